@@ -0,0 +1,116 @@
+"""
+Compares the order allocation strategies on synthetic data.
+
+Simulates a year of production and orders against the in-memory batch index, once per strategy with the same
+random data, and reports allocation latency, how many batches an order is split over, rejected orders and
+the quantity written off when batches expire with stock left.
+
+usage: python -m benchmarks.allocation_strategies --products 50 --days 365 --seed 1
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from utils.batch_index import ALLOCATION_STRATEGIES, BatchIndex
+
+
+def synthetic_days(products: int, days: int, seed: int):
+    """
+    Per day, the batches produced and the orders placed. Shelf lives vary between batches,
+    so the oldest batch is not always the first to expire.
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, 8)
+    batch_id = 0
+    schedule = []
+    for day in range(days):
+        today = start + timedelta(days=day)
+        produced = []
+        orders = []
+        for product_id in range(1, products + 1):
+            if rng.random() < 0.3:
+                batch_id += 1
+                produced.append(SimpleNamespace(
+                    id=batch_id, product_id=product_id, name=f"batch {batch_id}",
+                    availableQuantity=rng.choice((50, 100, 200)),
+                    productionDate=today,
+                    dateOfExpiry=(today + timedelta(days=rng.randint(20, 120))).date(),
+                ))
+            # demand a little under production, 0.3 * ~117 per day
+            for _ in range(rng.randint(0, 4)):
+                orders.append((product_id, rng.randint(1, 30)))
+        rng.shuffle(orders)
+        schedule.append((today.date(), produced, orders))
+    return schedule
+
+
+def simulate(strategy: str, schedule):
+    index = BatchIndex(strategy)
+    # start from an empty database
+    index.replace([])
+    remaining = {}  # batch_id -> quantity left
+    expiries = {}  # day -> [batch_id]
+    latencies = []
+    splits = []
+    rejected = 0
+    written_off = 0
+    sold = 0
+
+    for today, produced, orders in schedule:
+        for batch in produced:
+            index.add_batch(batch)
+            remaining[batch.id] = batch.availableQuantity
+            expiries.setdefault(batch.dateOfExpiry, []).append(batch.id)
+
+        for product_id, quantity in orders:
+            start = time.perf_counter_ns()
+            allocations = index.reserve(product_id, quantity, today)
+            if allocations is not None:
+                index.confirm(allocations)
+            latencies.append(time.perf_counter_ns() - start)
+            if allocations is None:
+                rejected += 1
+                continue
+            splits.append(len(allocations))
+            sold += quantity
+            for batch_id, _, take in allocations:
+                remaining[batch_id] -= take
+
+        # what is left in a batch on its expiry date is written off at the end of the day
+        for batch_id in expiries.pop(today, []):
+            written_off += remaining.pop(batch_id)
+
+    latencies.sort()
+    return {
+        "orders": len(latencies),
+        "p50_us": latencies[len(latencies) // 2] / 1000,
+        "p99_us": latencies[int(len(latencies) * 0.99)] / 1000,
+        "batches_per_order": sum(splits) / len(splits),
+        "rejected": rejected,
+        "sold": sold,
+        "written_off": written_off,
+    }
+
+
+def main(products: int, days: int, seed: int):
+    schedule = synthetic_days(products, days, seed)
+    produced = sum(batch.availableQuantity for _, batches, _ in schedule for batch in batches)
+    print(f"{products} products over {days} days, {produced} units produced")
+    print(f"{'strategy':<12} {'orders':>8} {'p50 us':>8} {'p99 us':>8} {'batches/order':>14} "
+          f"{'rejected':>9} {'sold':>9} {'written off':>12}")
+    for strategy in ALLOCATION_STRATEGIES:
+        result = simulate(strategy, schedule)
+        print(f"{strategy:<12} {result['orders']:>8} {result['p50_us']:>8.1f} {result['p99_us']:>8.1f} "
+              f"{result['batches_per_order']:>14.2f} {result['rejected']:>9} {result['sold']:>9} "
+              f"{result['written_off']:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.products, args.days, args.seed)
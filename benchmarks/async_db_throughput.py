@@ -0,0 +1,92 @@
+"""
+Compare concurrent throughput of the old sync-session-in-async-handler setup with the AsyncSession one.
+
+Runs the same query through both engines from DB_URL / ASYNC_DB_URL while a heartbeat task measures how long
+the event loop gets stalled.
+
+usage: python -m benchmarks.async_db_throughput --requests 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select, func
+
+from models import models
+from utils.database import SessionLocal, AsyncSessionLocal, engine, async_engine
+
+
+def grn_query():
+    return (select(models.GRN.id, func.count(models.GRN_has_Ingredient.Ingredient_id))
+            .join(models.GRN_has_Ingredient, models.GRN_has_Ingredient.GRN_id == models.GRN.id, isouter=True)
+            .group_by(models.GRN.id))
+
+
+# what the handlers did before: a blocking call inside a coroutine
+async def sync_handler():
+    db = SessionLocal()
+    try:
+        return db.execute(grn_query()).all()
+    finally:
+        db.close()
+
+
+async def async_handler():
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(grn_query())).all()
+
+
+async def heartbeat(stop: asyncio.Event, lags: list):
+    # a healthy loop wakes up every ~1ms, anything above that is time other requests had to wait
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def run(handler, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await handler()
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lags = []
+    beat = asyncio.create_task(heartbeat(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+
+    latencies.sort()
+    return {
+        "requests/s": round(total / elapsed, 1),
+        "p50 ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99 ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "max loop stall ms": round(max(lags, default=0) * 1000, 2),
+    }
+
+
+async def main(total: int, concurrency: int):
+    # warm up both pools so connection setup is not measured
+    await sync_handler()
+    await async_handler()
+
+    for name, handler in (("sync session in async def", sync_handler), ("AsyncSession", async_handler)):
+        print(name, await run(handler, total, concurrency))
+
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,63 @@
+"""
+Keystroke latency of the autocomplete index.
+
+Builds one PrefixIndex per type over synthetic names, then types sampled names one character at a time and
+times every lookup the way /autocomplete runs it, from memory. Also times the insert a create route makes.
+
+usage: python -m benchmarks.autocomplete --rows 1000000 --words 500 --seed 1
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.name_search import synthetic_names
+from utils.autocomplete import AUTOCOMPLETE_MODELS, Autocomplete, PrefixIndex
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main(rows: int, words: int, seed: int, limit: int):
+    rng = random.Random(seed)
+    autocomplete = Autocomplete()
+    per_type = rows // len(AUTOCOMPLETE_MODELS)
+    names = synthetic_names(per_type, rng)
+    start = time.perf_counter()
+    # the same names under every type, so every type has matches to merge
+    autocomplete._indexes = {kind: PrefixIndex.build(enumerate(names, 1)) for kind in AUTOCOMPLETE_MODELS}
+    print(f"{per_type * len(AUTOCOMPLETE_MODELS)} names indexed in {time.perf_counter() - start:.1f}s: "
+          f"{autocomplete.stats()}")
+
+    latencies = []
+    returned = 0
+    for _ in range(words):
+        typed = rng.choice(names)
+        for length in range(1, len(typed) + 1):
+            start = time.perf_counter_ns()
+            items = await autocomplete.complete(typed[:length], None, limit)
+            latencies.append(time.perf_counter_ns() - start)
+            returned += len(items)
+    print(f"{len(latencies)} keystrokes, {returned / len(latencies):.1f} names returned per keystroke, "
+          f"latency p50 {percentile(latencies, 0.5) / 1000:.1f} us, p99 {percentile(latencies, 0.99) / 1000:.1f} us, "
+          f"max {max(latencies) / 1000:.1f} us")
+
+    inserts = []
+    for row_id, name in enumerate(synthetic_names(1000, rng), per_type + 1):
+        start = time.perf_counter_ns()
+        autocomplete.add("ingredient", row_id, name)
+        inserts.append(time.perf_counter_ns() - start)
+    print(f"{len(inserts)} inserts, p50 {percentile(inserts, 0.5) / 1000:.1f} us, "
+          f"p99 {percentile(inserts, 0.99) / 1000:.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--words", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.words, args.seed, args.limit))
@@ -0,0 +1,77 @@
+"""
+Concurrent load check for /batch/add.
+
+Fires many batch creations for one product at the same time and then checks that the stock of every recipe
+ingredient was reduced exactly once per successful batch and never went negative. Exits with status 1 when it was not.
+
+usage: python -m benchmarks.batch_add_load --product-id 1 --requests 100 --concurrency 20
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+from sqlalchemy import select
+
+from main import app
+from models import models
+from utils.database import AsyncSessionLocal, async_engine
+
+
+async def stock_for_product(product_id: int):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(models.RecipeHasIngredient.Ingredient_id,
+                   models.RecipeHasIngredient.quantity,
+                   models.CurrentStock.current_quantity)
+            .join(models.Product, models.Product.Recipe_id == models.RecipeHasIngredient.Recipe_id)
+            .join(models.CurrentStock, models.CurrentStock.Ingredient_id == models.RecipeHasIngredient.Ingredient_id)
+            .filter(models.Product.id == product_id)
+        )
+        return {ingredient_id: (quantity, current) for ingredient_id, quantity, current in result}
+
+
+async def main(product_id: int, total: int, concurrency: int, batch_count: int):
+    before = await stock_for_product(product_id)
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load") as client:
+        async def one():
+            async with semaphore:
+                response = await client.post("/batch/add", json={"product_id": product_id,
+                                                                 "batch_count": batch_count})
+                statuses.append(response.status_code)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+
+    after = await stock_for_product(product_id)
+    created = statuses.count(200)
+    print(f"{total} requests in {elapsed:.2f}s, {created} batches created, statuses: "
+          f"{ {code: statuses.count(code) for code in set(statuses)} }")
+
+    ok = True
+    for ingredient_id, (quantity, current_before) in before.items():
+        expected = current_before - quantity * batch_count * created
+        current_after = after[ingredient_id][1]
+        if current_after != expected or current_after < 0:
+            ok = False
+            print(f"ingredient {ingredient_id}: expected {expected}, found {current_after}")
+    print("stock consistent" if ok else "STOCK INCONSISTENT")
+
+    await async_engine.dispose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--product-id", type=int, required=True)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch-count", type=int, default=1)
+    args = parser.parse_args()
+    if not asyncio.run(main(args.product_id, args.requests, args.concurrency, args.batch_count)):
+        sys.exit(1)
@@ -0,0 +1,75 @@
+"""
+Fan-out check for /dashboard/stream.
+
+Opens many server-sent event connections to a running server, makes writes through the API and measures how
+long each listener takes to see the delta. Needs a real server, the in-memory ASGI transport buffers streams.
+
+usage: uvicorn main:app  then  python -m benchmarks.dashboard_stream_fanout --listeners 500 --writes 20
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+
+async def listen(client, ready, received, writes):
+    async with client.stream("GET", "/dashboard/stream") as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "snapshot":
+                    ready.release()
+                elif event == "delta":
+                    arrived = time.perf_counter()
+                    seen = json.loads(line[len("data: "):]).get("totalIngredients", 0)
+                    received.extend([arrived] * seen)
+                    if len(received) >= writes:
+                        return
+
+
+async def main(base_url: str, listeners: int, writes: int):
+    limits = httpx.Limits(max_connections=listeners + 10)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+        ready = asyncio.Semaphore(0)
+        deliveries = [[] for _ in range(listeners)]
+        tasks = [asyncio.create_task(listen(client, ready, deliveries[i], writes)) for i in range(listeners)]
+        connected = asyncio.gather(*(ready.acquire() for _ in range(listeners)))
+        done, _ = await asyncio.wait([connected, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        if connected not in done:
+            # a listener failed before every snapshot arrived
+            for task in done:
+                task.result()
+        stats = (await client.get("/dashboard/cache_stats")).json()
+        print(f"{listeners} listeners connected, server reports {stats['streamListeners']}")
+
+        sent = []
+        for _ in range(writes):
+            sent.append(time.perf_counter())
+            response = await client.post("/ingredient/add", json={"name": "fanout-" + uuid.uuid4().hex[:12],
+                                                                  "description": "stream fan-out check"})
+            response.raise_for_status()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=60)
+
+    # deltas can be merged, so latency is measured from the last write a listener has seen
+    latencies = sorted(
+        (arrived - sent[index]) * 1000
+        for received in deliveries
+        for index, arrived in enumerate(received[:writes])
+    )
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{len(latencies)} deliveries, latency p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {latencies[-1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--listeners", type=int, default=200)
+    parser.add_argument("--writes", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.base_url, args.listeners, args.writes))
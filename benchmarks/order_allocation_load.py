@@ -0,0 +1,123 @@
+"""
+Concurrency check for /order/add.
+
+Fires many orders for one product at the same time, then checks that no batch was oversold: every batch keeps a
+non-negative quantity, the quantity taken off the batches equals what the successful orders asked for, and each
+order's Order_has_Batch rows add up to its quantity. Exits with status 1 when any check fails.
+
+Without --product-id it seeds a product with --batches batches into the configured database first, so it also
+runs against an empty SQLite file. Row locks and SKIP LOCKED are only exercised on MySQL.
+
+usage: python -m benchmarks.order_allocation_load --product-id 1 --requests 200 --concurrency 50 --max-quantity 5
+       DB_URL=sqlite:///load.db ASYNC_DB_URL=sqlite+aiosqlite:///load.db python -m benchmarks.order_allocation_load
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import httpx
+from sqlalchemy import select, func
+
+from main import app
+from models import models
+from utils.database import AsyncSessionLocal, async_engine
+
+
+async def seed_product(batches: int, max_quantity: int):
+    """
+    A product with batches of random size and expiry, a few hundred orders run it out so 409s are exercised too
+    """
+    async with AsyncSessionLocal() as db:
+        product = models.Product(name="load product", type="load", selling_price=1, batch_size=1)
+        db.add(product)
+        await db.flush()
+        today = date.today()
+        db.add_all(models.Batch(name=f"load batch {number}", product_id=product.id,
+                                productionDate=datetime.now() - timedelta(days=random.randint(0, 30)),
+                                dateOfExpiry=today + timedelta(days=random.randint(1, 60)),
+                                initialQuantity=quantity, availableQuantity=quantity)
+                   for number, quantity in enumerate(random.randint(1, 4 * max_quantity) for _ in range(batches)))
+        await db.commit()
+        return product.id
+
+
+async def batch_quantities(product_id: int):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(models.Batch.id, models.Batch.availableQuantity).filter(models.Batch.product_id == product_id)
+        )
+        return dict(result.all())
+
+
+async def allocated_per_order(order_ids):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(models.OrderHasBatch.Order_id, func.sum(models.OrderHasBatch.quantity))
+            .filter(models.OrderHasBatch.Order_id.in_(order_ids))
+            .group_by(models.OrderHasBatch.Order_id)
+        )
+        return dict(result.all())
+
+
+async def main(product_id, total: int, concurrency: int, max_quantity: int, batches: int):
+    if product_id is None:
+        product_id = await seed_product(batches, max_quantity)
+        print(f"seeded product {product_id} with {batches} batches")
+    before = await batch_quantities(product_id)
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+    placed = {}  # order id -> quantity
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load") as client:
+        async def one(number):
+            quantity = random.randint(1, max_quantity)
+            async with semaphore:
+                response = await client.post("/order/add", json={"name": f"load order {number}",
+                                                                 "quantity": quantity,
+                                                                 "Product_id": product_id})
+            statuses.append(response.status_code)
+            if response.status_code == 200:
+                placed[response.json()["id"]] = quantity
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(number) for number in range(total)))
+        elapsed = time.perf_counter() - start
+
+    after = await batch_quantities(product_id)
+    allocated = await allocated_per_order(list(placed)) if placed else {}
+    print(f"{total} orders in {elapsed:.2f}s ({total / elapsed:.0f}/s), statuses: "
+          f"{ {code: statuses.count(code) for code in set(statuses)} }")
+
+    ok = True
+    negative = {batch_id: quantity for batch_id, quantity in after.items() if quantity < 0}
+    if negative:
+        ok = False
+        print(f"batches with negative quantity: {negative}")
+    taken = sum(before.values()) - sum(after.values())
+    if taken != sum(placed.values()):
+        ok = False
+        print(f"batches lost {taken}, successful orders asked for {sum(placed.values())}")
+    wrong = {order_id: (quantity, allocated.get(order_id)) for order_id, quantity in placed.items()
+             if allocated.get(order_id) != quantity}
+    if wrong:
+        ok = False
+        print(f"orders whose allocations do not add up (ordered, allocated): {wrong}")
+    print("no overselling" if ok else "OVERSOLD")
+
+    await async_engine.dispose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--product-id", type=int)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--max-quantity", type=int, default=5)
+    args = parser.parse_args()
+    if not asyncio.run(main(args.product_id, args.requests, args.concurrency, args.max_quantity, args.batches)):
+        sys.exit(1)
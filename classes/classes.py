@@ -4,7 +4,9 @@ from typing import List
 from typing import Optional
 from decimal import Decimal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 
 class BaseIngredient(BaseModel):
@@ -32,6 +34,14 @@ class Current_Stock(BaseModel):
     current_quantity: int
 
 
+# manual stock correction, adjustments are signed, write-offs take the quantity to remove
+class StockAdjustment(BaseModel):
+    Ingredient_id: int
+    quantity: int
+    type: str = "adjustment"
+    note: Optional[str] = None
+
+
 # create GRN
 class BaseGRN(BaseModel):
     ingredients: List[IngredientInfo] = []
@@ -109,13 +119,22 @@ class UpdateBaseUser(BaseModel):
 
 class BaseBatchCreate(BaseModel):
     product_id: int
-    batch_count: int = 1  # default to a one batch
+    batch_count: int = Field(1, gt=0)  # default to a one batch
 
 
 class BaseBatch(BaseBatchCreate):
     id: Optional[int] = None
 
 
+class BaseBatchBulkCreate(BaseModel):
+    batches: List[BaseBatchCreate]
+
+
+# batches a production plan would make, nothing is produced
+class ProductionPlan(BaseModel):
+    batches: List[BaseBatchCreate]
+
+
 class LocationBase(BaseModel):
     name: str
     address: str
@@ -141,12 +160,17 @@ class LocationResponse(LocationBase):
 class SearchUsersForLocation(BaseModel):
     name: str
     locationID: int
+    cursor: Optional[str] = None
+    limit: int = Field(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
 
 class CreateOrder(BaseModel):
     name: str
     quantity: int
     Product_id: int
 
+class BaseOrderBulkCreate(BaseModel):
+    orders: List[CreateOrder]
+
 class UpdateOrder(BaseModel):
     id: int
     name: str
@@ -1,17 +1,41 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
 
 from routes import orderRoute, ingredientRoute, batchRoute, locationRoute, recipeRoute, grnRoute, productRoute
-from routes import userRoute, dashboardRoute
-from utils.database import engine
+from routes import userRoute, dashboardRoute, stockRoute, autocompleteRoute
+from utils.autocomplete import run_autocomplete_refresh
+from utils.database import engine, async_engine, AsyncSessionLocal
+from utils.expiry import run_expiry_sweeper
+from utils.migrations import migrate
+from utils.snapshots import run_snapshot_job
+from utils.stock import open_ledger
 from models import models
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
 
-
-app = FastAPI(title="Group5")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # stock from before the ledger is carried into it, once
+    async with AsyncSessionLocal() as db:
+        await open_ledger(db)
+        await db.commit()
+    # background jobs live as long as the app
+    jobs = [asyncio.create_task(run_expiry_sweeper()), asyncio.create_task(run_snapshot_job()),
+            asyncio.create_task(run_autocomplete_refresh())]
+    yield
+    for job in jobs:
+        job.cancel()
+    # let the jobs finish cancelling before their connections go away
+    await asyncio.gather(*jobs, return_exceptions=True)
+    await async_engine.dispose()
+
+
+app = FastAPI(title="Group5", lifespan=lifespan)
 #app.include_router(receipyRoute.router)
 app.include_router(ingredientRoute.router)
 app.include_router(userRoute.router)
@@ -29,7 +53,13 @@ app.include_router(productRoute.router)
 
 app.include_router(dashboardRoute.router)
 
+app.include_router(stockRoute.router)
+
+app.include_router(autocompleteRoute.router)
+
 models.Base.metadata.create_all(bind=engine)
+# columns and indexes added to tables that create_all leaves alone
+migrate(engine)
 
 origins = ["*"]
 
@@ -39,6 +69,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # paginated streaming responses carry their cursor in a header
+    expose_headers=["X-Next-Cursor"],
 )
 
 
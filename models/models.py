@@ -1,7 +1,7 @@
 from datetime import datetime
 from datetime import date
 
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Table, DateTime, Date, DECIMAL
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Table, DateTime, Date, DECIMAL, Index
 from sqlalchemy.orm import relationship
 
 from utils.database import Base
@@ -14,8 +14,23 @@ class Order(Base):
     name = Column(String(100))
     quantity = Column(Integer)
     Product_id = Column(Integer, ForeignKey('Product.id'))
+    createdAt = Column(DateTime, default=datetime.now)
     product = relationship("Product", back_populates="orders")
 
+    # /order/all filters on the order date
+    __table_args__ = (
+        Index('ix_order_createdAt', 'createdAt'),
+    )
+
+
+class OrderHasBatch(Base):
+    __tablename__ = 'Order_has_Batch'
+
+    # how much of an order was taken from each batch
+    Order_id = Column(Integer, ForeignKey('order.id'), primary_key=True)
+    Batch_id = Column(Integer, ForeignKey('Batch.id'), primary_key=True, index=True)
+    quantity = Column(Integer, nullable=False)
+
 
 class RecipeHasIngredient(Base):
     __tablename__ = 'Recipe_has_Ingredient'
@@ -34,6 +49,11 @@ class Recipe(Base):
     products = relationship("Product", back_populates='recipe')
     ingredients = relationship("Ingredient", secondary="Recipe_has_Ingredient", back_populates='recipes')
 
+    # name search, MySQL only, ngram tokens so any part of a name matches (utils/search.py)
+    __table_args__ = (
+        Index('ft_Recipe_name', 'name', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+
 
 class Product(Base):
     __tablename__ = 'Product'
@@ -50,6 +70,11 @@ class Product(Base):
     batches = relationship("Batch", back_populates='product')
     orders = relationship('Order', back_populates='product')
 
+    # name search
+    __table_args__ = (
+        Index('ft_Product_name', 'name', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+
 
 class LocationHasUsers(Base):
     __tablename__ = 'Location_has_User'
@@ -71,6 +96,11 @@ class User(Base):
     locations = relationship("Location", secondary="Location_has_User", back_populates='users')
     userType = relationship("UserType", back_populates='user')
 
+    # name search
+    __table_args__ = (
+        Index('ft_User_name', 'name', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+
 
 class UserType(Base):
     __tablename__ = 'UserType'
@@ -99,6 +129,11 @@ class Ingredient(Base):
     recipes = relationship("Recipe", secondary="Recipe_has_Ingredient", back_populates='ingredients')
     current_stock = relationship("CurrentStock", back_populates='ingredient', uselist=False)
 
+    # name search
+    __table_args__ = (
+        Index('ft_Ingredient_name', 'name', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+
 
 class CurrentStock(Base):
     __tablename__ = 'Current_Stock'
@@ -108,6 +143,40 @@ class CurrentStock(Base):
     ingredient = relationship("Ingredient", back_populates='current_stock')
 
 
+class StockMovement(Base):
+    __tablename__ = 'Stock_Movement'
+
+    # append only, Current_Stock is the running total of these rows
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    Ingredient_id = Column(Integer, ForeignKey('Ingredient.id'), nullable=False)
+    type = Column(String(50), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    GRN_id = Column(Integer, ForeignKey('GRN.id'), nullable=True)
+    Batch_id = Column(Integer, ForeignKey('Batch.id'), nullable=True)
+    note = Column(String(255))
+    createdAt = Column(DateTime, nullable=False, default=datetime.now)
+    # business date the stock changed on: the GRN issuedDate or the batch productionDate, createdAt otherwise.
+    # Always written, nullable only so the column can be added to a filled table (utils/migrations.py)
+    effectiveAt = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_Stock_Movement_Ingredient_id_createdAt', 'Ingredient_id', 'createdAt'),
+        Index('ix_Stock_Movement_createdAt', 'createdAt'),
+        # snapshots and point in time queries read one period of movements across all ingredients
+        Index('ix_Stock_Movement_effectiveAt', 'effectiveAt'),
+        Index('ix_Stock_Movement_Ingredient_id_effectiveAt', 'Ingredient_id', 'effectiveAt'),
+    )
+
+
+class StockSnapshot(Base):
+    __tablename__ = 'Stock_Snapshot'
+
+    # stock of every ingredient including all movements with effectiveAt <= takenAt
+    takenAt = Column(DateTime, primary_key=True)
+    Ingredient_id = Column(Integer, ForeignKey('Ingredient.id'), primary_key=True)
+    quantity = Column(Integer, nullable=False)
+
+
 class GRN(Base):
     __tablename__ = 'GRN'
 
@@ -115,6 +184,11 @@ class GRN(Base):
     issuedDate = Column(DateTime, default=datetime.now)
     ingredient = relationship("Ingredient",secondary="GRN_has_Ingredient", back_populates="grn")
 
+    # /grn/view_all pages and filters on issuedDate
+    __table_args__ = (
+        Index('ix_GRN_issuedDate_id', 'issuedDate', 'id'),
+    )
+
 
 class GRN_has_Ingredient(Base):
     __tablename__ = 'GRN_has_Ingredient'
@@ -133,9 +207,40 @@ class Batch(Base):
     initialQuantity = Column(Integer)
     availableQuantity = Column(Integer)
     dateOfExpiry = Column(Date)
+    # set by the expiry sweeper, the remaining quantity is moved to writtenOffQuantity
+    expired = Column(Boolean, nullable=False, default=False, server_default='0')
+    writtenOffQuantity = Column(Integer, nullable=False, default=0, server_default='0')
     product_id = Column(Integer, ForeignKey("Product.id"))
     product = relationship("Product", back_populates="batches")
 
+    # keyset pagination of /batch/all walks this index
+    __table_args__ = (
+        Index('ix_Batch_productionDate_id', 'productionDate', 'id'),
+        # the sweeper looks up (expired = false, dateOfExpiry < today), counts use (expired = true)
+        Index('ix_Batch_expired_dateOfExpiry', 'expired', 'dateOfExpiry'),
+        # order allocation walks a product's batches oldest first
+        Index('ix_Batch_product_productionDate', 'product_id', 'productionDate', 'id'),
+        # first expiry first and closest fit allocation
+        Index('ix_Batch_product_dateOfExpiry_available', 'product_id', 'dateOfExpiry', 'availableQuantity'),
+    )
+
+
+class DailyRollup(Base):
+    __tablename__ = 'Daily_Rollup'
+
+    # pre-aggregated analytics, one row per metric, day and product or ingredient (0 for plain totals)
+    metric = Column(String(50), primary_key=True)
+    day = Column(Date, primary_key=True)
+    key_id = Column(Integer, primary_key=True, default=0)
+    value = Column(Integer, nullable=False, default=0)
+
+
+class Counter(Base):
+    __tablename__ = 'Counter'
+
+    name = Column(String(100), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
 
 # models.py
 
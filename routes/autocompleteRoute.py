@@ -0,0 +1,24 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from utils.autocomplete import autocomplete, AUTOCOMPLETE_MODELS, AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT
+
+router = APIRouter()
+
+
+@router.get("/autocomplete", summary="Names of ingredients, products, recipes and locations starting with q")
+async def get_autocomplete(q: str,
+                           type: Optional[List[str]] = Query(None),
+                           limit: int = Query(AUTOCOMPLETE_LIMIT, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)):
+    # served from memory, called on every keystroke
+    unknown = set(type or []) - AUTOCOMPLETE_MODELS.keys()
+    if unknown:
+        raise HTTPException(status_code=400,
+                            detail="Unknown type, one of: " + ", ".join(AUTOCOMPLETE_MODELS))
+    return {"items": await autocomplete.complete(q, type, limit)}
+
+
+@router.get("/autocomplete/stats")
+async def get_autocomplete_stats():
+    return autocomplete.stats()
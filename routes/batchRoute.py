@@ -1,85 +1,234 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy import func, cast, Integer
-from sqlalchemy.orm import Session, joinedload
-from typing import Annotated, List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import Annotated, Optional
+from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 
 from models import models
-from classes.classes import BaseBatchCreate, BaseBatch  # We'll define BaseBatchCreate for the POST request
-from utils.database import SessionLocal
+from classes.classes import BaseBatchCreate, BaseBatchBulkCreate, ProductionPlan
+from utils.analytics import BATCHES_PRODUCED, INGREDIENT_CONSUMED, add_to_rollups, rollup_rows
+from utils.batch_index import batch_index
+from utils.cache import count_on_dashboard
+from utils.database import AsyncSessionLocal, insert_returning_ids
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, keyset_after
+from utils.planning import explode_plan, max_batches_per_recipe
+from utils.stock import BATCH_CONSUMPTION, movement_rows, record_movements
 
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Annotation for dependency injection
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.get("/batch/all")
-async def get_all_batches(db: db_dependency):
-    return db.query(models.Batch).options(joinedload(models.Batch.product)).all()
+async def get_all_batches(db: db_dependency,
+                          cursor: Optional[str] = None,
+                          limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          product_id: Optional[int] = None,
+                          expiry_from: Optional[date] = None,
+                          expiry_to: Optional[date] = None,
+                          available: Optional[bool] = None):
+    """
+    Newest batches first, paginated on (productionDate, id). Pass the returned next_cursor to get the next page.
+    """
+    query = (select(models.Batch.id,
+                    models.Batch.name,
+                    models.Batch.productionDate,
+                    models.Batch.initialQuantity,
+                    models.Batch.availableQuantity,
+                    models.Batch.dateOfExpiry,
+                    models.Batch.product_id,
+                    models.Product.name.label("product_name"),
+                    models.Product.type.label("product_type"))
+             .join(models.Product, models.Product.id == models.Batch.product_id)
+             .order_by(models.Batch.productionDate.desc(), models.Batch.id.desc())
+             .limit(limit + 1))
+
+    if cursor:
+        query = query.filter(keyset_after(models.Batch.productionDate, models.Batch.id, cursor))
+    if product_id is not None:
+        query = query.filter(models.Batch.product_id == product_id)
+    if expiry_from:
+        query = query.filter(models.Batch.dateOfExpiry >= expiry_from)
+    if expiry_to:
+        query = query.filter(models.Batch.dateOfExpiry <= expiry_to)
+    if available is True:
+        query = query.filter(models.Batch.availableQuantity > 0)
+    elif available is False:
+        query = query.filter(models.Batch.availableQuantity <= 0)
+
+    rows = (await db.execute(query)).all()
+    # one extra row is fetched to know whether there is a next page
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1].productionDate, page[-1].id) if len(rows) > limit else None
+
+    return {
+        "items": [
+            {
+                "id": row.id,
+                "name": row.name,
+                "productionDate": row.productionDate,
+                "initialQuantity": row.initialQuantity,
+                "availableQuantity": row.availableQuantity,
+                "dateOfExpiry": row.dateOfExpiry,
+                "product_id": row.product_id,
+                "product": {"id": row.product_id, "name": row.product_name, "type": row.product_type},
+            }
+            for row in page
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+@router.get("/batch/producible")
+async def get_producible_batches(db: db_dependency):
+    """
+    Max number of batches of every product the current stock can make, with the ingredient that limits it
+    """
+    products = (await db.execute(
+        select(models.Product.id, models.Product.name, models.Product.Recipe_id)
+    )).all()
+    recipe_lines = (await db.execute(
+        select(models.RecipeHasIngredient.Recipe_id,
+               models.RecipeHasIngredient.Ingredient_id,
+               models.RecipeHasIngredient.quantity)
+    )).all()
+    stock = dict((await db.execute(
+        select(models.CurrentStock.Ingredient_id, models.CurrentStock.current_quantity)
+    )).all())
+    ingredient_names = dict((await db.execute(select(models.Ingredient.id, models.Ingredient.name))).all())
+
+    recipe_ids, ingredient_ids, quantities = zip(*recipe_lines) if recipe_lines else ((), (), ())
+    quantities = [quantity or 0 for quantity in quantities]
+    per_recipe = max_batches_per_recipe(recipe_ids, ingredient_ids, quantities, stock)
+    per_batch = {(recipe_id, ingredient_id): quantity
+                 for recipe_id, ingredient_id, quantity in zip(recipe_ids, ingredient_ids, quantities)}
+
+    results = []
+    for product_id, product_name, recipe_id in products:
+        max_batches, limiting_id = per_recipe.get(recipe_id, (0, None))
+        results.append({
+            "product_id": product_id,
+            "product_name": product_name,
+            "max_batches": max_batches,
+            "limiting_ingredient": {
+                "id": limiting_id,
+                "name": ingredient_names.get(limiting_id),
+                "current_quantity": stock.get(limiting_id, 0),
+                "quantity_per_batch": per_batch[(recipe_id, limiting_id)],
+            } if limiting_id is not None else None
+        })
+    return results
+
+
+@router.post("/batch/plan", summary="Ingredients a production plan needs and what is short")
+async def explode_production_plan(db: db_dependency, plan: ProductionPlan):
+    """
+    Totals the ingredients of a plan such as 20 batches of A and 5 of B against Current_Stock.
+    Every short ingredient lists the plan lines that use it and the line at which the plan runs out of it.
+    Three queries whatever the size of the plan.
+    """
+    if not plan.batches:
+        raise HTTPException(status_code=400, detail="No batches given")
+
+    product_ids = {line.product_id for line in plan.batches}
+    products = {product_id: (name, recipe_id) for product_id, name, recipe_id in (await db.execute(
+        select(models.Product.id, models.Product.name, models.Product.Recipe_id)
+        .filter(models.Product.id.in_(product_ids))
+    )).all()}
+    for product_id in product_ids:
+        if product_id not in products:
+            raise HTTPException(status_code=404, detail="Product not found: " + str(product_id))
+        if not products[product_id][1]:
+            raise HTTPException(status_code=404, detail="Recipe not found for product: " + str(product_id))
+
+    recipe_ingredients = await get_recipe_ingredients(db, {recipe_id for _, recipe_id in products.values()})
+    recipe_lines = [(recipe_id, ingredient_id, quantity)
+                    for recipe_id, ingredients in recipe_ingredients.items()
+                    for ingredient_id, (_, quantity) in ingredients.items()]
+    names = {ingredient_id: name
+             for ingredients in recipe_ingredients.values()
+             for ingredient_id, (name, _) in ingredients.items()}
+    stock = dict((await db.execute(
+        select(models.CurrentStock.Ingredient_id, models.CurrentStock.current_quantity)
+        .filter(models.CurrentStock.Ingredient_id.in_(names.keys()))
+    )).all())
+
+    recipe_ids, ingredient_ids, quantities = zip(*recipe_lines) if recipe_lines else ((), (), ())
+    ingredients, required, current, shortfall, usage, first_over = explode_plan(
+        [products[line.product_id][1] for line in plan.batches],
+        [line.batch_count for line in plan.batches],
+        recipe_ids, ingredient_ids, quantities, stock)
+
+    results = []
+    for column, ingredient_id in enumerate(ingredients.tolist()):
+        short = int(shortfall[column])
+        results.append({
+            "id": ingredient_id,
+            "name": names[ingredient_id],
+            "required": int(required[column]),
+            "current_quantity": int(current[column]),
+            "shortfall": short,
+            # the plan lines drawing on a short ingredient, in plan order
+            "lines": [
+                {"line": line, "product_id": plan.batches[line].product_id,
+                 "batch_count": plan.batches[line].batch_count, "quantity": int(usage[line, column])}
+                for line in usage[:, column].nonzero()[0].tolist()
+            ] if short else [],
+            "runs_out_at_line": int(first_over[column]) if short else None,
+        })
+    results.sort(key=lambda ingredient: (-ingredient["shortfall"], ingredient["id"]))
+
+    return {
+        "feasible": not shortfall.any(),
+        "ingredients": results,
+    }
+
+
+@router.get("/batch/index_stats")
+async def get_batch_index_stats():
+    return batch_index.stats()
 
 
 @router.post("/batch/add")
 async def create_batch(db: db_dependency, batch_data: BaseBatchCreate):
-    new_batch = None
     # validate against product
-    batch_product: models.Product = db.query(models.Product).filter(models.Product.id == batch_data.product_id).first()
+    batch_product: models.Product = (await db.execute(
+        select(models.Product).filter(models.Product.id == batch_data.product_id)
+    )).scalars().first()
     if not batch_product:
         raise HTTPException(status_code=404, detail="Product not found")
-    # check weather the brewery has enough ingredients to make this batch
-    # fetch the ingredients for the recipe in the product
-    batch_recipe: models.Recipe = batch_product.recipe
-    if not batch_recipe:
+    if not batch_product.Recipe_id:
         raise HTTPException(status_code=404, detail="Recipe not found")
 
-    ingredients = batch_product.recipe.ingredients
-    if not ingredients:
+    # fetch the ingredients for the recipe in the product with its quantities
+    recipe_ingredients = await get_recipe_ingredients(db, [batch_product.Recipe_id])
+    if not recipe_ingredients:
         raise HTTPException(status_code=404, detail="Ingredients not found")
 
-    # get ingredients for the recipe with is quantities
-    batch_recipe_ingredients = (db
-                                .query(models.RecipeHasIngredient)
-                                .filter(models.RecipeHasIngredient.Recipe_id == batch_recipe.id)
-                                .all())
-
-    processed_batch_recipe_ingredients = [
-        {"ingredient_id": item.Ingredient_id, "Recipe_id": item.Recipe_id, "quantity": int(item.quantity)}
-        for item in batch_recipe_ingredients
-    ]
-
-    result = db.query(models.CurrentStock).all()
-    # convert to dictionary type
-    processed_total_ingredients = [
-        {"id": item.Ingredient_id, "totalQuantity": int(item.current_quantity)}
-        for item in result
-    ]
-
-    for ingredient in ingredients:
-        # get the current quantity
-        total_ingredient_record = next(filter(lambda x: x["id"] == ingredient.id, processed_total_ingredients), None)
-        recipe_ingredient_record = next(filter(lambda x: x["ingredient_id"] == ingredient.id,
-                                               processed_batch_recipe_ingredients), None)
-        # check if current quantity is enough to make batch
-        if total_ingredient_record and recipe_ingredient_record:
-            if total_ingredient_record["totalQuantity"] < (int(recipe_ingredient_record["quantity"]) * batch_data.batch_count):
-                raise HTTPException(status_code=404,
-                                    detail="Ingredients not sufficient to make the batch, name: " + ingredient.name)
-        else:
-            raise HTTPException(status_code=404,
-                                detail="Ingredients not sufficient to make the batch, name: " + ingredient.name)
+    # total quantity of each ingredient needed for the requested batches
+    required = {
+        ingredient_id: quantity * batch_data.batch_count
+        for ingredient_id, (_, quantity) in recipe_ingredients[batch_product.Recipe_id].items()
+    }
+    names = {ingredient_id: name for ingredient_id, (name, _) in recipe_ingredients[batch_product.Recipe_id].items()}
+
+    # check weather the brewery has enough ingredients to make this batch, the stock rows stay locked until commit
+    await reserve_stock(db, required, names)
 
     # creating a batch record and then reduce stocks for ingredients
-    expire_data = (datetime.now() + relativedelta(months=batch_product.expire_duration))
+    expire_data = (datetime.now() + relativedelta(months=batch_product.expire_duration)).date()
     new_batch = models.Batch(
         name='Batch of Product: ' + batch_product.name + ' of type: ' + batch_product.type,
         productionDate=datetime.now(),
@@ -88,22 +237,137 @@ async def create_batch(db: db_dependency, batch_data: BaseBatchCreate):
         dateOfExpiry=expire_data,
         product_id=batch_product.id
     )
-
     db.add(new_batch)
-    db.commit()
-    db.refresh(new_batch)
-
-    # reduce the current quantities
-    for ingredient in ingredients:
-        # get the current quantity
-        recipe_ingredient_record = next(filter(lambda x: x["ingredient_id"] == ingredient.id,
-                                               processed_batch_recipe_ingredients), None)
-        if recipe_ingredient_record:
-            current_stock = ingredient.current_stock
-            if current_stock:
-                current_stock.current_quantity -= (int(recipe_ingredient_record["quantity"]) * batch_data.batch_count)
-        db.commit()
-    return (db.query(models.Batch)
-            .options(joinedload(models.Batch.product))
-            .filter(models.Batch.id == new_batch.id)
-            .first())
+    await db.flush()
+    await record_movements(db, movement_rows(BATCH_CONSUMPTION,
+                                             {ingredient_id: -quantity for ingredient_id, quantity in required.items()},
+                                             Batch_id=new_batch.id),
+                           require_stock=True)
+    production_day = new_batch.productionDate.date()
+    await add_to_rollups(db, rollup_rows(BATCHES_PRODUCED, production_day, {batch_product.id: 1})
+                         + rollup_rows(INGREDIENT_CONSUMED, production_day, required))
+
+    # batch, stock deduction and rollups are committed together
+    await db.commit()
+    count_on_dashboard("totalBatches")
+    batch_index.add_batch(new_batch)
+    return (await db.execute(
+        select(models.Batch)
+        .options(joinedload(models.Batch.product))
+        .filter(models.Batch.id == new_batch.id)
+    )).scalars().first()
+
+
+@router.post("/batch/add_bulk")
+async def create_batches_bulk(db: db_dependency, bulk_data: BaseBatchBulkCreate):
+    if not bulk_data.batches:
+        raise HTTPException(status_code=400, detail="No batches given")
+
+    # validate all the products at once
+    product_ids = {line.product_id for line in bulk_data.batches}
+    products = {product.id: product for product in (await db.execute(
+        select(models.Product).filter(models.Product.id.in_(product_ids))
+    )).scalars()}
+    for product_id in product_ids:
+        if product_id not in products:
+            raise HTTPException(status_code=404, detail="Product not found: " + str(product_id))
+        if not products[product_id].Recipe_id:
+            raise HTTPException(status_code=404, detail="Recipe not found for product: " + str(product_id))
+
+    recipe_ingredients = await get_recipe_ingredients(db, {product.Recipe_id for product in products.values()})
+
+    # sum the ingredient requirements over the whole request
+    required = {}
+    names = {}
+    for line in bulk_data.batches:
+        ingredients = recipe_ingredients.get(products[line.product_id].Recipe_id)
+        if not ingredients:
+            raise HTTPException(status_code=404, detail="Ingredients not found for product: " + str(line.product_id))
+        for ingredient_id, (name, quantity) in ingredients.items():
+            required[ingredient_id] = required.get(ingredient_id, 0) + quantity * line.batch_count
+            names[ingredient_id] = name
+
+    await reserve_stock(db, required, names)
+
+    production_date = datetime.now()
+    new_batches = []
+    for line in bulk_data.batches:
+        product = products[line.product_id]
+        new_batches.append({
+            "name": 'Batch of Product: ' + product.name + ' of type: ' + product.type,
+            "productionDate": production_date,
+            "initialQuantity": product.batch_size,
+            "availableQuantity": product.batch_size,
+            "dateOfExpiry": (production_date + relativedelta(months=product.expire_duration)).date(),
+            "product_id": product.id,
+        })
+
+    # one insert for the batches and one round of statements for the stock, committed together
+    batch_ids = await insert_returning_ids(db, models.Batch, new_batches)
+    await record_movements(db, [
+        row
+        for line, batch_id in zip(bulk_data.batches, batch_ids)
+        for row in movement_rows(BATCH_CONSUMPTION,
+                                 {ingredient_id: -quantity * line.batch_count
+                                  for ingredient_id, (_, quantity)
+                                  in recipe_ingredients[products[line.product_id].Recipe_id].items()},
+                                 Batch_id=batch_id)
+    ], require_stock=True)
+    for batch, batch_id in zip(new_batches, batch_ids):
+        batch["id"] = batch_id
+    batches_per_product = {}
+    for batch in new_batches:
+        batches_per_product[batch["product_id"]] = batches_per_product.get(batch["product_id"], 0) + 1
+    await add_to_rollups(db, rollup_rows(BATCHES_PRODUCED, production_date.date(), batches_per_product)
+                         + rollup_rows(INGREDIENT_CONSUMED, production_date.date(), required))
+    await db.commit()
+    count_on_dashboard("totalBatches", len(new_batches))
+    # one query reloads all the products into the index
+    await batch_index.load(db, product_ids)
+
+    return {
+        "batches": new_batches,
+        "ingredients": [
+            {"id": ingredient_id, "name": names[ingredient_id], "quantity": quantity}
+            for ingredient_id, quantity in required.items()
+        ]
+    }
+
+
+async def get_recipe_ingredients(db, recipe_ids):
+    """
+    Returns {recipe_id: {ingredient_id: (ingredient_name, quantity)}} for the given recipes in one query
+    """
+    result = await db.execute(
+        select(models.RecipeHasIngredient.Recipe_id,
+               models.RecipeHasIngredient.Ingredient_id,
+               models.Ingredient.name,
+               models.RecipeHasIngredient.quantity)
+        .join(models.Ingredient, models.Ingredient.id == models.RecipeHasIngredient.Ingredient_id)
+        .filter(models.RecipeHasIngredient.Recipe_id.in_(recipe_ids))
+    )
+    recipe_ingredients = {}
+    for recipe_id, ingredient_id, name, quantity in result:
+        recipe_ingredients.setdefault(recipe_id, {})[ingredient_id] = (name, int(quantity or 0))
+    return recipe_ingredients
+
+
+async def reserve_stock(db, required, names):
+    """
+    Locks the Current_Stock rows of the required ingredients and checks there is enough of each.
+    Rows are locked in id order so concurrent batches can not deadlock each other. Where the database has no
+    row locks the consumption is still guarded, record_movements(require_stock=True) refuses to overdraw.
+    """
+    locked = await db.execute(
+        select(models.CurrentStock.Ingredient_id, models.CurrentStock.current_quantity)
+        .filter(models.CurrentStock.Ingredient_id.in_(required.keys()))
+        .order_by(models.CurrentStock.Ingredient_id)
+        .with_for_update()
+    )
+    stock = {ingredient_id: int(quantity) for ingredient_id, quantity in locked}
+
+    for ingredient_id, quantity in required.items():
+        if stock.get(ingredient_id, 0) < quantity:
+            raise HTTPException(status_code=404,
+                                detail="Ingredients not sufficient to make the batch, name: " + names[ingredient_id])
+    return stock
@@ -1,24 +1,34 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+import asyncio
+from datetime import date, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import func
-from typing import Annotated
-from utils.database import SessionLocal
+from typing import Annotated, Optional
+from utils.analytics import METRICS, read_rollup, rebuild_rollups
+from utils.database import AsyncSessionLocal
+from utils.cache import dashboard_cache
+from utils.events import dashboard_events, delta_stream
+from utils.expiry import expired_batch_count
 import models.models
-from datetime import datetime
 
 # Create API router
 router = APIRouter()
 
+# one request reads the counts on a cache miss, the others wait for its result
+_dashboard_refresh = asyncio.Lock()
+
 # Dependency for database session
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.get("/dashboard")
@@ -34,40 +44,93 @@ async def get_dashboard_data(db: db_dependency):
     - Number of Locations
     - Number of Expired Batches
     """
+    return await dashboard_counts(db)
 
-    # 'Batch' count
-    total_batches = db.query(func.count(models.models.Batch.id)).scalar()
 
-    # 'Product' count
-    total_products = db.query(func.count(models.models.Product.id)).scalar()
+@router.get("/dashboard/stream", summary="Live dashboard counts as server-sent events")
+async def stream_dashboard():
+    """
+    Sends a snapshot event with the current counts, then a delta event for every committed write.
+    Listeners share the cached counts and the in-process event bus, a connection costs no queries of its own.
+    """
+    return StreamingResponse(delta_stream(dashboard_events, read_dashboard_snapshot),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    # 'Ingredient' count
-    total_ingredients = db.query(func.count(models.models.Ingredient.id)).scalar()
 
-    # 'GRN' count
-    total_grns = db.query(func.count(models.models.GRN.id)).scalar()
+@router.get("/dashboard/cache_stats")
+async def get_dashboard_cache_stats():
+    return {**dashboard_cache.stats(), "streamListeners": dashboard_events.subscriber_count}
 
-    # 'Order' count
-    total_orders = db.query(func.count(models.models.Order.id)).scalar()
 
-    # 'User' count
-    total_users = db.query(func.count(models.models.User.id)).scalar()
+async def dashboard_counts(db):
+    """
+    The dashboard counts from the cache, or read in one round trip and cached
+    """
+    data = dashboard_cache.get("dashboard")
+    if data is not None:
+        return data
+    async with _dashboard_refresh:
+        data = dashboard_cache.get("dashboard")
+        if data is not None:
+            return data
+        # all the counts in one round trip
+        row = (await db.execute(select(
+            count_rows(models.models.Batch).label("totalBatches"),
+            count_rows(models.models.Product).label("totalProducts"),
+            count_rows(models.models.Ingredient).label("totalIngredients"),
+            count_rows(models.models.GRN).label("totalGRNs"),
+            count_rows(models.models.Order).label("totalOrders"),
+            count_rows(models.models.User).label("totalUsers"),
+            count_rows(models.models.Location).label("totalLocations"),
+            # maintained by the expiry sweeper
+            expired_batch_count().label("expiredBatches"),
+        ))).one()
+        data = {key: value or 0 for key, value in row._mapping.items()}
+        dashboard_cache.set("dashboard", data)
+    return data
+
 
-    # 'Location' count
-    total_locations = db.query(func.count(models.models.Location.id)).scalar()
+async def read_dashboard_snapshot():
+    async with AsyncSessionLocal() as db:
+        return await dashboard_counts(db)
 
-    # 'Expired Batch' count
-    expired_batches = db.query(func.count(models.models.Batch.id)).filter(
-        models.models.Batch.dateOfExpiry < datetime.utcnow()
-    ).scalar()
+
+@router.get("/dashboard/analytics/{metric}", summary="Time series of a pre-aggregated dashboard metric")
+async def get_dashboard_analytics(db: db_dependency,
+                                  metric: str,
+                                  date_from: Optional[date] = None,
+                                  date_to: Optional[date] = None,
+                                  bucket: str = Query("day", pattern="^(day|week|month)$"),
+                                  key_id: Optional[int] = None):
+    """
+    Reads only the Daily_Rollup rows, the last 30 days by default.
+    - batches_produced, orders_placed, ordered_quantity: key_id is the product
+    - ingredient_consumed, grn_quantity: key_id is the ingredient
+    - grns_issued: key_id is always 0
+    """
+    if metric not in METRICS:
+        raise HTTPException(status_code=404, detail="Unknown metric, one of: " + ", ".join(METRICS))
+    date_to = date_to or date.today()
+    date_from = date_from or date_to - timedelta(days=30)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from is after date_to")
 
     return {
-        "totalBatches": total_batches or 0,
-        "totalProducts": total_products or 0,
-        "totalIngredients": total_ingredients or 0,
-        "totalGRNs": total_grns or 0,
-        "totalOrders": total_orders or 0,
-        "totalUsers": total_users or 0,
-        "totalLocations": total_locations or 0,
-        "expiredBatches": expired_batches or 0,
-    }
\ No newline at end of file
+        "metric": metric,
+        "bucket": bucket,
+        "date_from": date_from,
+        "date_to": date_to,
+        "series": await read_rollup(db, metric, date_from, date_to, bucket, key_id),
+    }
+
+
+@router.post("/dashboard/analytics/rebuild", summary="Recompute the dashboard rollups from the raw tables")
+async def rebuild_dashboard_analytics(db: db_dependency):
+    await rebuild_rollups(db)
+    await db.commit()
+    return {"rows": (await db.execute(select(func.count()).select_from(models.models.DailyRollup))).scalar()}
+
+
+def count_rows(model):
+    return select(func.count(model.id)).scalar_subquery()
@@ -1,12 +1,23 @@
-from datetime import datetime
-
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+import csv
+import io
+from datetime import datetime, time
+from itertools import islice
+
+from fastapi import APIRouter, Depends, HTTPException, Query, File, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, insert, update, delete, case
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import ValidationError
 from typing import Annotated, Optional, List
 
 from models import models
 from classes.classes import GRNResponse, BaseGRN, IngredientInfo, GRNUpdate
-from utils.database import SessionLocal
+from utils.analytics import GRNS_ISSUED, GRN_QUANTITY, add_to_rollups, rollup_rows
+from utils.cache import count_on_dashboard
+from utils.database import AsyncSessionLocal
+from utils.pagination import MAX_PAGE_SIZE, encode_cursor, keyset_after
+from utils.stock import GRN_RECEIPT, add_grn_lines, movement_rows, record_movements
 
 import logging
 
@@ -19,17 +30,21 @@ logger.addHandler(console_handler)
 
 router = APIRouter()
 
+# rows read, validated and written per round of bulk statements in /grn/import
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_REPORTED_ERRORS = 1000
+
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Dependency annotation
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 # need create, read, update, delete
@@ -37,42 +52,42 @@ db_dependency = Annotated[Session, Depends(get_db)]
 # create - needs to update Ingredients with new tuple if not existing or update quantity of existing and GRN_has_ingredient
 @router.post("/grn/add", response_model=GRNResponse)
 async def create_GRN(grn_data: BaseGRN, db: db_dependency):
-    # create new GRN tuple
+    # resolve all the ingredient names with one query
+    names = {ingredient_data.name for ingredient_data in grn_data.ingredients}
+    ingredient_ids = dict((await db.execute(
+        select(models.Ingredient.name, models.Ingredient.id).filter(models.Ingredient.name.in_(names))
+    )).all())
+    # if ingredient tuple does not exist, return error
+    missing = names - ingredient_ids.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail="Ingredient not found: " + ", ".join(sorted(missing)))
+
+    # the same ingredient can appear on more than one line of the note
+    quantities = {}
+    for ingredient_data in grn_data.ingredients:
+        ingredient_id = ingredient_ids[ingredient_data.name]
+        quantities[ingredient_id] = quantities.get(ingredient_id, 0) + ingredient_data.quantity
+
+    # create new GRN tuple, flushed to get its id
     new_GRN = models.GRN(issuedDate=datetime.now())
     db.add(new_GRN)
-    # iterate through the ingredients
-    for ingredient_data in grn_data.ingredients:
-        # update Ingredient with ingredient quantity
-        ingredient = db.query(models.Ingredient).filter(models.Ingredient.name == ingredient_data.name).first()
-        # if ingredient tuple does not exist, return error
-        if not ingredient:
-            raise HTTPException(status_code=404, detail="Ingredient not found")
-        else:
-            db.add(ingredient)
-            db.commit()
-            db.refresh(ingredient)
-
-            # update GRN_has_Ingredient
-            GRN_ingredient = models.GRN_has_Ingredient(
-                GRN_id=new_GRN.id,
-                Ingredient_id=ingredient.id,
-                currentQuantity=ingredient_data.quantity
-            )
-            db.add(GRN_ingredient)
-
-            # Optionally: Update the current stock of the ingredient
-            current_stock = ingredient.current_stock
-            if current_stock:
-                current_stock.current_quantity += ingredient_data.quantity
-            else:
-                # Create a new stock record if it doesn't exist
-                new_stock = models.CurrentStock(
-                    Ingredient_id=ingredient.id,
-                    current_quantity=ingredient_data.quantity
-                )
-                db.add(new_stock)
-            db.commit()
-            db.refresh(new_GRN)
+    await db.flush()
+
+    # GRN_has_Ingredient lines and the stock upsert go in as one statement each
+    if quantities:
+        await db.execute(insert(models.GRN_has_Ingredient), [
+            {"GRN_id": new_GRN.id, "Ingredient_id": ingredient_id, "currentQuantity": quantity}
+            for ingredient_id, quantity in quantities.items()
+        ])
+    await record_movements(db, movement_rows(GRN_RECEIPT, quantities, GRN_id=new_GRN.id,
+                                             effective_at=new_GRN.issuedDate))
+    issued_day = new_GRN.issuedDate.date()
+    await add_to_rollups(db, rollup_rows(GRNS_ISSUED, issued_day, {0: 1})
+                         + rollup_rows(GRN_QUANTITY, issued_day, quantities))
+
+    # nothing is written unless the whole GRN goes through
+    await db.commit()
+    count_on_dashboard("totalGRNs")
     return GRNResponse(
         id=new_GRN.id,
         issuedDate=new_GRN.issuedDate,
@@ -80,58 +95,196 @@ async def create_GRN(grn_data: BaseGRN, db: db_dependency):
     )
 
 
+# bulk import - delivery spreadsheets exported as CSV with the columns grn,name,quantity and optionally issuedDate.
+# rows with the same grn reference become one GRN, the first row of a GRN sets its issuedDate
+@router.post("/grn/import")
+async def import_grns(file: UploadFile = File(...)):
+    text = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(text)
+    fieldnames = await run_in_threadpool(lambda: reader.fieldnames)
+    missing_columns = {"grn", "name", "quantity"} - set(fieldnames or [])
+    if missing_columns:
+        raise HTTPException(status_code=400, detail="Missing CSV columns: " + ", ".join(sorted(missing_columns)))
+
+    report = {"rows": 0, "imported": 0, "grns": 0, "errorCount": 0, "errors": []}
+    grn_ids = {}  # grn reference -> GRN.id, across chunks
+    grn_issued = {}  # GRN.id -> when it was issued, for the ledger and the rollups
+    ingredient_ids = {}  # ingredient name -> Ingredient.id, across chunks
+
+    def add_error(row_number, error):
+        report["errorCount"] += 1
+        if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+            report["errors"].append({"row": row_number, "error": error})
+
+    # the file is read, validated and written one chunk of rows at a time and committed once at the end,
+    # a failure part way leaves nothing of it imported
+    async with AsyncSessionLocal() as db:
+        while True:
+            chunk = await run_in_threadpool(lambda: list(islice(reader, IMPORT_CHUNK_SIZE)))
+            if not chunk:
+                break
+
+            valid_rows = []
+            for row in chunk:
+                report["rows"] += 1
+                # header is row 1
+                row_number = report["rows"] + 1
+                try:
+                    line = IngredientInfo(name=(row["name"] or "").strip(), quantity=row["quantity"])
+                    reference = (row["grn"] or "").strip()
+                    if not reference:
+                        raise ValueError("grn reference is empty")
+                    issued_date = datetime.fromisoformat(row["issuedDate"]) if row.get("issuedDate") else None
+                except ValidationError as error:
+                    add_error(row_number, "; ".join(f"{item['loc'][0]}: {item['msg']}" for item in error.errors()))
+                    continue
+                except ValueError as error:
+                    add_error(row_number, str(error))
+                    continue
+                valid_rows.append((row_number, reference, issued_date, line))
+
+            # resolve the names this chunk has not seen yet in one query
+            new_names = {line.name for _, _, _, line in valid_rows} - ingredient_ids.keys()
+            if new_names:
+                ingredient_ids.update((await db.execute(
+                    select(models.Ingredient.name, models.Ingredient.id).filter(models.Ingredient.name.in_(new_names))
+                )).all())
+
+            new_grns = {}
+            for _, reference, issued_date, line in valid_rows:
+                if reference not in grn_ids and reference not in new_grns and line.name in ingredient_ids:
+                    new_grns[reference] = models.GRN(issuedDate=issued_date or datetime.now())
+            if new_grns:
+                db.add_all(new_grns.values())
+                await db.flush()
+                grn_ids.update((reference, grn.id) for reference, grn in new_grns.items())
+                grn_issued.update((grn.id, grn.issuedDate) for grn in new_grns.values())
+                report["grns"] += len(new_grns)
+
+            lines = {}
+            for row_number, reference, issued_date, line in valid_rows:
+                if line.name not in ingredient_ids:
+                    add_error(row_number, "Ingredient not found: " + line.name)
+                    continue
+                grn_id = grn_ids[reference]
+                if issued_date and issued_date != grn_issued[grn_id]:
+                    add_error(row_number, f"issuedDate {issued_date.isoformat()} conflicts with "
+                                          f"{grn_issued[grn_id].isoformat()} of the earlier rows of grn {reference}")
+                    continue
+                ingredient_id = ingredient_ids[line.name]
+                key = (grn_id, ingredient_id)
+                lines[key] = lines.get(key, 0) + line.quantity
+                report["imported"] += 1
+
+            await add_grn_lines(db, lines)
+            await record_movements(db, [
+                row
+                for (grn_id, ingredient_id), quantity in lines.items()
+                for row in movement_rows(GRN_RECEIPT, {ingredient_id: quantity}, GRN_id=grn_id, note="CSV import",
+                                         effective_at=grn_issued[grn_id])
+            ])
+            await add_to_rollups(db, [
+                row
+                for grn in new_grns.values()
+                for row in rollup_rows(GRNS_ISSUED, grn_issued[grn.id].date(), {0: 1})
+            ] + [
+                row
+                for (grn_id, ingredient_id), quantity in lines.items()
+                for row in rollup_rows(GRN_QUANTITY, grn_issued[grn_id].date(), {ingredient_id: quantity})
+            ])
+            # the transaction spans the file, the session does not need to hold on to its GRNs
+            db.expunge_all()
+
+        await db.commit()
+    count_on_dashboard("totalGRNs", report["grns"])
+
+    return report
+
+
 # read - should get all ingredients involved with GRN
 @router.get("/grn/view_all", response_model=List[GRNResponse])
-async def view_all_grns(db: db_dependency):
-    # get all grns
-    grns = db.query(models.GRN).all()
-
-    all_grns = []
-    for grn in grns:
-        # Get the ingredients associated with the grn
-        grn_ingredients = db.query(models.GRN_has_Ingredient).filter(
-            models.GRN_has_Ingredient.GRN_id == grn.id
-        ).all()
-
-        # Get ingredient info associated with the grn
-        ingredients = []
-        for grn_ingredient in grn_ingredients:
-            ingredient = db.query(models.Ingredient).filter(
-                models.Ingredient.id == grn_ingredient.Ingredient_id
-            ).first()
-            if ingredient:
-                ingredients.append(
-                    IngredientInfo(name=ingredient.name, quantity=grn_ingredient.currentQuantity)
-                )
-
-        # Append GRN details to the list
-        all_grns.append(
-            GRNResponse(
-                id=grn.id,
-                issuedDate=grn.issuedDate,
-                ingredients=ingredients
-            )
-        )
-
-    return all_grns
+async def view_all_grns(db: db_dependency,
+                        date_from: Optional[datetime] = None,
+                        date_to: Optional[datetime] = None,
+                        cursor: Optional[str] = None,
+                        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    Streams the GRNs ordered by (issuedDate, id) as a chunked JSON array.
+    Without a limit every matching GRN is streamed, with a limit the cursor for the next page is sent in the
+    X-Next-Cursor header.
+    """
+    grn_filters = []
+    if date_from:
+        grn_filters.append(models.GRN.issuedDate >= date_from)
+    if date_to:
+        grn_filters.append(models.GRN.issuedDate <= date_to)
+    if cursor:
+        grn_filters.append(keyset_after(models.GRN.issuedDate, models.GRN.id, cursor, descending=False))
+
+    headers = {}
+    if limit:
+        # pick the page of GRN ids first so the page size is in GRNs, not ingredient lines
+        page = (await db.execute(
+            select(models.GRN.id, models.GRN.issuedDate)
+            .filter(*grn_filters)
+            .order_by(models.GRN.issuedDate, models.GRN.id)
+            .limit(limit + 1)
+        )).all()
+        if len(page) > limit:
+            headers["X-Next-Cursor"] = encode_cursor(page[limit - 1].issuedDate, page[limit - 1].id)
+        grn_filters = [models.GRN.id.in_([row.id for row in page[:limit]])]
+
+    return StreamingResponse(stream_grns(grn_filters), media_type="application/json", headers=headers)
+
+
+async def stream_grns(grn_filters):
+    """
+    One joined query read through a server side cursor, rows come ordered by GRN so each GRN is written out as
+    soon as its last line is read
+    """
+    query = (select(models.GRN.id,
+                    models.GRN.issuedDate,
+                    models.Ingredient.name,
+                    models.GRN_has_Ingredient.currentQuantity)
+             .join(models.GRN_has_Ingredient, models.GRN_has_Ingredient.GRN_id == models.GRN.id, isouter=True)
+             .join(models.Ingredient, models.Ingredient.id == models.GRN_has_Ingredient.Ingredient_id, isouter=True)
+             .filter(*grn_filters)
+             .order_by(models.GRN.issuedDate, models.GRN.id))
+
+    # the response outlives the request dependencies, so the stream has its own session
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query)
+        yield "["
+        separator = ""
+        current = None
+        async for grn_id, issued_date, ingredient_name, quantity in result:
+            if current is None or current.id != grn_id:
+                if current is not None:
+                    yield separator + current.model_dump_json()
+                    separator = ","
+                current = GRNResponse(id=grn_id, issuedDate=issued_date, ingredients=[])
+            if ingredient_name is not None:
+                current.ingredients.append(IngredientInfo(name=ingredient_name, quantity=quantity))
+        if current is not None:
+            yield separator + current.model_dump_json()
+        yield "]"
 
 
 # view specific GRN
 @router.get("/grn/view/{grn_id}", response_model=GRNResponse)
 async def view_grn(grn_id: int, db: db_dependency):
     # get grn
-    grn = db.query(models.GRN).filter(models.GRN.id == grn_id).first()
+    grn = (await db.execute(select(models.GRN).filter(models.GRN.id == grn_id))).scalars().first()
     if not grn:
         raise HTTPException(status_code=404, detail="GRN not found")
 
     # get ingredients and quantities for the grn
-    ingredients_data = (
-        db.query(models.Ingredient.name, models.GRN_has_Ingredient.currentQuantity)
+    ingredients_data = (await db.execute(
+        select(models.Ingredient.name, models.GRN_has_Ingredient.currentQuantity)
         .join(models.GRN_has_Ingredient, models.GRN_has_Ingredient.Ingredient_id == models.Ingredient.id)
         .join(models.GRN, models.GRN.id == models.GRN_has_Ingredient.GRN_id)
         .filter(models.GRN_has_Ingredient.GRN_id == grn_id)
-        .all()
-    )
+    )).all()
 
     ingredients = [
         IngredientInfo(name=ingredient_name, quantity=quantity)
@@ -150,81 +303,95 @@ async def view_grn(grn_id: int, db: db_dependency):
 @router.put("/grn/update/{grn_id}", response_model=GRNResponse)
 async def update_grn(grn_id: int, grn_data: GRNUpdate, db: db_dependency):
 
-    grn = db.query(models.GRN).filter(models.GRN.id == grn_id).first()
+    # the GRN row stays locked until commit, so concurrent updates of it diff one after the other
+    grn = (await db.execute(
+        select(models.GRN).filter(models.GRN.id == grn_id).with_for_update()
+    )).scalars().first()
     if not grn:
         raise HTTPException(status_code=404, detail="GRN not found")
 
-    grn_ingredient_records = db.query(models.GRN_has_Ingredient).filter(
-        models.GRN_has_Ingredient.GRN_id == grn_id
-    ).all()
-
-    grn_ingredient_map = {record.Ingredient_id: record for record in grn_ingredient_records}
-
-    updated_ingredient_names = {ingredient.name for ingredient in grn_data.ingredients}
-
-    ingredient_map = {}
-    for new_ingredient in grn_data.ingredients:
-        ingredient = db.query(models.Ingredient).filter(models.Ingredient.name == new_ingredient.name).first()
-        if not ingredient:
-            raise HTTPException(status_code=404, detail=f"Ingredient '{new_ingredient.name}' not found")
-        ingredient_map[ingredient.id] = new_ingredient
-
-    for grn_ingredient in grn_ingredient_records:
-        if grn_ingredient.Ingredient_id not in ingredient_map:
-            # Missing ingredient
-            stock = db.query(models.CurrentStock).filter(
-                models.CurrentStock.Ingredient_id == grn_ingredient.Ingredient_id
-            ).first()
-            if stock:
-                stock.current_quantity -= grn_ingredient.currentQuantity
-                db.add(stock)
-            db.delete(grn_ingredient)
-
-    for ingredient_id, new_ingredient_data in ingredient_map.items():
-        if ingredient_id not in grn_ingredient_map:
-            # New ingredient
-            stock = db.query(models.CurrentStock).filter(
-                models.CurrentStock.Ingredient_id == ingredient_id
-            ).first()
-            if not stock:
-                raise HTTPException(status_code=404, detail=f"Stock record for ingredient ID '{ingredient_id}' not found")
-            stock.current_quantity += new_ingredient_data.quantity
-            db.add(stock)
-
-            ingredient_id = int(ingredient.id)
-
-            new_grn_ingredient = models.GRN_has_Ingredient(
-                GRN_id=grn_id,
-                Ingredient_id=ingredient_id,
-                currentQuantity=new_ingredient_data.quantity
+    old_day = grn.issuedDate.date()
+    new_day = grn_data.issuedDate or old_day
+    old_quantities = new_quantities = stock_changes = {}
+    if grn_data.ingredients is not None or new_day != old_day:
+        old_quantities = new_quantities = dict((await db.execute(
+            select(models.GRN_has_Ingredient.Ingredient_id, models.GRN_has_Ingredient.currentQuantity)
+            .filter(models.GRN_has_Ingredient.GRN_id == grn_id)
+        )).all())
+
+    if grn_data.ingredients is not None:
+
+        names = {ingredient.name for ingredient in grn_data.ingredients}
+        ingredient_ids = dict((await db.execute(
+            select(models.Ingredient.name, models.Ingredient.id).filter(models.Ingredient.name.in_(names))
+        )).all())
+        missing = names - ingredient_ids.keys()
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Ingredient '{sorted(missing)[0]}' not found")
+
+        new_quantities = {}
+        for new_ingredient in grn_data.ingredients:
+            ingredient_id = ingredient_ids[new_ingredient.name]
+            new_quantities[ingredient_id] = new_quantities.get(ingredient_id, 0) + new_ingredient.quantity
+
+        # diff of the old and new lines, worked out in memory
+        removed = old_quantities.keys() - new_quantities.keys()
+        added = new_quantities.keys() - old_quantities.keys()
+        changed = {ingredient_id: quantity for ingredient_id, quantity in new_quantities.items()
+                   if ingredient_id in old_quantities and old_quantities[ingredient_id] != quantity}
+
+        stock_changes = {ingredient_id: -old_quantities[ingredient_id] for ingredient_id in removed}
+        stock_changes.update({ingredient_id: new_quantities[ingredient_id] for ingredient_id in added})
+        stock_changes.update({ingredient_id: quantity - old_quantities[ingredient_id]
+                              for ingredient_id, quantity in changed.items()})
+
+        # a fixed number of statements however many lines the GRN has
+        if removed:
+            await db.execute(
+                delete(models.GRN_has_Ingredient)
+                .where(models.GRN_has_Ingredient.GRN_id == grn_id,
+                       models.GRN_has_Ingredient.Ingredient_id.in_(removed))
+            )
+        if added:
+            await db.execute(insert(models.GRN_has_Ingredient), [
+                {"GRN_id": grn_id, "Ingredient_id": ingredient_id, "currentQuantity": new_quantities[ingredient_id]}
+                for ingredient_id in added
+            ])
+        if changed:
+            await db.execute(
+                update(models.GRN_has_Ingredient)
+                .where(models.GRN_has_Ingredient.GRN_id == grn_id,
+                       models.GRN_has_Ingredient.Ingredient_id.in_(changed.keys()))
+                .values(currentQuantity=case(changed, value=models.GRN_has_Ingredient.Ingredient_id))
+                .execution_options(synchronize_session=False)
             )
-            db.add(new_grn_ingredient)
-
-    db.commit()
-
-    for ingredient_id, grn_ingredient in grn_ingredient_map.items():
-        if ingredient_id in ingredient_map:
-            new_quantity = ingredient_map[ingredient_id].quantity
-            old_quantity = grn_ingredient.currentQuantity
-
-            if new_quantity != old_quantity:
-                difference = new_quantity - old_quantity
-                stock = db.query(models.CurrentStock).filter(
-                    models.CurrentStock.Ingredient_id == ingredient_id
-                ).first()
-                if stock:
-                    stock.current_quantity += difference
-                    db.add(stock)
-
-                grn_ingredient.currentQuantity = new_quantity
-                db.add(grn_ingredient)
 
-    db.commit()
+    if new_day != old_day:
+        # the ledger is append-only: the receipt is taken back on the old date and made again on the new one
+        await record_movements(db, movement_rows(
+            GRN_RECEIPT, {ingredient_id: -quantity for ingredient_id, quantity in old_quantities.items()},
+            GRN_id=grn_id, note="GRN date change", effective_at=grn.issuedDate
+        ) + movement_rows(
+            GRN_RECEIPT, new_quantities, GRN_id=grn_id, note="GRN date change",
+            effective_at=datetime.combine(new_day, time())
+        ))
+    else:
+        await record_movements(db, movement_rows(GRN_RECEIPT, stock_changes, GRN_id=grn_id, note="GRN update",
+                                                 effective_at=grn.issuedDate))
 
     if grn_data.issuedDate:
         grn.issuedDate = grn_data.issuedDate
         db.add(grn)
-        db.commit()
+
+    # the GRN leaves the rollups of its old day and is counted again on its new one, equal amounts cancel out
+    await add_to_rollups(db, rollup_rows(GRNS_ISSUED, old_day, {0: -1})
+                         + rollup_rows(GRN_QUANTITY, old_day, {ingredient_id: -quantity
+                                                               for ingredient_id, quantity in old_quantities.items()})
+                         + rollup_rows(GRNS_ISSUED, new_day, {0: 1})
+                         + rollup_rows(GRN_QUANTITY, new_day, new_quantities))
+
+    # lines, stock, date and rollups are committed together
+    await db.commit()
     return await view_grn(grn_id, db)
 
 
@@ -1,45 +1,82 @@
+import asyncio
+
 from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.params import Query
-from sqlalchemy import Integer
+from sqlalchemy import Integer, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql.functions import coalesce
 from starlette import status
 
 import models.models
 from classes.classes import BaseRecipe, BaseIngredient, BaseRecipeCreate, UpdateBaseIngredient
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import func, cast
-from typing import Annotated, List
+from typing import Annotated, List, Optional
 
-from utils.database import SessionLocal
+from utils.database import AsyncSessionLocal
+from utils.cache import count_on_dashboard, forget_recipes, ingredients_changed, stock_cache
+from utils.events import delta_stream, stock_events
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from utils.search import ingredient_search
+from utils.autocomplete import autocomplete
 
 router = APIRouter()
+# one stream listener reads the ingredient rows on a cache miss, the others wait for its result
+_ingredient_refresh = asyncio.Lock()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # annotation for dependency injection
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.get("/ingredient/all")
 async def getAllIngredient(db: db_dependency):
-
-    second_result = (db
-                     .query(models.models.Ingredient.id,
-                            models.models.Ingredient.name,
-                            models.models.Ingredient.description,
-                            models.models.CurrentStock.current_quantity)
-                     .join(models.models.CurrentStock,
-                           models.models.CurrentStock.Ingredient_id == models.models.Ingredient.id,
-                           isouter=True)
-                     .all())
+    return await ingredient_rows(db)
+
+
+@router.get("/ingredient/stream", summary="Live ingredient stock as server-sent events")
+async def stream_ingredients():
+    """
+    Sends a snapshot event with the rows of /ingredient/all, then a delta event {ingredient_id: quantity} for
+    every committed stock movement: GRNs, batches and adjustments. Orders take finished batches, not ingredients,
+    so they do not show here. Listeners share the cached rows and the in-process event bus.
+    """
+    return StreamingResponse(delta_stream(stock_events, read_ingredient_snapshot),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def read_ingredient_snapshot():
+    rows = stock_cache.get("ingredients")
+    if rows is None:
+        async with _ingredient_refresh:
+            rows = stock_cache.get("ingredients")
+            if rows is None:
+                async with AsyncSessionLocal() as db:
+                    rows = {row["id"]: row for row in await ingredient_rows(db)}
+                stock_cache.set("ingredients", rows)
+    return list(rows.values())
+
+
+async def ingredient_rows(db):
+    second_result = (await db.execute(
+        select(models.models.Ingredient.id,
+               models.models.Ingredient.name,
+               models.models.Ingredient.description,
+               models.models.CurrentStock.current_quantity)
+        .join(models.models.CurrentStock,
+              models.models.CurrentStock.Ingredient_id == models.models.Ingredient.id,
+              isouter=True)
+    )).all()
 
     ingredients = [
         {
@@ -53,34 +90,54 @@ async def getAllIngredient(db: db_dependency):
     return ingredients
 
 
+@router.get("/ingredient/search_by_name/{ingredient_name}")
+async def search_ingredient_by_name(ingredient_name: str, db: db_dependency,
+                                    cursor: Optional[str] = None,
+                                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return await ingredient_search.search(db, ingredient_name, cursor, limit)
+
+
 @router.put("/ingredient/edit")
 async def updateIngredient(db: db_dependency, updateBaseIngredient: UpdateBaseIngredient):
-    db_item = db.query(models.models.Ingredient).filter(models.models.Ingredient.id == updateBaseIngredient.id).first()
+    db_item = (await db.execute(
+        select(models.models.Ingredient).filter(models.models.Ingredient.id == updateBaseIngredient.id)
+    )).scalars().first()
 
     if not db_item:
         raise HTTPException(status_code=404, detail="Ingredient not found")
 
+    renamed = db_item.name != updateBaseIngredient.name
+
     # Update the item fields
     db_item.id = updateBaseIngredient.id
     db_item.name = updateBaseIngredient.name
     db_item.description = updateBaseIngredient.description
 
     # Commit the changes to the database
-    db.commit()
-    db.refresh(db_item)  # Optional: refresh instance with database values
+    await db.commit()
+    ingredients_changed()
+    if renamed:
+        ingredient_search.add(db_item.id, db_item.name)
+        autocomplete.add("ingredient", db_item.id, db_item.name)
+        # recipe documents carry the ingredient name, only the recipes using it are dropped
+        forget_recipes((await db.execute(
+            select(models.models.RecipeHasIngredient.Recipe_id)
+            .filter(models.models.RecipeHasIngredient.Ingredient_id == db_item.id)
+        )).scalars().all())
+    await db.refresh(db_item)  # Optional: refresh instance with database values
     print('record updated: ', db_item)
 
-    result = (db
-              .query(models.models.Ingredient.id,
-                     models.models.Ingredient.name,
-                     models.models.Ingredient.description,
-                     cast(func.sum(models.models.GRN_has_Ingredient.currentQuantity), Integer).label('totalQuantity'))
-              .join(models.models.GRN_has_Ingredient,
-                    models.models.Ingredient.id == models.models.GRN_has_Ingredient.Ingredient_id)
-              .group_by(models.models.Ingredient.id, models.models.Ingredient.name,
-                        models.models.Ingredient.description)
-              .filter(models.models.Ingredient.id == db_item.id)
-              .first())
+    result = (await db.execute(
+        select(models.models.Ingredient.id,
+               models.models.Ingredient.name,
+               models.models.Ingredient.description,
+               cast(func.sum(models.models.GRN_has_Ingredient.currentQuantity), Integer).label('totalQuantity'))
+        .join(models.models.GRN_has_Ingredient,
+              models.models.Ingredient.id == models.models.GRN_has_Ingredient.Ingredient_id)
+        .group_by(models.models.Ingredient.id, models.models.Ingredient.name,
+                  models.models.Ingredient.description)
+        .filter(models.models.Ingredient.id == db_item.id)
+    )).first()
 
     # convert to dictionary type
     if result:
@@ -96,10 +153,9 @@ async def updateIngredient(db: db_dependency, updateBaseIngredient: UpdateBaseIn
 
 @router.post("/ingredient/add")
 async def createIngredient(db: db_dependency, ingredient: BaseIngredient):
-    existing_ingredient = (db
-                           .query(models.models.Ingredient)
-                           .filter(models.models.Ingredient.name == ingredient.name)
-                           .first())
+    existing_ingredient = (await db.execute(
+        select(models.models.Ingredient).filter(models.models.Ingredient.name == ingredient.name)
+    )).scalars().first()
     if existing_ingredient:
         return JSONResponse(
             status_code=409,
@@ -110,22 +166,26 @@ async def createIngredient(db: db_dependency, ingredient: BaseIngredient):
 
     db_ingredient = models.models.Ingredient(**ingredient.dict())
     db.add(db_ingredient)
-    db.commit()
-    db.refresh(db_ingredient)
+    await db.commit()
+    await db.refresh(db_ingredient)
+    count_on_dashboard("totalIngredients")
+    ingredient_search.add(db_ingredient.id, db_ingredient.name)
+    autocomplete.add("ingredient", db_ingredient.id, db_ingredient.name)
+    ingredients_changed()
     print('item created: ', db_ingredient.id)
-    result = (db
-              .query(models.models.Ingredient.id,
-                     models.models.Ingredient.name,
-                     models.models.Ingredient.description,
-                     cast(func.sum(coalesce(models.models.GRN_has_Ingredient.currentQuantity, 0)), Integer).label(
-                         'totalQuantity'))
-              .join(models.models.GRN_has_Ingredient,
-                    models.models.Ingredient.id == models.models.GRN_has_Ingredient.Ingredient_id,
-                    isouter=True)
-              .group_by(models.models.Ingredient.id, models.models.Ingredient.name,
-                        models.models.Ingredient.description)
-              .filter(models.models.Ingredient.id == db_ingredient.id)
-              .first())
+    result = (await db.execute(
+        select(models.models.Ingredient.id,
+               models.models.Ingredient.name,
+               models.models.Ingredient.description,
+               cast(func.sum(coalesce(models.models.GRN_has_Ingredient.currentQuantity, 0)), Integer).label(
+                   'totalQuantity'))
+        .join(models.models.GRN_has_Ingredient,
+              models.models.Ingredient.id == models.models.GRN_has_Ingredient.Ingredient_id,
+              isouter=True)
+        .group_by(models.models.Ingredient.id, models.models.Ingredient.name,
+                  models.models.Ingredient.description)
+        .filter(models.models.Ingredient.id == db_ingredient.id)
+    )).first()
 
     # convert to dictionary type
     if result:
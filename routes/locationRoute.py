@@ -1,5 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 from typing import Annotated, List
 
 from starlette import status
@@ -10,32 +12,34 @@ from fastapi import HTTPException
 
 
 from models import models  # Assuming Location model is defined here
-from utils.database import SessionLocal  # Database session dependency
+from utils.database import AsyncSessionLocal  # Database session dependency
+from utils.cache import count_on_dashboard
+from utils.autocomplete import autocomplete
 
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Dependency annotation for session
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.get("/location/list", response_model=List[LocationResponse])
 async def get_all_locations(db: db_dependency):
-    locations = db.query(models.Location).all()
+    locations = (await db.execute(select(models.Location))).scalars().all()
     return locations
 
 
 @router.get("/location/{id}", response_model=LocationResponse)
 async def get_location_by_id(id: int, db: db_dependency):
-    location = db.query(models.Location).filter(models.Location.id == id).first()
+    location = (await db.execute(select(models.Location).filter(models.Location.id == id))).scalars().first()
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
     return location
@@ -43,97 +47,119 @@ async def get_location_by_id(id: int, db: db_dependency):
 
 @router.get("/location/user/{user_id}", summary="filter assigned Locations based on given user")
 async def get_locations_by_user(db: db_dependency, user_id: int):
-    user = db.query(models.Location).filter(models.Location.id == user_id).first()
+    user = (await db.execute(select(models.Location).filter(models.Location.id == user_id))).scalars().first()
     if user is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found!")
 
     # Get users assigned to location
-    return db.query(models.Location).join(models.Location.users).filter(models.User.id == user_id).all()
+    result = await db.execute(select(models.Location).join(models.Location.users).filter(models.User.id == user_id))
+    return result.scalars().all()
 
 
 @router.get("/location/users/all", summary='Get all locations with assigned users')
 async def get_all_locations_with_users(db: db_dependency):
-    return db.query(models.Location).options(joinedload(models.Location.users)).all()
+    result = await db.execute(select(models.Location).options(joinedload(models.Location.users)))
+    return result.unique().scalars().all()
 
 
 @router.post("/location/add", response_model=LocationResponse)
 async def add_location(db: db_dependency, location_data: LocationCreate):
     new_location = models.Location(**location_data.dict())
     db.add(new_location)
-    db.commit()
-    db.refresh(new_location)
+    await db.commit()
+    await db.refresh(new_location)
+    count_on_dashboard("totalLocations")
+    autocomplete.add("location", new_location.id, new_location.name)
     return new_location
 
 
 @router.put("/location/update/{id}", response_model=LocationResponse)
 async def update_location(id: int, db: db_dependency, location_data: LocationUpdate):
-    location = db.query(models.Location).filter(models.Location.id == id).first()
+    location = (await db.execute(select(models.Location).filter(models.Location.id == id))).scalars().first()
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
 
     for key, value in location_data.dict().items():
         setattr(location, key, value)
 
-    db.commit()
-    db.refresh(location)
+    await db.commit()
+    await db.refresh(location)
+    autocomplete.add("location", location.id, location.name)
     return location
 
 
 @router.delete("/location/delete/{id}")
 async def delete_location(id: int, db: db_dependency):
-    location = db.query(models.Location).filter(models.Location.id == id).first()
+    location = (await db.execute(select(models.Location).filter(models.Location.id == id))).scalars().first()
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
 
-    db.delete(location)
-    db.commit()
+    await db.delete(location)
+    await db.commit()
+    count_on_dashboard("totalLocations", -1)
+    autocomplete.remove("location", id)
     return {"message": "Location deleted successfully"}
 
 
 @router.delete("/location/remove_user/{user_id}/{location_id}", summary="remove user from a locationr")
 async def remove_user_from_location(db: db_dependency, user_id: int, location_id: int):
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = (await db.execute(select(models.User).filter(models.User.id == user_id))).scalars().first()
     if user is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found!")
 
-    location = db.query(models.Location).filter(models.Location.id == location_id).first()
+    location = (await db.execute(
+        select(models.Location)
+        .options(selectinload(models.Location.users))
+        .filter(models.Location.id == location_id)
+    )).scalars().first()
     if location is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Location not found!")
 
     location.users.remove(user)
     # Get users assigned to location
     db.add(location)
-    db.commit()
+    await db.commit()
+    # unload the users collection so the response does not nest users -> locations -> users
+    db.expire(location)
 
-    return (db.query(models.User)
-            .join(models.User.locations)  # Join the locations relationship
-            .filter(models.Location.id == location_id)  # Eager load locations if needed
-            .all())
+    return (await db.execute(
+        select(models.User)
+        .join(models.User.locations)  # Join the locations relationship
+        .filter(models.Location.id == location_id)  # Eager load locations if needed
+    )).scalars().all()
 
 
 @router.put("/location/assign_user/{user_id}/{location_id}", summary="Assign location to a user")
 async def assign_user_to_location(db: db_dependency, user_id: int, location_id: int):
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = (await db.execute(select(models.User).filter(models.User.id == user_id))).scalars().first()
     if user is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found!")
 
-    location = db.query(models.Location).filter(models.Location.id == location_id).first()
+    location = (await db.execute(
+        select(models.Location)
+        .options(selectinload(models.Location.users))
+        .filter(models.Location.id == location_id)
+    )).scalars().first()
     if location is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Location not found!")
 
     location.users.append(user)
     db.add(location)
-    db.commit()
-    return (db.query(models.User)
-            .join(models.User.locations)  # Join the locations relationship
-            .filter(models.Location.id == location_id)  # Eager load locations if needed
-            .all())
+    await db.commit()
+    # unload the users collection so the response does not nest users -> locations -> users
+    db.expire(location)
+    return (await db.execute(
+        select(models.User)
+        .join(models.User.locations)  # Join the locations relationship
+        .filter(models.Location.id == location_id)  # Eager load locations if needed
+    )).scalars().all()
 
 
 async def get_location_with_assigned_users(db, location_id: int):
-    return (db.query(models.Location)
-            .options(joinedload(models.Location.users))
-            .filter(models.Location.id == location_id)  # Join the locations relationship
-            .first())
\ No newline at end of file
+    return (await db.execute(
+        select(models.Location)
+        .options(joinedload(models.Location.users))
+        .filter(models.Location.id == location_id)  # Join the locations relationship
+    )).unique().scalars().first()
\ No newline at end of file
@@ -1,11 +1,18 @@
 import logging
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
-from typing import Annotated
+from typing import Annotated, Optional
 from sqlalchemy import select, func
-from utils.database import SessionLocal
-from models.models import Order, Product, Batch
-from classes.classes import CreateOrder, UpdateOrder
+from utils.database import AsyncSessionLocal, insert_returning_ids
+from models.models import Order, OrderHasBatch, Product, Batch
+from classes.classes import CreateOrder, UpdateOrder, BaseOrderBulkCreate
+from utils.allocation import allocated, apply_allocations, lock_product_batches, record_allocations, take_batches
+from utils.batch_index import batch_index
+from utils.analytics import ORDERS_PLACED, ORDERED_QUANTITY, add_to_rollups, rollup_rows
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_id_cursor, id_after
+from utils.cache import count_on_dashboard
 
 
 # Configure logging
@@ -17,82 +24,178 @@ logger.addHandler(console_handler)
 
 router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Dependency annotation
-db_dependency = Annotated[SessionLocal, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 @router.get("/order/all")
-async def getAllOrders(db: db_dependency):
-    batch_name_subq = (
-        select(Batch.name)
-        .where(Batch.product_id == Order.Product_id)
-        .order_by(Batch.productionDate.asc())
-        .limit(1)
-        .scalar_subquery()
-    )
-
-    orders = (db.query(
-                Order.id,
-                Order.name,
-                Order.quantity,
-                batch_name_subq.label('batch_name')
-              )
-              .all())
-
-    results = []
-    for o in orders:
-        results.append({
-            "id": o[0],
-            "name": o[1],
-            "quantity": o[2],
-            "batch_name": o[3] if o[3] is not None else None
-        })
-    return results
+async def getAllOrders(db: db_dependency,
+                       cursor: Optional[str] = None,
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       product_id: Optional[int] = None,
+                       date_from: Optional[datetime] = None,
+                       date_to: Optional[datetime] = None):
+    """
+    Newest orders first, paginated on id, with the batches each order was taken from.
+    Orders placed before allocations were recorded have no batches.
+    """
+    page = (select(Order.id, Order.name, Order.quantity, Order.Product_id, Order.createdAt)
+            .order_by(Order.id.desc())
+            .limit(limit + 1))
+    if cursor:
+        page = page.filter(id_after(Order.id, cursor))
+    if product_id is not None:
+        page = page.filter(Order.Product_id == product_id)
+    if date_from:
+        page = page.filter(Order.createdAt >= date_from)
+    if date_to:
+        page = page.filter(Order.createdAt <= date_to)
+    page = page.subquery()
+
+    # the page and its allocations in one query, oldest batch of each order first
+    rows = (await db.execute(
+        select(page, OrderHasBatch.Batch_id, Batch.name.label("batch_name"), OrderHasBatch.quantity.label("taken"))
+        .outerjoin(OrderHasBatch, OrderHasBatch.Order_id == page.c.id)
+        .outerjoin(Batch, Batch.id == OrderHasBatch.Batch_id)
+        .order_by(page.c.id.desc(), Batch.productionDate, Batch.id)
+    )).all()
+
+    results = {}
+    for row in rows:
+        order = results.get(row.id)
+        if order is None:
+            order = results[row.id] = {
+                "id": row.id,
+                "name": row.name,
+                "quantity": row.quantity,
+                "product_id": row.Product_id,
+                "createdAt": row.createdAt,
+                "batch_name": row.batch_name,
+                "batches": [],
+            }
+        if row.Batch_id is not None:
+            order["batches"].append({"batch_id": row.Batch_id, "batch_name": row.batch_name, "quantity": row.taken})
+
+    # one extra order is fetched to know whether there is a next page
+    items = list(results.values())[:limit]
+    return {
+        "items": items,
+        "next_cursor": encode_id_cursor(items[-1]["id"]) if len(results) > limit else None,
+    }
 
 
 @router.post("/order/add")
 async def addOrder(db: db_dependency, createOrder: CreateOrder):
+    if createOrder.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Order quantity must be positive")
+
     # Check if product_id exists
-    product = db.query(Product).filter(Product.id == createOrder.Product_id).first()
+    product = (await db.execute(select(Product).filter(Product.id == createOrder.Product_id))).scalars().first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    # Find a batch that can fulfill the requested quantity
-    batch = (db.query(Batch)
-             .filter(Batch.product_id == createOrder.Product_id,
-                     Batch.availableQuantity >= createOrder.quantity)
-             .order_by(Batch.productionDate.asc())
-             .first()
-             )
-
-    if not batch:
-        raise HTTPException(status_code=409, detail="Not enough available quantity to fulfill the order")
-
-    remaining_quantity = batch.availableQuantity - createOrder.quantity
-    if remaining_quantity < 0:
-        raise HTTPException(status_code=409, detail="Fulfilling this order would leave no available quantity")
+    # the order is split over batches with stock in the order of the allocation strategy, picked from the batch index
+    # and locked until commit
+    async with allocated(db, createOrder.Product_id, createOrder.quantity) as allocations:
+        # Create the Order using the same field names
+        db_order = Order(**createOrder.dict(), createdAt=datetime.now())
+        db.add(db_order)
+        await db.flush()
 
-    # Create the Order using the same field names
-    db_order = Order(**createOrder.dict())
-    db.add(db_order)
+        # allocated took the quantities off the batches, record which batches the order came from
+        await record_allocations(db, {db_order.id: allocations})
 
-    # Update the batch available quantity
-    batch.availableQuantity = remaining_quantity
+        order_day = db_order.createdAt.date()
+        await add_to_rollups(db, rollup_rows(ORDERS_PLACED, order_day, {createOrder.Product_id: 1})
+                             + rollup_rows(ORDERED_QUANTITY, order_day,
+                                           {createOrder.Product_id: createOrder.quantity}))
 
-    db.commit()
-    db.refresh(db_order)
+        await db.commit()
+    count_on_dashboard("totalOrders")
 
     return {
         "id": db_order.id,
         "name": db_order.name,
         "quantity": db_order.quantity,
         "product_id": db_order.Product_id,
-        "batch_name": batch.name
-    }
\ No newline at end of file
+        # the first batch the order was taken from
+        "batch_name": allocations[0][1],
+        "batches": [
+            {"batch_id": batch_id, "batch_name": batch_name, "quantity": quantity}
+            for batch_id, batch_name, quantity in allocations
+        ]
+    }
+
+
+@router.post("/order/add_bulk")
+async def addOrdersBulk(db: db_dependency, bulk_data: BaseOrderBulkCreate):
+    """
+    Places many orders at once. Each line succeeds or fails on its own, lines are allocated in request order.
+    """
+    results = [None] * len(bulk_data.orders)
+
+    # validate all the products with one query
+    product_ids = {line.Product_id for line in bulk_data.orders}
+    known = set((await db.execute(select(Product.id).filter(Product.id.in_(product_ids)))).scalars())
+
+    # every batch the request can draw from is locked in one pass, then allocated in memory
+    batches = await lock_product_batches(db, known, batch_index.strategy)
+    new_orders = []
+    created_at = datetime.now()
+    for index, line in enumerate(bulk_data.orders):
+        if line.quantity <= 0:
+            results[index] = {"line": index, "status": "failed", "error": "Order quantity must be positive"}
+            continue
+        if line.Product_id not in known:
+            results[index] = {"line": index, "status": "failed", "error": "Product not found"}
+            continue
+        allocations = take_batches(batches.get(line.Product_id, []), line.quantity, batch_index.strategy)
+        if allocations is None:
+            results[index] = {"line": index, "status": "failed",
+                              "error": "Not enough available quantity to fulfill the order"}
+            continue
+        new_orders.append((index, {**line.dict(), "createdAt": created_at}, allocations))
+
+    if new_orders:
+        # all the orders go in with one statement, then one batch update and one allocation insert
+        order_ids = await insert_returning_ids(db, Order, [order for _, order, _ in new_orders])
+        await apply_allocations(db, {order_id: allocations
+                                     for order_id, (_, _, allocations) in zip(order_ids, new_orders)})
+
+        ordered = {}
+        placed = {}
+        for _, order, _ in new_orders:
+            ordered[order["Product_id"]] = ordered.get(order["Product_id"], 0) + order["quantity"]
+            placed[order["Product_id"]] = placed.get(order["Product_id"], 0) + 1
+        await add_to_rollups(db, rollup_rows(ORDERS_PLACED, created_at.date(), placed)
+                             + rollup_rows(ORDERED_QUANTITY, created_at.date(), ordered))
+        await db.commit()
+        count_on_dashboard("totalOrders", len(new_orders))
+        for _, _, allocations in new_orders:
+            batch_index.consume(allocations)
+
+        for order_id, (index, order, allocations) in zip(order_ids, new_orders):
+            results[index] = {
+                "line": index,
+                "status": "created",
+                "id": order_id,
+                "batches": [
+                    {"batch_id": batch_id, "batch_name": batch_name, "quantity": quantity}
+                    for batch_id, batch_name, quantity in allocations
+                ]
+            }
+
+    return {
+        "lines": len(results),
+        "created": len(new_orders),
+        "errorCount": len(results) - len(new_orders),
+        "results": results,
+    }
+
@@ -1,13 +1,19 @@
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session, joinedload
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from typing import Annotated, Optional, List
 
 from models import models
 from classes.classes import CreateProduct, UpdateProduct
 from models.models import Recipe, Product
-from utils.database import SessionLocal
+from utils.database import AsyncSessionLocal
+from utils.cache import count_on_dashboard
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from utils.search import product_search
+from utils.autocomplete import autocomplete
 
 import logging
 
@@ -21,66 +27,72 @@ logger.addHandler(console_handler)
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Dependency annotation
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.get("/product/all")
 async def getAllProducts(db: db_dependency):
-    return (db.query(models.Product)
-            .options(joinedload(models.Product.recipe))
-            .all())
+    result = await db.execute(select(models.Product).options(joinedload(models.Product.recipe)))
+    return result.scalars().all()
 
 
 @router.get("/product/search_by_name/{product_name}")
-async def search_product_by_name(product_name: str, db: db_dependency):
-    return (db.query(Product)
-            .filter(Product.name.ilike(f"%{product_name}%"))
-            .all())
+async def search_product_by_name(product_name: str, db: db_dependency,
+                                 cursor: Optional[str] = None,
+                                 limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return await product_search.search(db, product_name, cursor, limit)
 
 
 @router.post("/product/add")
 async def addProduct(db: db_dependency, createProduct: CreateProduct):
-    recipe = db.query(Recipe).filter(Recipe.id == createProduct.Recipe_id).first()
+    recipe = (await db.execute(select(Recipe).filter(Recipe.id == createProduct.Recipe_id))).scalars().first()
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
 
     db_product = Product(**createProduct.dict())
     db.add(db_product)
-    db.commit()
-    db.refresh(db_product)
+    await db.commit()
+    await db.refresh(db_product)
+    count_on_dashboard("totalProducts")
+    product_search.add(db_product.id, db_product.name)
+    autocomplete.add("product", db_product.id, db_product.name)
     # return data
 
-    return (db.query(models.Product)
-            .options(joinedload(models.Product.recipe))
-            .filter(Product.id == db_product.id)
-            .first())
+    return (await db.execute(
+        select(models.Product)
+        .options(joinedload(models.Product.recipe))
+        .filter(Product.id == db_product.id)
+    )).scalars().first()
 
 
 @router.put("/product/update")
 async def updateProduct(db: db_dependency, editProduct: UpdateProduct):
-    product = db.query(Product).filter(Product.id == editProduct.id).first()
+    product = (await db.execute(select(Product).filter(Product.id == editProduct.id))).scalars().first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    recipe = db.query(Recipe).filter(Recipe.id == editProduct.Recipe_id).first()
+    recipe = (await db.execute(select(Recipe).filter(Recipe.id == editProduct.Recipe_id))).scalars().first()
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
 
     for key, value in editProduct.dict().items():
         setattr(product, key, value)
 
-    db.commit()
-    db.refresh(product)
-    return (db.query(models.Product)
-            .options(joinedload(models.Product.recipe))
-            .filter(Product.id == product.id)
-            .first())
+    await db.commit()
+    await db.refresh(product)
+    product_search.add(product.id, product.name)
+    autocomplete.add("product", product.id, product.name)
+    return (await db.execute(
+        select(models.Product)
+        .options(joinedload(models.Product.recipe))
+        .filter(Product.id == product.id)
+    )).scalars().first()
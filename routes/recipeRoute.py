@@ -1,11 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session, joinedload
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, delete, insert, update, case
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from typing import Annotated, Optional, List
 
 from models import models
 from classes.classes import BaseRecipeCreate, RecipeResponse, RecipeViewResponse, BaseRecipeUpdate
 from models.models import Recipe, Ingredient, RecipeHasIngredient
-from utils.database import SessionLocal
+from utils.cache import recipe_cache, forget_recipes
+from utils.database import AsyncSessionLocal
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from utils.search import recipe_search
+from utils.autocomplete import autocomplete
 
 import logging
 
@@ -19,130 +25,81 @@ logger.addHandler(console_handler)
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # Dependency annotation
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 @router.post("/recipe/add")
 async def create_recipe(recipe_data: BaseRecipeCreate, db: db_dependency):
     # logger.info(f"Creating Recipe: {recipe_data.name}")
 
-    # Step 1: Create the Recipe entry
+    # Step 1: resolve all the ingredients first, nothing is written when one is missing
+    quantities = await ingredient_quantities(db, recipe_data.ingredients)
+
+    # Step 2: the recipe and all its ingredient lines go in one transaction
     new_recipe = models.Recipe(name=recipe_data.name, description=recipe_data.description)
     db.add(new_recipe)
-    db.commit()
-    db.refresh(new_recipe)
-
-    # Step 2: Process Ingredients
-    for ingredient_data in recipe_data.ingredients:
-        ingredient = db.query(models.Ingredient).filter(models.Ingredient.name == ingredient_data.name).first()
-        if not ingredient:
-            raise HTTPException(status_code=404, detail="Ingredient not found")
-
-        recipe_ingredient = models.RecipeHasIngredient(
-            Recipe_id=new_recipe.id,
-            Ingredient_id=ingredient.id,
-            quantity=ingredient_data.quantity
-        )
-        db.add(recipe_ingredient)
-    db.commit()
+    await db.flush()
+    if quantities:
+        await db.execute(insert(models.RecipeHasIngredient), [
+            {"Recipe_id": new_recipe.id, "Ingredient_id": ingredient_id, "quantity": quantity}
+            for ingredient_id, quantity in quantities.items()
+        ])
+    await db.commit()
+    forget_recipes([new_recipe.id])
+    recipe_search.add(new_recipe.id, new_recipe.name)
+    autocomplete.add("recipe", new_recipe.id, new_recipe.name)
     return await view_recipe(new_recipe.id, db)
 
 
 @router.get("/recipe/view/{recipe_id}")
 async def view_recipe(recipe_id: int, db: db_dependency):
-    recipes_with_ingredients = (
-        db.query(
-            Recipe.id.label("recipe_id"),
-            Recipe.name.label("recipe_name"),
-            Recipe.description.label("description"),
-            Ingredient.id.label("ingredient_id"),
-            Ingredient.name.label("ingredient_name"),
-            RecipeHasIngredient.quantity.label("quantity")
-        )
-        .join(RecipeHasIngredient, RecipeHasIngredient.Recipe_id == Recipe.id)
-        .join(Ingredient, RecipeHasIngredient.Ingredient_id == Ingredient.id)
-        .filter(Recipe.id == recipe_id)
-        .all()
-    )
-
-    # Organize the data into a structured dictionary
-    recipe_dict = {}
-    for recipe_id, recipe_name, description, ingredient_id, ingredient_name, quantity in recipes_with_ingredients:
-        if recipe_id not in recipe_dict:
-            recipe_dict[recipe_id] = {
-                "id": recipe_id,
-                "name": recipe_name,
-                "description": description,
-                "ingredients": []
-            }
-        recipe_dict[recipe_id]["ingredients"].append({
-            "id": ingredient_id,
-            "name": ingredient_name,
-            "quantity": quantity
-        })
-
-    # Convert the dictionary to a list of recipes
-    recipes = list(recipe_dict.values())
+    recipes = recipe_cache.get(("recipe", recipe_id))
+    if recipes is None:
+        invalidations = recipe_cache.invalidations
+        recipes = await recipe_documents(db, recipe_id)
+        # a write that committed while this was read may already be in the result or not, so it is not cached
+        if recipe_cache.invalidations == invalidations:
+            recipe_cache.set(("recipe", recipe_id), recipes)
     return recipes
 
 
 @router.get("/recipe/search_by_name/{recipe_name}")
-async def search_recipe_by_name(recipe_name: str, db: db_dependency):
-    return (db.query(Recipe)
-            .filter(Recipe.name.ilike(f"%{recipe_name}%"))
-            .all())
+async def search_recipe_by_name(recipe_name: str, db: db_dependency,
+                                cursor: Optional[str] = None,
+                                limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return await recipe_search.search(db, recipe_name, cursor, limit)
 
 
 @router.get("/recipe/view_all")
 async def view_all_recipes(db: db_dependency):
-    recipes_with_ingredients = (
-        db.query(
-            Recipe.id.label("recipe_id"),
-            Recipe.name.label("recipe_name"),
-            Recipe.description.label("description"),
-            Ingredient.id.label("ingredient_id"),
-            Ingredient.name.label("ingredient_name"),
-            RecipeHasIngredient.quantity.label("quantity")
-        )
-        .join(RecipeHasIngredient, RecipeHasIngredient.Recipe_id == Recipe.id)
-        .join(Ingredient, RecipeHasIngredient.Ingredient_id == Ingredient.id)
-        .all()
-    )
+    recipes = recipe_cache.get("all")
+    if recipes is None:
+        invalidations = recipe_cache.invalidations
+        recipes = await recipe_documents(db)
+        # a write that committed while this was read may already be in the result or not, so it is not cached
+        if recipe_cache.invalidations == invalidations:
+            recipe_cache.set("all", recipes)
+    return recipes
 
-    # Organize the data into a structured dictionary
-    recipe_dict = {}
-    for recipe_id, recipe_name, description, ingredient_id, ingredient_name, quantity in recipes_with_ingredients:
-        if recipe_id not in recipe_dict:
-            recipe_dict[recipe_id] = {
-                "id": recipe_id,
-                "name": recipe_name,
-                "description": description,
-                "ingredients": []
-            }
-        recipe_dict[recipe_id]["ingredients"].append({
-            "id": ingredient_id,
-            "name": ingredient_name,
-            "quantity": quantity
-        })
 
-    # Convert the dictionary to a list of recipes
-    recipes = list(recipe_dict.values())
-    return recipes
+@router.get("/recipe/cache_stats")
+async def get_recipe_cache_stats():
+    return recipe_cache.stats()
 
 
 @router.put("/recipe/update/{recipe_id}")
 async def update_recipe(recipe_id: int, recipe_data: BaseRecipeUpdate, db: db_dependency):
     # Fetch the recipe
-    recipe = db.query(models.Recipe).filter(models.Recipe.id == recipe_id).first()
+    recipe = (await db.execute(select(models.Recipe).filter(models.Recipe.id == recipe_id))).scalars().first()
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
 
@@ -152,46 +109,102 @@ async def update_recipe(recipe_id: int, recipe_data: BaseRecipeUpdate, db: db_de
     if recipe_data.description:
         recipe.description = recipe_data.description
 
-    # Update ingredients
+    # Update ingredients, a fixed number of statements however many lines the recipe has
     if recipe_data.ingredients:
-        existing_ingredients = {ri.Ingredient_id: ri.quantity for ri in db.query(models.RecipeHasIngredient).filter(
-            models.RecipeHasIngredient.Recipe_id == recipe.id)}
-
-        for ingredient_data in recipe_data.ingredients:
-            # Check if ingredient already exists
-            ingredient = db.query(models.Ingredient).filter(models.Ingredient.name == ingredient_data.name).first()
-            if not ingredient:
-                raise HTTPException(status_code=404, detail=("Ingredient not found: " + ingredient_data.name))
-
-            # If ingredient is new to this recipe, add it
-            if ingredient.id not in existing_ingredients:
-                recipe_ingredient = models.RecipeHasIngredient(
-                    Recipe_id=recipe.id,
-                    Ingredient_id=ingredient.id,
-                    quantity=ingredient_data.quantity
-                )
-                db.add(recipe_ingredient)
-            else:
-                # Update quantity if different
-                recipe_ingredient = db.query(models.RecipeHasIngredient).filter(
-                    models.RecipeHasIngredient.Recipe_id == recipe.id,
-                    models.RecipeHasIngredient.Ingredient_id == ingredient.id
-                ).first()
-                if recipe_ingredient.quantity != ingredient_data.quantity:
-                    recipe_ingredient.quantity = ingredient_data.quantity
-
-            # Remove the ingredient from the tracking dictionary if it's still part of the recipe
-            existing_ingredients.pop(ingredient.id, None)
-
-        # Remove any ingredients that are no longer needed
-        for ingredient_id in existing_ingredients:
-            db.query(models.RecipeHasIngredient).filter(
-                models.RecipeHasIngredient.Recipe_id == recipe.id,
-                models.RecipeHasIngredient.Ingredient_id == ingredient_id
-            ).delete()
+        new_quantities = await ingredient_quantities(db, recipe_data.ingredients)
+        old_quantities = dict((await db.execute(
+            select(models.RecipeHasIngredient.Ingredient_id, models.RecipeHasIngredient.quantity)
+            .filter(models.RecipeHasIngredient.Recipe_id == recipe.id)
+        )).all())
+
+        removed = old_quantities.keys() - new_quantities.keys()
+        added = new_quantities.keys() - old_quantities.keys()
+        changed = {ingredient_id: quantity for ingredient_id, quantity in new_quantities.items()
+                   if ingredient_id in old_quantities and old_quantities[ingredient_id] != quantity}
+
+        if removed:
+            await db.execute(
+                delete(models.RecipeHasIngredient)
+                .where(models.RecipeHasIngredient.Recipe_id == recipe.id,
+                       models.RecipeHasIngredient.Ingredient_id.in_(removed))
+            )
+        if added:
+            await db.execute(insert(models.RecipeHasIngredient), [
+                {"Recipe_id": recipe.id, "Ingredient_id": ingredient_id, "quantity": new_quantities[ingredient_id]}
+                for ingredient_id in added
+            ])
+        if changed:
+            await db.execute(
+                update(models.RecipeHasIngredient)
+                .where(models.RecipeHasIngredient.Recipe_id == recipe.id,
+                       models.RecipeHasIngredient.Ingredient_id.in_(changed.keys()))
+                .values(quantity=case(changed, value=models.RecipeHasIngredient.Ingredient_id))
+                .execution_options(synchronize_session=False)
+            )
 
     # Commit all changes
-    db.commit()
+    await db.commit()
+    forget_recipes([recipe_id])
+    recipe_search.add(recipe_id, recipe.name)
+    autocomplete.add("recipe", recipe_id, recipe.name)
 
     # Fetch updated recipe with related data
-    return await view_recipe(recipe_id, db)
\ No newline at end of file
+    return await view_recipe(recipe_id, db)
+
+
+async def ingredient_quantities(db, ingredients):
+    """
+    Resolves the ingredient names of recipe lines with one query, returns {ingredient_id: quantity}.
+    Lines naming the same ingredient are added up.
+    """
+    names = {ingredient.name for ingredient in ingredients}
+    ingredient_ids = dict((await db.execute(
+        select(models.Ingredient.name, models.Ingredient.id).filter(models.Ingredient.name.in_(names))
+    )).all())
+    missing = names - ingredient_ids.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail="Ingredient not found: " + ", ".join(sorted(missing)))
+
+    quantities = {}
+    for ingredient in ingredients:
+        ingredient_id = ingredient_ids[ingredient.name]
+        quantities[ingredient_id] = quantities.get(ingredient_id, 0) + ingredient.quantity
+    return quantities
+
+
+async def recipe_documents(db, recipe_id=None):
+    """
+    Recipes with their ingredients, all of them or the one with recipe_id
+    """
+    query = (select(
+                Recipe.id.label("recipe_id"),
+                Recipe.name.label("recipe_name"),
+                Recipe.description.label("description"),
+                Ingredient.id.label("ingredient_id"),
+                Ingredient.name.label("ingredient_name"),
+                RecipeHasIngredient.quantity.label("quantity")
+             )
+             .join(RecipeHasIngredient, RecipeHasIngredient.Recipe_id == Recipe.id)
+             .join(Ingredient, RecipeHasIngredient.Ingredient_id == Ingredient.id))
+    if recipe_id is not None:
+        query = query.filter(Recipe.id == recipe_id)
+    recipes_with_ingredients = (await db.execute(query)).all()
+
+    # Organize the data into a structured dictionary
+    recipe_dict = {}
+    for recipe_id, recipe_name, description, ingredient_id, ingredient_name, quantity in recipes_with_ingredients:
+        if recipe_id not in recipe_dict:
+            recipe_dict[recipe_id] = {
+                "id": recipe_id,
+                "name": recipe_name,
+                "description": description,
+                "ingredients": []
+            }
+        recipe_dict[recipe_id]["ingredients"].append({
+            "id": ingredient_id,
+            "name": ingredient_name,
+            "quantity": quantity
+        })
+
+    # Convert the dictionary to a list of recipes
+    return list(recipe_dict.values())
@@ -0,0 +1,134 @@
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Annotated, Optional
+
+from models import models
+from classes.classes import StockAdjustment
+from utils.cache import ingredients_changed
+from utils.database import AsyncSessionLocal
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, keyset_after
+from utils.snapshots import latest_snapshot_before, stock_rows_between
+from utils.stock import ADJUSTMENT, WRITE_OFF, movement_rows, record_movements, rebuild_current_stock
+
+router = APIRouter()
+
+
+async def get_db():
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+# Dependency annotation
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+
+
+@router.get("/stock/movements")
+async def get_stock_movements(db: db_dependency,
+                              ingredient_id: Optional[int] = None,
+                              type: Optional[str] = None,
+                              cursor: Optional[str] = None,
+                              limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    Stock ledger, newest movement first
+    """
+    query = (select(models.StockMovement.id,
+                    models.StockMovement.Ingredient_id,
+                    models.Ingredient.name.label("ingredient_name"),
+                    models.StockMovement.type,
+                    models.StockMovement.quantity,
+                    models.StockMovement.GRN_id,
+                    models.StockMovement.Batch_id,
+                    models.StockMovement.note,
+                    models.StockMovement.createdAt,
+                    models.StockMovement.effectiveAt)
+             .join(models.Ingredient, models.Ingredient.id == models.StockMovement.Ingredient_id)
+             .order_by(models.StockMovement.createdAt.desc(), models.StockMovement.id.desc())
+             .limit(limit + 1))
+    if ingredient_id is not None:
+        query = query.filter(models.StockMovement.Ingredient_id == ingredient_id)
+    if type:
+        query = query.filter(models.StockMovement.type == type)
+    if cursor:
+        query = query.filter(keyset_after(models.StockMovement.createdAt, models.StockMovement.id, cursor))
+
+    rows = (await db.execute(query)).all()
+    page = rows[:limit]
+    return {
+        "items": [dict(row._mapping) for row in page],
+        "next_cursor": encode_cursor(page[-1].createdAt, page[-1].id) if len(rows) > limit else None,
+    }
+
+
+@router.get("/stock/as_of", summary="Inventory as it was at a point in time")
+async def get_stock_as_of(db: db_dependency, at: datetime, ingredient_id: Optional[int] = None):
+    """
+    Starts from the last snapshot taken at or before the requested time and replays only the movements after it.
+    Movements count on their business date, GRN issuedDate and batch productionDate.
+    """
+    snapshot_at = await latest_snapshot_before(db, at)
+    rows = stock_rows_between(snapshot_at, at, ingredient_id).subquery()
+    result = await db.execute(
+        select(models.Ingredient.id, models.Ingredient.name, func.sum(rows.c.quantity))
+        .join(rows, rows.c.Ingredient_id == models.Ingredient.id)
+        .group_by(models.Ingredient.id, models.Ingredient.name)
+        .order_by(models.Ingredient.id)
+    )
+    return {
+        "at": at,
+        "snapshotAt": snapshot_at,
+        "ingredients": [
+            {"id": row_id, "name": name, "quantity": int(quantity or 0)}
+            for row_id, name, quantity in result
+        ]
+    }
+
+
+@router.post("/stock/adjust")
+async def adjust_stock(db: db_dependency, adjustment: StockAdjustment):
+    if adjustment.type not in (ADJUSTMENT, WRITE_OFF):
+        raise HTTPException(status_code=400, detail="Stock can only be changed here by an adjustment or a write_off")
+
+    quantity = adjustment.quantity
+    if adjustment.type == WRITE_OFF:
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Write-off quantity must be positive")
+        # the stock row stays locked so a concurrent batch can not use what is being written off
+        current = (await db.execute(
+            select(models.CurrentStock.current_quantity)
+            .filter(models.CurrentStock.Ingredient_id == adjustment.Ingredient_id)
+            .with_for_update()
+        )).scalar()
+        if (current or 0) < quantity:
+            raise HTTPException(status_code=409, detail="Not enough stock to write off")
+        quantity = -quantity
+    else:
+        ingredient = (await db.execute(
+            select(models.Ingredient.id).filter(models.Ingredient.id == adjustment.Ingredient_id)
+        )).scalar()
+        if not ingredient:
+            raise HTTPException(status_code=404, detail="Ingredient not found")
+
+    await record_movements(db, movement_rows(adjustment.type, {adjustment.Ingredient_id: quantity},
+                                             note=adjustment.note))
+    await db.commit()
+
+    current = (await db.execute(
+        select(models.CurrentStock.current_quantity)
+        .filter(models.CurrentStock.Ingredient_id == adjustment.Ingredient_id)
+    )).scalar()
+    return {"Ingredient_id": adjustment.Ingredient_id, "current_quantity": current or 0}
+
+
+@router.post("/stock/rebuild", summary="Rebuild Current_Stock from the stock movement ledger")
+async def rebuild_stock(db: db_dependency):
+    await rebuild_current_stock(db)
+    await db.commit()
+    ingredients_changed()
+    result = await db.execute(select(models.CurrentStock.Ingredient_id, models.CurrentStock.current_quantity))
+    return [{"Ingredient_id": ingredient_id, "current_quantity": quantity} for ingredient_id, quantity in result]
@@ -0,0 +1,23 @@
+import asyncio
+import os
+import tempfile
+
+# the app reads its database from the environment, the tests run it on a SQLite file of their own
+DATABASE = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DB_URL"] = f"sqlite:///{DATABASE}"
+os.environ["ASYNC_DB_URL"] = f"sqlite+aiosqlite:///{DATABASE}"
+
+
+def run(coroutine):
+    """
+    Runs a test coroutine on a fresh event loop, the pooled connections belong to it and are closed with it
+    """
+    from utils.database import async_engine
+
+    async def run_and_dispose():
+        try:
+            return await coroutine
+        finally:
+            await async_engine.dispose()
+
+    return asyncio.run(run_and_dispose())
@@ -0,0 +1,35 @@
+from utils.allocation import take_batches
+from utils.batch_index import CLOSEST_FIT, FEFO, FIFO
+
+
+def locked(*available):
+    return [[batch_id, f"batch {batch_id}", quantity] for batch_id, quantity in enumerate(available, 1)]
+
+
+def test_takes_in_locked_order():
+    batches = locked(3, 5, 4)
+    assert take_batches(batches, 6, FIFO) == [(1, "batch 1", 3), (2, "batch 2", 3)]
+    assert [batch[2] for batch in batches] == [0, 2, 4]
+
+
+def test_skips_emptied_batches():
+    batches = locked(3, 5)
+    take_batches(batches, 3, FEFO)
+    assert take_batches(batches, 2, FEFO) == [(2, "batch 2", 2)]
+
+
+def test_short_leaves_batches_untouched():
+    batches = locked(2, 2)
+    assert take_batches(batches, 5, FIFO) is None
+    assert [batch[2] for batch in batches] == [2, 2]
+
+
+def test_closest_fit_takes_smallest_covering_batch():
+    batches = locked(9, 4, 6, 4)
+    assert take_batches(batches, 4, CLOSEST_FIT) == [(2, "batch 2", 4)]
+    assert [batch[2] for batch in batches] == [9, 0, 6, 4]
+
+
+def test_closest_fit_without_single_batch_splits_in_order():
+    batches = locked(3, 2, 4)
+    assert take_batches(batches, 8, CLOSEST_FIT) == [(1, "batch 1", 3), (2, "batch 2", 2), (3, "batch 3", 3)]
@@ -0,0 +1,67 @@
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from utils.batch_index import CLOSEST_FIT, FEFO, FIFO, BatchIndex
+
+Row = namedtuple("Row", "id product_id name availableQuantity dateOfExpiry productionDate")
+
+TODAY = date(2026, 6, 1)
+
+
+def row(batch_id, available, expires_in=30, made_days_ago=0, product_id=1):
+    return Row(batch_id, product_id, f"batch {batch_id}", available, TODAY + timedelta(days=expires_in),
+               datetime(2026, 6, 1) - timedelta(days=made_days_ago))
+
+
+def index(strategy, *rows):
+    batch_index = BatchIndex(strategy)
+    batch_index.replace(rows)
+    return batch_index
+
+
+def test_fifo_reserves_oldest_first():
+    batch_index = index(FIFO, row(1, 5, made_days_ago=1), row(2, 5, made_days_ago=3))
+    assert batch_index.reserve(1, 7, TODAY) == [(2, "batch 2", 5), (1, "batch 1", 2)]
+    assert batch_index.reserve(1, 3, TODAY) == [(1, "batch 1", 3)]
+    assert batch_index.reserve(1, 1, TODAY) is None
+
+
+def test_fefo_reserves_first_to_expire_and_skips_expired():
+    batch_index = index(FEFO, row(1, 5, expires_in=10), row(2, 5, expires_in=2), row(3, 5, expires_in=20))
+    assert batch_index.reserve(1, 6, TODAY) == [(2, "batch 2", 5), (1, "batch 1", 1)]
+    assert batch_index.reserve(1, 5, TODAY + timedelta(days=15)) == [(3, "batch 3", 5)]
+
+
+def test_closest_fit_reserves_one_batch():
+    batch_index = index(CLOSEST_FIT, row(1, 9, expires_in=2), row(2, 4, expires_in=9), row(3, 5, expires_in=5))
+    assert batch_index.reserve(1, 4, TODAY) == [(2, "batch 2", 4)]
+    assert batch_index.reserve(1, 10, TODAY) == [(1, "batch 1", 9), (3, "batch 3", 1)]
+
+
+def test_short_reserve_takes_nothing():
+    batch_index = index(FIFO, row(1, 2), row(2, 2))
+    assert batch_index.reserve(1, 5, TODAY) is None
+    assert batch_index.reserve(1, 4, TODAY) == [(1, "batch 1", 2), (2, "batch 2", 2)]
+
+
+def test_unloaded_product_is_left_to_the_database():
+    assert BatchIndex(FIFO).reserve(1, 1, TODAY) is None
+    assert index(FIFO, row(1, 5)).reserve(2, 1, TODAY) is None
+
+
+def test_release_gives_back_the_reservation():
+    batch_index = index(FIFO, row(1, 3, made_days_ago=1), row(2, 3))
+    allocations = batch_index.reserve(1, 4, TODAY)
+    batch_index.release(allocations)
+    assert batch_index.reserve(1, 6, TODAY) == [(1, "batch 1", 3), (2, "batch 2", 3)]
+
+
+def test_reload_keeps_reservations_of_orders_in_flight():
+    batch_index = index(FIFO, row(1, 5))
+    allocations = batch_index.reserve(1, 3, TODAY)
+    # the order has not committed, the database still has 5
+    assert batch_index.replace([row(1, 5)]) == 0
+    assert batch_index.reserve(1, 3, TODAY) is None
+    batch_index.confirm(allocations)
+    assert batch_index.replace([row(1, 2)]) == 0
+    assert batch_index.reserve(1, 2, TODAY) == [(1, "batch 1", 2)]
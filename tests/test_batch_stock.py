@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+from sqlalchemy import select
+
+from conftest import run
+from main import app
+from models import models
+from utils.database import AsyncSessionLocal
+
+
+async def seed_product(name, stock, per_batch):
+    async with AsyncSessionLocal() as db:
+        ingredient = models.Ingredient(name=f"{name} malt", description="")
+        recipe = models.Recipe(name=f"{name} recipe", description="")
+        db.add_all([ingredient, recipe])
+        await db.flush()
+        product = models.Product(name=f"{name} product", type="beer", batch_size=1, expire_duration=1,
+                                 Recipe_id=recipe.id)
+        db.add_all([product,
+                    models.RecipeHasIngredient(Recipe_id=recipe.id, Ingredient_id=ingredient.id, quantity=per_batch),
+                    models.CurrentStock(Ingredient_id=ingredient.id, current_quantity=stock)])
+        await db.commit()
+        return product.id, ingredient.id
+
+
+async def current_stock(ingredient_id):
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(
+            select(models.CurrentStock.current_quantity).filter(models.CurrentStock.Ingredient_id == ingredient_id)
+        )).scalar()
+
+
+def test_concurrent_batches_never_overdraw_stock():
+    async def scenario():
+        product_id, ingredient_id = await seed_product("overdraw", stock=84, per_batch=10)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            responses = await asyncio.gather(*(client.post("/batch/add", json={"product_id": product_id})
+                                               for _ in range(40)))
+        return [response.status_code for response in responses], await current_stock(ingredient_id)
+
+    statuses, stock = run(scenario())
+    assert statuses.count(200) == 8
+    assert stock == 84 - 8 * 10
+    assert set(statuses) <= {200, 404, 409}
+
+
+def test_bulk_batches_record_their_own_consumption():
+    async def scenario():
+        product_id, ingredient_id = await seed_product("bulk", stock=100, per_batch=10)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/batch/add_bulk", json={"batches": [
+                {"product_id": product_id, "batch_count": 1}, {"product_id": product_id, "batch_count": 3}]})
+        async with AsyncSessionLocal() as db:
+            movements = (await db.execute(
+                select(models.StockMovement.Batch_id, models.StockMovement.quantity)
+                .filter(models.StockMovement.Ingredient_id == ingredient_id)
+                .order_by(models.StockMovement.id)
+            )).all()
+        return response.json(), movements, await current_stock(ingredient_id)
+
+    body, movements, stock = run(scenario())
+    assert [tuple(movement) for movement in movements] == [(batch["id"], -10 * count)
+                                                          for batch, count in zip(body["batches"], (1, 3))]
+    assert stock == 60
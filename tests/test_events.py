@@ -0,0 +1,27 @@
+from conftest import run
+from utils.events import EventBus, delta_stream
+
+
+async def read_snapshot():
+    return {"1": 10}
+
+
+def test_delta_stream_subscribes_only_while_it_runs():
+    async def scenario():
+        bus = EventBus()
+        stream = delta_stream(bus, read_snapshot)
+        counts = [bus.subscriber_count]
+        first = await stream.__anext__()
+        counts.append(bus.subscriber_count)
+        bus.publish({"type": "delta", "changes": {"1": -2}})
+        bus.publish({"type": "delta", "changes": {"1": -3}})
+        second = await stream.__anext__()
+        await stream.aclose()
+        counts.append(bus.subscriber_count)
+        return counts, first, second
+
+    counts, first, second = run(scenario())
+    # a response that is never sent leaves no subscriber behind
+    assert counts == [0, 1, 0]
+    assert first == 'event: snapshot\ndata: {"1": 10}\n\n'
+    assert second == 'event: delta\ndata: {"1": -5}\n\n'
@@ -0,0 +1,69 @@
+import httpx
+import pytest
+from sqlalchemy import func, select
+
+import routes.grnRoute
+from conftest import run
+from main import app
+from models import models
+from utils.database import AsyncSessionLocal
+
+
+async def seed_ingredient(name):
+    async with AsyncSessionLocal() as db:
+        db.add(models.Ingredient(name=name, description=""))
+        await db.commit()
+
+
+async def grn_lines(ingredient_name):
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(
+            select(func.count(), func.sum(models.GRN_has_Ingredient.currentQuantity))
+            .join(models.Ingredient, models.Ingredient.id == models.GRN_has_Ingredient.Ingredient_id)
+            .filter(models.Ingredient.name == ingredient_name)
+        )).one()
+
+
+async def post_csv(content):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post("/grn/import", files={"file": ("grns.csv", content.encode())})
+    return response.json()
+
+
+def test_conflicting_issued_date_is_a_row_error():
+    async def scenario():
+        await seed_ingredient("import test rye")
+        report = await post_csv("grn,name,quantity,issuedDate\n"
+                                "A,import test rye,5,2026-01-01\n"
+                                "A,import test rye,7,2026-02-01\n"
+                                "A,import test rye,1,\n")
+        return report, await grn_lines("import test rye")
+
+    report, (lines, quantity) = run(scenario())
+    assert report["imported"] == 2
+    assert [error["row"] for error in report["errors"]] == [3]
+    assert "conflicts" in report["errors"][0]["error"]
+    assert (lines, quantity) == (1, 6)
+
+
+def test_failure_part_way_imports_nothing(monkeypatch):
+    calls = []
+    add_grn_lines = routes.grnRoute.add_grn_lines
+
+    async def failing_second_chunk(db, quantities):
+        calls.append(quantities)
+        if len(calls) == 2:
+            raise RuntimeError("database went away")
+        await add_grn_lines(db, quantities)
+
+    monkeypatch.setattr(routes.grnRoute, "IMPORT_CHUNK_SIZE", 2)
+    monkeypatch.setattr(routes.grnRoute, "add_grn_lines", failing_second_chunk)
+
+    async def scenario():
+        await seed_ingredient("import test oats")
+        with pytest.raises(RuntimeError):
+            await post_csv("grn,name,quantity\n" + "".join(f"B{row},import test oats,1\n" for row in range(4)))
+        return await grn_lines("import test oats")
+
+    lines, _ = run(scenario())
+    assert lines == 0
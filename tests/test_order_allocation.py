@@ -0,0 +1,104 @@
+import asyncio
+from datetime import date, datetime, timedelta
+
+import httpx
+from sqlalchemy import select, func
+
+from conftest import run
+from main import app
+from models import models
+from utils import allocation
+from utils.database import AsyncSessionLocal
+
+
+async def seed_batches(name, quantities):
+    async with AsyncSessionLocal() as db:
+        recipe = models.Recipe(name=f"{name} recipe", description="")
+        db.add(recipe)
+        await db.flush()
+        product = models.Product(name=f"{name} product", type="beer", batch_size=1, expire_duration=30,
+                                 Recipe_id=recipe.id)
+        db.add(product)
+        await db.flush()
+        made = datetime.now() - timedelta(days=len(quantities))
+        db.add_all([models.Batch(name=f"{name} {index}", productionDate=made + timedelta(days=index),
+                                 initialQuantity=quantity, availableQuantity=quantity,
+                                 dateOfExpiry=date.today() + timedelta(days=30), product_id=product.id)
+                    for index, quantity in enumerate(quantities)])
+        await db.commit()
+        return product.id
+
+
+def test_concurrent_orders_are_all_placed_without_overselling():
+    async def scenario():
+        product_id = await seed_batches("order test", [30, 30, 30, 30, 30])
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            responses = await asyncio.gather(*(
+                client.post("/order/add", json={"name": f"order {index}", "quantity": 3, "Product_id": product_id})
+                for index in range(40)
+            ))
+        async with AsyncSessionLocal() as db:
+            available = (await db.execute(
+                select(models.Batch.availableQuantity).filter(models.Batch.product_id == product_id)
+            )).scalars().all()
+            allocated = dict((await db.execute(
+                select(models.OrderHasBatch.Order_id, func.sum(models.OrderHasBatch.quantity))
+                .join(models.Order, models.Order.id == models.OrderHasBatch.Order_id)
+                .filter(models.Order.Product_id == product_id)
+                .group_by(models.OrderHasBatch.Order_id)
+            )).all())
+        return responses, available, allocated
+
+    responses, available, allocated = run(scenario())
+    placed = [response.json()["id"] for response in responses if response.status_code == 200]
+    # an order only fails when it lost the race twice, which a database with row locks never lets happen
+    assert {response.status_code for response in responses} <= {200, 409}
+    assert sum(available) == 150 - 3 * len(placed)
+    assert min(available) >= 0
+    assert sorted(allocated) == sorted(placed)
+    assert set(allocated.values()) == {3}
+
+
+def test_order_lost_to_a_concurrent_order_is_allocated_again(monkeypatch):
+    take_from_batches = allocation.take_from_batches
+    calls = []
+
+    async def lose_the_first_update(db, taken):
+        calls.append(taken)
+        if len(calls) == 1:
+            return False
+        return await take_from_batches(db, taken)
+
+    monkeypatch.setattr(allocation, "take_from_batches", lose_the_first_update)
+
+    async def scenario():
+        product_id = await seed_batches("retry test", [10, 10])
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/order/add", json={"name": "retried", "quantity": 15, "Product_id": product_id})
+
+    response = run(scenario())
+    assert response.status_code == 200
+    assert [batch["quantity"] for batch in response.json()["batches"]] == [10, 5]
+    assert len(calls) == 2
+
+
+def test_bulk_orders_get_their_own_ids_and_batches():
+    async def scenario():
+        product_id = await seed_batches("bulk order test", [5, 5])
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/order/add_bulk", json={"orders": [
+                {"name": "first", "quantity": 4, "Product_id": product_id},
+                {"name": "too many", "quantity": 50, "Product_id": product_id},
+                {"name": "second", "quantity": 3, "Product_id": product_id},
+            ]})
+        async with AsyncSessionLocal() as db:
+            names = dict((await db.execute(
+                select(models.Order.id, models.Order.name).filter(models.Order.Product_id == product_id)
+            )).all())
+        return response.json(), names
+
+    body, names = run(scenario())
+    created = [result for result in body["results"] if result["status"] == "created"]
+    assert [names[result["id"]] for result in created] == ["first", "second"]
+    assert [[batch["quantity"] for batch in result["batches"]] for result in created] == [[4], [1, 2]]
+    assert body["results"][1]["error"] == "Not enough available quantity to fulfill the order"
@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from conftest import run
+import main  # noqa: F401, creates the tables
+from models import models
+from utils.database import AsyncSessionLocal
+from utils.snapshots import take_due_snapshots
+from utils.stock import record_movements, ADJUSTMENT
+
+
+async def snapshot_quantity(db, ingredient_id):
+    latest = (await db.execute(select(func.max(models.StockSnapshot.takenAt)))).scalar()
+    return (await db.execute(
+        select(models.StockSnapshot.quantity)
+        .filter(models.StockSnapshot.takenAt == latest, models.StockSnapshot.Ingredient_id == ingredient_id)
+    )).scalar()
+
+
+def test_backdated_movement_is_in_the_snapshots_taken_again():
+    async def scenario():
+        now = datetime.now()
+        async with AsyncSessionLocal() as db:
+            ingredient = models.Ingredient(name="snapshot test hops", description="")
+            db.add(ingredient)
+            await db.flush()
+            ingredient_id = ingredient.id
+            await record_movements(db, [{"Ingredient_id": ingredient_id, "type": ADJUSTMENT, "quantity": 5,
+                                         "effectiveAt": now - timedelta(days=10)}])
+            await db.commit()
+            await take_due_snapshots(db)
+            before = await snapshot_quantity(db, ingredient_id)
+
+            await record_movements(db, [{"Ingredient_id": ingredient_id, "type": ADJUSTMENT, "quantity": 3,
+                                         "effectiveAt": now - timedelta(days=5)}])
+            await db.commit()
+            taken = await take_due_snapshots(db)
+            return before, taken, await snapshot_quantity(db, ingredient_id)
+
+    before, taken, after = run(scenario())
+    assert before == 5
+    assert taken >= 5
+    assert after == 8
@@ -0,0 +1,293 @@
+from contextlib import asynccontextmanager
+from datetime import date
+
+from fastapi import HTTPException
+from sqlalchemy import select, insert, update, case, or_, and_
+
+from models import models
+from utils.batch_index import ALLOCATION_STRATEGY, CLOSEST_FIT, FIFO, batch_index, batch_sort_key
+
+# batch rows read per round trip while picking enough stock
+ALLOCATION_SCAN_SIZE = 50
+# times a waiting order picks its batches again after orders that committed first took them
+ALLOCATION_ATTEMPTS = 3
+# times an order is allocated again when another order took its batches between the check and the update
+ALLOCATION_RETRIES = 1
+
+
+def batch_order(strategy):
+    """
+    Columns batches are picked in, the SQL side of batch_sort_key
+    """
+    if strategy == FIFO:
+        return [models.Batch.productionDate, models.Batch.id]
+    return [models.Batch.dateOfExpiry, models.Batch.productionDate, models.Batch.id]
+
+
+def sellable_batches(batch_filter):
+    return (batch_filter,
+            models.Batch.expired == False,
+            models.Batch.dateOfExpiry >= date.today(),
+            models.Batch.availableQuantity > 0)
+
+
+def after_row(columns, values):
+    """
+    Keyset filter for the rows that come after values when ordering by columns
+    """
+    return or_(*(
+        and_(*(column == value for column, value in zip(columns[:index], values[:index])),
+             columns[index] > values[index])
+        for index in range(len(columns))
+    ))
+
+
+async def lock_by_id(db, batch_ids, skip_locked, strategy=ALLOCATION_STRATEGY):
+    """
+    Locks those of the batches that are still sellable, in ascending id order. Every allocation path locks in
+    this one order, so transactions wanting the same batches queue on the lowest id instead of deadlocking.
+    Returns [(product_id, sort key of the strategy, [batch_id, batch_name, available quantity])] sorted.
+    """
+    if not batch_ids:
+        return []
+    rows = (await db.execute(
+        select(models.Batch.id, models.Batch.product_id, models.Batch.name, models.Batch.availableQuantity,
+               models.Batch.dateOfExpiry, models.Batch.productionDate)
+        .filter(*sellable_batches(models.Batch.id.in_(batch_ids)))
+        .order_by(models.Batch.id)
+        .with_for_update(skip_locked=skip_locked)
+    )).all()
+    return sorted((row.product_id, batch_sort_key(strategy, row.productionDate, row.dateOfExpiry, row.id),
+                   [row.id, row.name, row.availableQuantity]) for row in rows)
+
+
+async def pick_batches(db, product_id, quantity, remaining, strategy, seen=()):
+    """
+    Picks the product's batches for an order with a plain read, nothing is locked: the closest fit for quantity,
+    or batches in the order of the strategy until they cover remaining by what they held when read.
+    seen are ids left out. Returns (ids, the quantity they held).
+    """
+    order = batch_order(strategy)
+    filters = list(sellable_batches(models.Batch.product_id == product_id))
+    if seen:
+        filters.append(models.Batch.id.notin_(seen))
+    if strategy == CLOSEST_FIT:
+        # the smallest single batch that covers the order, served by the (product, expiry, quantity) index
+        fit = (await db.execute(
+            select(models.Batch.id, models.Batch.availableQuantity)
+            .filter(*filters, models.Batch.availableQuantity >= quantity)
+            .order_by(models.Batch.availableQuantity, *order)
+            .limit(1)
+        )).first()
+        if fit:
+            return [fit.id], fit.availableQuantity
+
+    ids = []
+    held = 0
+    last = None
+    while held < remaining:
+        query = (select(models.Batch.id, models.Batch.availableQuantity, *order[:-1])
+                 .filter(*filters)
+                 .order_by(*order)
+                 .limit(ALLOCATION_SCAN_SIZE))
+        if last:
+            query = query.filter(after_row(order, last))
+        rows = (await db.execute(query)).all()
+        for row in rows:
+            ids.append(row.id)
+            held += row.availableQuantity
+            if held >= remaining:
+                break
+        if len(rows) < ALLOCATION_SCAN_SIZE:
+            break
+        last = [getattr(rows[-1], column.key) for column in order]
+    return ids, held
+
+
+async def lock_batches(db, product_id, quantity, skip_locked, strategy=ALLOCATION_STRATEGY):
+    """
+    Locks batches of the product that cover quantity and takes it from them in the order of the strategy.
+    Skipping locked batches, it picks further batches until it has enough. Waiting for locked batches, it locks
+    everything in one statement, and if orders that committed meanwhile took what it waited for it rolls back
+    and picks again, so it never waits while holding locks taken earlier.
+    Returns [(batch_id, batch_name, quantity taken)], or None when there is not enough.
+    """
+    if skip_locked:
+        batches = []
+        seen = set()
+        while True:
+            locked = sum(batch[2] for _, _, batch in batches)
+            ids, _ = await pick_batches(db, product_id, quantity, quantity - locked, strategy, seen)
+            if not ids:
+                return None
+            seen.update(ids)
+            batches = sorted(batches + await lock_by_id(db, ids, True, strategy))
+            allocations = take_batches([batch for _, _, batch in batches], quantity, strategy)
+            if allocations is not None:
+                return allocations
+
+    for _ in range(ALLOCATION_ATTEMPTS):
+        ids, held = await pick_batches(db, product_id, quantity, quantity, strategy)
+        if held < quantity:
+            return None
+        batches = await lock_by_id(db, ids, False, strategy)
+        allocations = take_batches([batch for _, _, batch in batches], quantity, strategy)
+        if allocations is not None:
+            return allocations
+        await db.rollback()
+    return None
+
+
+async def allocate_batches(db, product_id, quantity, strategy=ALLOCATION_STRATEGY):
+    """
+    Splits quantity over the product's batches in the order of the strategy, the batch rows stay locked until commit.
+    Has to run before anything else is written in the transaction, it may roll back to wait for locked batches.
+    """
+    # batches locked by orders in flight are skipped, so concurrent orders spread over the batches without waiting
+    allocations = await lock_batches(db, product_id, quantity, True, strategy)
+    if allocations is None:
+        # what was skipped may still be enough, wait for it from a clean transaction
+        await db.rollback()
+        allocations = await lock_batches(db, product_id, quantity, False, strategy)
+        if allocations is None:
+            raise HTTPException(status_code=409, detail="Not enough available quantity to fulfill the order")
+    return allocations
+
+
+@asynccontextmanager
+async def allocated(db, product_id, quantity):
+    """
+    Picks the batches for an order from the in-memory index, locks just those rows to check them and takes the
+    quantity off them. Falls back to the locked scan of allocate_batches when the index can not cover the order or
+    was wrong. Where the database has no row locks another order can take the batches between the check and the
+    update, the scan is then run once more before the order is refused.
+    The body records the order and commits, the index is settled when it exits.
+    """
+    allocations = batch_index.reserve(product_id, quantity)
+    if allocations is not None:
+        # locked in id order, like every other allocation path
+        stored = dict((await db.execute(
+            select(models.Batch.id, models.Batch.availableQuantity)
+            .filter(models.Batch.id.in_([batch_id for batch_id, _, _ in allocations]))
+            .order_by(models.Batch.id)
+            .with_for_update()
+        )).all())
+        if (any(stored.get(batch_id, 0) < take for batch_id, _, take in allocations)
+                or not await take_from_batches(db, batch_totals([allocations]))):
+            batch_index.release(allocations)
+            allocations = None
+            await db.rollback()
+
+    reserved = allocations is not None
+    if not reserved:
+        for _ in range(1 + ALLOCATION_RETRIES):
+            allocations = await allocate_batches(db, product_id, quantity, batch_index.strategy)
+            if await take_from_batches(db, batch_totals([allocations])):
+                break
+            await db.rollback()
+        else:
+            raise HTTPException(status_code=409, detail="Batch quantities changed while allocating, retry the order")
+
+    try:
+        yield allocations
+    except BaseException:
+        if reserved:
+            batch_index.release(allocations)
+        raise
+
+    if reserved:
+        batch_index.confirm(allocations)
+    else:
+        # the index did not know this product or had it wrong
+        await batch_index.load(db, [product_id])
+
+
+async def lock_product_batches(db, product_ids, strategy=ALLOCATION_STRATEGY):
+    """
+    Locks the sellable batches of all the products in one statement, in id order.
+    Returns {product_id: [[batch_id, batch_name, available quantity]]} in the order of the strategy, for take_batches.
+    """
+    batch_ids = (await db.execute(
+        select(models.Batch.id).filter(*sellable_batches(models.Batch.product_id.in_(product_ids)))
+    )).scalars().all()
+    batches = {}
+    for product_id, _, batch in await lock_by_id(db, batch_ids, False, strategy):
+        batches.setdefault(product_id, []).append(batch)
+    return batches
+
+
+def take_batches(batches, quantity, strategy=ALLOCATION_STRATEGY):
+    """
+    Takes quantity from the locked batches in the order they were locked, in memory. Returns the allocations,
+    or None and leaves the batches untouched when they do not cover quantity.
+    """
+    if sum(available for _, _, available in batches) < quantity:
+        return None
+    if strategy == CLOSEST_FIT:
+        fits = [batch for batch in batches if batch[2] >= quantity]
+        if fits:
+            # min keeps the first of equal batches, the first to expire
+            batch = min(fits, key=lambda fit: fit[2])
+            batch[2] -= quantity
+            return [(batch[0], batch[1], quantity)]
+    allocations = []
+    remaining = quantity
+    for batch in batches:
+        if remaining == 0:
+            break
+        take = min(batch[2], remaining)
+        if take:
+            batch[2] -= take
+            remaining -= take
+            allocations.append((batch[0], batch[1], take))
+    return allocations
+
+
+def batch_totals(allocation_lists):
+    """
+    {batch_id: quantity taken} over lists of (batch_id, batch_name, quantity) allocations
+    """
+    taken = {}
+    for allocations in allocation_lists:
+        for batch_id, _, quantity in allocations:
+            taken[batch_id] = taken.get(batch_id, 0) + quantity
+    return taken
+
+
+async def take_from_batches(db, taken):
+    """
+    Takes {batch_id: quantity} off the batches with one UPDATE. Returns False when a batch no longer held its
+    quantity, the caller rolls back what the other batches gave.
+    """
+    if not taken:
+        return True
+    result = await db.execute(
+        update(models.Batch)
+        .where(models.Batch.id.in_(taken.keys()),
+               # holds even where the database has no row locks
+               models.Batch.availableQuantity >= case(taken, value=models.Batch.id))
+        .values(availableQuantity=models.Batch.availableQuantity - case(taken, value=models.Batch.id))
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == len(taken)
+
+
+async def record_allocations(db, order_allocations):
+    """
+    Records {order_id: [(batch_id, batch_name, quantity)]} with one Order_has_Batch insert
+    """
+    rows = [{"Order_id": order_id, "Batch_id": batch_id, "quantity": quantity}
+            for order_id, allocations in order_allocations.items()
+            for batch_id, _, quantity in allocations]
+    if rows:
+        await db.execute(insert(models.OrderHasBatch), rows)
+
+
+async def apply_allocations(db, order_allocations):
+    """
+    Writes {order_id: [(batch_id, batch_name, quantity)]}: one UPDATE of the batches and one Order_has_Batch insert
+    """
+    if not await take_from_batches(db, batch_totals(order_allocations.values())):
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Batch quantities changed while allocating, retry the order")
+    await record_allocations(db, order_allocations)
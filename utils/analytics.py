@@ -0,0 +1,107 @@
+from datetime import date, timedelta
+
+from sqlalchemy import select, insert, delete, func, literal
+
+from models import models
+from utils.stock import BATCH_CONSUMPTION, increment_upsert
+
+# Daily_Rollup metrics, keyed by product, ingredient or 0 for totals
+BATCHES_PRODUCED = "batches_produced"  # per product
+INGREDIENT_CONSUMED = "ingredient_consumed"  # per ingredient
+GRNS_ISSUED = "grns_issued"  # total
+GRN_QUANTITY = "grn_quantity"  # per ingredient
+ORDERS_PLACED = "orders_placed"  # per product
+ORDERED_QUANTITY = "ordered_quantity"  # per product
+METRICS = (BATCHES_PRODUCED, INGREDIENT_CONSUMED, GRNS_ISSUED, GRN_QUANTITY, ORDERS_PLACED, ORDERED_QUANTITY)
+
+
+def rollup_rows(metric, day: date, values):
+    """
+    Daily_Rollup rows adding {key_id: value} to metric on day, values of 0 are left out
+    """
+    return [{"metric": metric, "day": day, "key_id": key_id, "value": value}
+            for key_id, value in values.items() if value]
+
+
+async def add_to_rollups(db, rows):
+    """
+    Folds the rows into Daily_Rollup with one increment upsert, called in the same transaction as the write
+    """
+    merged = {}
+    for row in rows:
+        key = (row["metric"], row["day"], row["key_id"])
+        merged[key] = merged.get(key, 0) + row["value"]
+    await increment_upsert(db, models.DailyRollup, ["metric", "day", "key_id"], "value", [
+        {"metric": metric, "day": day, "key_id": key_id, "value": value}
+        for (metric, day, key_id), value in merged.items() if value
+    ])
+
+
+def bucket_start(day: date, bucket: str) -> date:
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+async def read_rollup(db, metric, date_from: date, date_to: date, bucket="day", key_id=None):
+    """
+    Series of {bucket, key_id, value} for metric, weeks and months are summed from the daily rows
+    """
+    query = (select(models.DailyRollup.day, models.DailyRollup.key_id, models.DailyRollup.value)
+             .filter(models.DailyRollup.metric == metric,
+                     models.DailyRollup.day >= date_from,
+                     models.DailyRollup.day <= date_to,
+                     # rows an update has brought back to zero
+                     models.DailyRollup.value != 0)
+             .order_by(models.DailyRollup.day, models.DailyRollup.key_id))
+    if key_id is not None:
+        query = query.filter(models.DailyRollup.key_id == key_id)
+
+    series = {}
+    for day, row_key, value in await db.execute(query):
+        key = (bucket_start(day, bucket), row_key)
+        series[key] = series.get(key, 0) + value
+    return [{"bucket": start, "key_id": row_key, "value": value} for (start, row_key), value in series.items()]
+
+
+async def rebuild_rollups(db):
+    """
+    Recomputes every rollup from the raw tables, for history written before the rollups existed
+    """
+    sources = {
+        BATCHES_PRODUCED: select(func.date(models.Batch.productionDate), models.Batch.product_id,
+                                 func.count(models.Batch.id))
+        .filter(models.Batch.product_id.isnot(None))
+        .group_by(func.date(models.Batch.productionDate), models.Batch.product_id),
+        INGREDIENT_CONSUMED: select(func.date(models.StockMovement.effectiveAt), models.StockMovement.Ingredient_id,
+                                    -func.sum(models.StockMovement.quantity))
+        .filter(models.StockMovement.type == BATCH_CONSUMPTION)
+        .group_by(func.date(models.StockMovement.effectiveAt), models.StockMovement.Ingredient_id),
+        GRNS_ISSUED: select(func.date(models.GRN.issuedDate), literal(0), func.count(models.GRN.id))
+        .group_by(func.date(models.GRN.issuedDate)),
+        GRN_QUANTITY: select(func.date(models.GRN.issuedDate), models.GRN_has_Ingredient.Ingredient_id,
+                             func.sum(models.GRN_has_Ingredient.currentQuantity))
+        .join(models.GRN_has_Ingredient, models.GRN_has_Ingredient.GRN_id == models.GRN.id)
+        .group_by(func.date(models.GRN.issuedDate), models.GRN_has_Ingredient.Ingredient_id),
+        # orders placed before createdAt existed have no date and are left out
+        ORDERS_PLACED: select(func.date(models.Order.createdAt), models.Order.Product_id, func.count(models.Order.id))
+        .filter(models.Order.createdAt.isnot(None), models.Order.Product_id.isnot(None))
+        .group_by(func.date(models.Order.createdAt), models.Order.Product_id),
+        ORDERED_QUANTITY: select(func.date(models.Order.createdAt), models.Order.Product_id,
+                                 func.sum(models.Order.quantity))
+        .filter(models.Order.createdAt.isnot(None), models.Order.Product_id.isnot(None))
+        .group_by(func.date(models.Order.createdAt), models.Order.Product_id),
+    }
+
+    await db.execute(delete(models.DailyRollup))
+    for metric, source in sources.items():
+        rows = source.subquery()
+        day, key_id, value = rows.c
+        await db.execute(
+            insert(models.DailyRollup).from_select(
+                ["metric", "day", "key_id", "value"],
+                select(literal(metric), day, key_id, value)
+            )
+        )
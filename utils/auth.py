@@ -5,23 +5,24 @@ from fastapi.security import OAuth2PasswordBearer
 
 from jose import jwt
 from pydantic import ValidationError
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models.models
-from utils.database import SessionLocal
+from utils.database import AsyncSessionLocal
 from utils.util import JWT_ALGORITHM, JWT_SECRET
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # annotation for dependency injection
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 reuseable_oauth = OAuth2PasswordBearer(
     tokenUrl="/login",
@@ -51,7 +52,9 @@ async def get_current_user(db: db_dependency, token: str = Depends(reuseable_oau
 
     print('payload sub: ', payload['sub'])
     # extract user
-    user = db.query(models.models.User).filter(models.models.User.username == payload['sub']).first()
+    user = (await db.execute(
+        select(models.models.User).filter(models.models.User.username == payload['sub'])
+    )).scalars().first()
     # user: Union[dict[str, Any], None] = db_dependency.get(payload['sub'], None)
 
     if user is None:
@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import logging
+from bisect import bisect_left, insort
+from itertools import islice
+
+from decouple import config
+from sqlalchemy import select
+
+from models import models
+from utils.database import AsyncSessionLocal
+from utils.search import fold
+
+logger = logging.getLogger(__name__)
+
+# seconds between rebuilds from the database, bounds how long names written by other workers are missed
+AUTOCOMPLETE_REFRESH = config('AUTOCOMPLETE_REFRESH', default=300, cast=int)
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# what /autocomplete completes, by the type it reports
+AUTOCOMPLETE_MODELS = {
+    "ingredient": models.Ingredient,
+    "product": models.Product,
+    "recipe": models.Recipe,
+    "location": models.Location,
+}
+
+
+def name_keys(name):
+    """
+    A name is found from the start of any of its words: "pale malt" has the keys "pale malt" and "malt"
+    """
+    words = fold(name).split()
+    return [" ".join(words[start:]) for start in range(len(words))]
+
+
+class PrefixIndex:
+    """
+    Names of one table as a sorted array of (key, name, id), a prefix is a binary search to the first key
+    starting with it and a walk forward, O(log n) plus the number of names returned.
+    """
+
+    def __init__(self):
+        self._entries = []  # sorted (key, name, id)
+        self._names = {}  # id -> name, to find the entries of a renamed or deleted row
+
+    @classmethod
+    def build(cls, rows):
+        index = cls()
+        index._names = {row_id: name for row_id, name in rows if name}
+        index._entries = sorted((key, name, row_id) for row_id, name in index._names.items()
+                                for key in name_keys(name))
+        return index
+
+    def add(self, row_id, name):
+        if self._names.get(row_id) == name:
+            return
+        self.remove(row_id)
+        if name:
+            self._names[row_id] = name
+            for key in name_keys(name):
+                insort(self._entries, (key, name, row_id))
+
+    def remove(self, row_id):
+        name = self._names.pop(row_id, None)
+        if name is None:
+            return
+        for key in name_keys(name):
+            position = bisect_left(self._entries, (key, name, row_id))
+            if position < len(self._entries) and self._entries[position] == (key, name, row_id):
+                del self._entries[position]
+
+    def complete(self, prefix):
+        """
+        Yields (key, name, id) for every key starting with prefix, in key order.
+        A name that matches from more than one of its words comes once per word.
+        """
+        entries = self._entries
+        position = bisect_left(entries, (prefix,))
+        while position < len(entries) and entries[position][0].startswith(prefix):
+            yield entries[position]
+            position += 1
+
+    def __len__(self):
+        return len(self._names)
+
+
+class Autocomplete:
+    """
+    Typeahead over the names in AUTOCOMPLETE_MODELS, answered from memory without touching the database.
+    Built at startup and every AUTOCOMPLETE_REFRESH seconds by run_autocomplete_refresh,
+    the routes that write these names update it as they commit.
+    """
+
+    def __init__(self):
+        self._indexes = None  # type -> PrefixIndex
+        self._changes = None  # writes made while a rebuild reads, replayed on the new indexes
+        self._building = None
+
+    def add(self, kind, row_id, name):
+        """
+        Called after a name is committed
+        """
+        if self._indexes is not None:
+            self._indexes[kind].add(row_id, name)
+        if self._changes is not None:
+            self._changes.append((kind, row_id, name))
+
+    def remove(self, kind, row_id):
+        self.add(kind, row_id, None)
+
+    async def complete(self, query, kinds=None, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Up to limit names of the given types with a word starting query, as [{type, id, name}] ordered by the
+        matched words. Waits for the first build when the app started without it.
+        """
+        prefix = " ".join(fold(query).split())
+        if not prefix:
+            return []
+        if self._indexes is None:
+            await self.load()
+
+        def matches(kind):
+            seen = set()
+            for key, name, row_id in self._indexes[kind].complete(prefix):
+                if row_id not in seen:
+                    seen.add(row_id)
+                    yield key, name, kind, row_id
+
+        return [{"type": kind, "id": row_id, "name": name}
+                for _, name, kind, row_id in islice(heapq.merge(*(matches(kind) for kind in kinds or self._indexes)),
+                                                    limit)]
+
+    async def load(self):
+        """
+        Rebuilds every index from the database, concurrent callers wait for the same build
+        """
+        if self._building is None:
+            self._building = asyncio.create_task(self._rebuild())
+        await asyncio.shield(self._building)
+
+    async def _rebuild(self):
+        self._changes = []
+        try:
+            rows = {}
+            async with AsyncSessionLocal() as db:
+                for kind, model in AUTOCOMPLETE_MODELS.items():
+                    rows[kind] = (await db.execute(select(model.id, model.name))).all()
+            # off the event loop, a large table takes seconds to sort
+            indexes = {kind: await asyncio.to_thread(PrefixIndex.build, kind_rows) for kind, kind_rows in rows.items()}
+            for kind, row_id, name in self._changes:
+                indexes[kind].add(row_id, name)
+            self._indexes = indexes
+        finally:
+            self._changes = None
+            self._building = None
+
+    def stats(self):
+        if self._indexes is None:
+            return {"loaded": False}
+        return {"loaded": True, **{kind: len(index) for kind, index in self._indexes.items()}}
+
+
+autocomplete = Autocomplete()
+
+
+async def run_autocomplete_refresh():
+    """
+    Background task started with the app, builds the autocomplete indexes at startup and then every
+    AUTOCOMPLETE_REFRESH seconds
+    """
+    while True:
+        try:
+            await autocomplete.load()
+        except Exception:
+            logger.exception("Autocomplete rebuild failed")
+        await asyncio.sleep(AUTOCOMPLETE_REFRESH)
@@ -0,0 +1,220 @@
+import heapq
+import logging
+from datetime import date
+
+from decouple import config
+from sqlalchemy import select
+
+from models import models
+
+logger = logging.getLogger(__name__)
+
+# order allocation strategies: oldest batch first, first to expire first, or the one batch closest to the
+# ordered quantity (first to expire first when no single batch covers it)
+FIFO = "fifo"
+FEFO = "fefo"
+CLOSEST_FIT = "closest_fit"
+ALLOCATION_STRATEGIES = (FIFO, FEFO, CLOSEST_FIT)
+ALLOCATION_STRATEGY = config('ORDER_ALLOCATION_STRATEGY', default=FIFO)
+if ALLOCATION_STRATEGY not in ALLOCATION_STRATEGIES:
+    raise ValueError("ORDER_ALLOCATION_STRATEGY must be one of: " + ", ".join(ALLOCATION_STRATEGIES))
+
+
+def batch_sort_key(strategy, production_date, expiry, batch_id):
+    """
+    Order batches are drawn in, closest fit falls back to first to expire first
+    """
+    if strategy == FIFO:
+        return production_date, batch_id
+    return expiry, production_date, batch_id
+
+
+class BatchIndex:
+    """
+    In-process view of the sellable batches, one heap per product in the order of the allocation strategy.
+    Orders pick their batches here in O(log n) and only go to the database to lock and write them,
+    closest fit looks at every batch of the product for a single batch that covers the order.
+    The database stays the source of truth: picks are checked under the row lock, and the index is
+    reloaded from it at startup, after every expiry sweep and for any product where it was found wrong.
+    """
+
+    def __init__(self, strategy=ALLOCATION_STRATEGY):
+        self.strategy = strategy
+        self._heaps = {}  # product_id -> heap of (sort key, batch_id)
+        self._batches = {}  # batch_id -> [product_id, name, available, dateOfExpiry, productionDate, in heap]
+        self._reserved = {}  # batch_id -> quantity picked by orders that have not committed yet
+        self._loaded = set()  # products loaded from the database
+        self._complete = False  # every product is loaded
+
+    def _is_loaded(self, product_id):
+        return self._complete or product_id in self._loaded
+
+    def _put(self, batch_id, product_id, name, available, expiry, production_date):
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            batch = self._batches[batch_id] = [product_id, name, available, expiry, production_date, False]
+        else:
+            batch[2] = available
+        if available > 0 and not batch[5]:
+            heapq.heappush(self._heaps.setdefault(product_id, []),
+                           (batch_sort_key(self.strategy, production_date, expiry, batch_id), batch_id))
+            batch[5] = True
+
+    def add_batch(self, batch):
+        """
+        Called after a batch is committed
+        """
+        if self._is_loaded(batch.product_id):
+            self._put(batch.id, batch.product_id, batch.name, batch.availableQuantity,
+                      batch.dateOfExpiry, batch.productionDate)
+
+    def reserve(self, product_id, quantity, today=None):
+        """
+        Picks batches in the order of the strategy and takes quantity off them in the index.
+        Returns [(batch_id, batch_name, quantity)], or None when the index can not cover the order.
+        """
+        if not self._is_loaded(product_id):
+            return None
+        today = today or date.today()
+        heap = self._heaps.get(product_id, [])
+        picked = []
+        allocations = []
+        remaining = quantity
+        if self.strategy == CLOSEST_FIT:
+            fit = self._closest_fit(heap, quantity, today)
+            if fit is not None:
+                allocations.append((fit, self._batches[fit][1], quantity))
+                remaining = 0
+        while heap and remaining > 0:
+            entry = heapq.heappop(heap)
+            batch = self._batches.get(entry[1])
+            if batch is None or batch[3] < today:
+                # expired since it was indexed
+                self._batches.pop(entry[1], None)
+                continue
+            if batch[2] <= 0:
+                batch[5] = False
+                continue
+            picked.append(entry)
+            take = min(batch[2], remaining)
+            allocations.append((entry[1], batch[1], take))
+            remaining -= take
+        for entry in picked:
+            heapq.heappush(heap, entry)
+        if remaining > 0:
+            return None
+
+        for batch_id, _, take in allocations:
+            self._batches[batch_id][2] -= take
+            self._reserved[batch_id] = self._reserved.get(batch_id, 0) + take
+        return allocations
+
+    def _closest_fit(self, heap, quantity, today):
+        best = None
+        for key, batch_id in heap:
+            batch = self._batches.get(batch_id)
+            if batch is None or batch[3] < today or batch[2] < quantity:
+                continue
+            # the smallest batch that covers the order, the first to expire among equals
+            if best is None or (batch[2], key) < best[0]:
+                best = ((batch[2], key), batch_id)
+        return best[1] if best else None
+
+    def release(self, allocations):
+        """
+        Gives back what reserve took, for an order that did not commit
+        """
+        for batch_id, _, take in allocations:
+            self._unreserve(batch_id, take)
+            batch = self._batches.get(batch_id)
+            if batch is not None:
+                self._put(batch_id, batch[0], batch[1], batch[2] + take, batch[3], batch[4])
+
+    def confirm(self, allocations):
+        """
+        The order committed, its reservation is now in the database
+        """
+        for batch_id, _, take in allocations:
+            self._unreserve(batch_id, take)
+
+    def consume(self, allocations):
+        """
+        Takes off quantities committed without a reservation, e.g. by a bulk order
+        """
+        for batch_id, _, take in allocations:
+            batch = self._batches.get(batch_id)
+            if batch is not None:
+                batch[2] -= take
+
+    def _unreserve(self, batch_id, take):
+        left = self._reserved.get(batch_id, 0) - take
+        if left > 0:
+            self._reserved[batch_id] = left
+        else:
+            self._reserved.pop(batch_id, None)
+
+    async def load(self, db, product_ids=None):
+        """
+        Reloads the sellable batches of the products, or of every product, from the database.
+        Quantities reserved by orders in flight are kept off. Returns how many batches the index had wrong.
+        """
+        query = (select(models.Batch.id, models.Batch.product_id, models.Batch.name, models.Batch.availableQuantity,
+                        models.Batch.dateOfExpiry, models.Batch.productionDate)
+                 .filter(models.Batch.expired == False,
+                         models.Batch.dateOfExpiry >= date.today(),
+                         models.Batch.availableQuantity > 0))
+        if product_ids is not None:
+            query = query.filter(models.Batch.product_id.in_(product_ids))
+        rows = (await db.execute(query)).all()
+        return self.replace(rows, product_ids)
+
+    def replace(self, rows, product_ids=None):
+        """
+        Swaps in rows of (id, product_id, name, availableQuantity, dateOfExpiry, productionDate) for the products,
+        or for every product. Returns how many batches the index had wrong.
+        """
+        stored = {row.id: (row.product_id, row.availableQuantity - self._reserved.get(row.id, 0)) for row in rows}
+        indexed = {batch_id: (batch[0], batch[2]) for batch_id, batch in self._batches.items()
+                   if batch[2] > 0 and (product_ids is None or batch[0] in product_ids)}
+        # only products the index already held can be wrong
+        wrong = sum(1 for batch_id in stored.keys() | indexed.keys()
+                    if self._is_loaded((stored.get(batch_id) or indexed.get(batch_id))[0])
+                    and stored.get(batch_id, (None, 0))[1] != indexed.get(batch_id, (None, 0))[1])
+
+        if product_ids is None:
+            self._heaps = {}
+            self._batches = {}
+        else:
+            for product_id in product_ids:
+                self._heaps.pop(product_id, None)
+            for batch_id in [batch_id for batch_id, batch in self._batches.items() if batch[0] in product_ids]:
+                del self._batches[batch_id]
+        for row in rows:
+            self._put(row.id, row.product_id, row.name, stored[row.id][1], row.dateOfExpiry, row.productionDate)
+
+        if product_ids is None:
+            self._complete = True
+        else:
+            self._loaded.update(product_ids)
+        return wrong
+
+    def stats(self):
+        return {
+            "products": len(self._heaps),
+            "batches": sum(1 for batch in self._batches.values() if batch[2] > 0),
+            "reservedBatches": len(self._reserved),
+            "complete": self._complete,
+        }
+
+
+batch_index = BatchIndex()
+
+
+async def check_batch_index(db):
+    """
+    Loads every product into the index and logs how many batches it had wrong, run at startup and after sweeps
+    """
+    wrong = await batch_index.load(db)
+    if wrong:
+        logger.warning(f"Batch index was out of step with the database on {wrong} batches, reloaded")
+    return wrong
@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+from utils.events import dashboard_events, stock_events
+
+# seconds a cached /dashboard response is served before the counts are read again
+DASHBOARD_CACHE_TTL = config('DASHBOARD_CACHE_TTL', default=30, cast=int)
+# built recipe documents kept per process, writes here drop them at once, the TTL bounds what other workers serve
+RECIPE_CACHE_SIZE = config('RECIPE_CACHE_SIZE', default=1024, cast=int)
+RECIPE_CACHE_TTL = config('RECIPE_CACHE_TTL', default=300, cast=int)
+
+
+class Cache:
+    """
+    In-process cache with an optional TTL and an optional LRU size bound, keeps hit and miss counts.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._fresh(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        if self.maxsize and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def update(self, key, change):
+        """
+        Applies change(value) to a cached value in place of dropping it, does nothing when key is not cached
+        """
+        entry = self._fresh(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], change(entry[1]))
+
+    def invalidate(self, key=None):
+        """
+        Drops one key, or everything when no key is given
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+dashboard_cache = Cache(ttl=DASHBOARD_CACHE_TTL)
+# "ingredients" -> {Ingredient.id: /ingredient/all row}, the snapshot of /ingredient/stream
+stock_cache = Cache(ttl=DASHBOARD_CACHE_TTL)
+# ("recipe", id) -> /recipe/view document, "all" -> /recipe/view_all document
+recipe_cache = Cache(ttl=RECIPE_CACHE_TTL, maxsize=RECIPE_CACHE_SIZE)
+
+
+def count_on_dashboard(counter, by=1):
+    """
+    Called by write paths after commit, keeps the cached dashboard counts in step without reading them again
+    and pushes the change to the live dashboard listeners
+    """
+    if by:
+        dashboard_cache.update("dashboard", lambda data: {**data, counter: data[counter] + by})
+        dashboard_events.publish({"type": "delta", "changes": {counter: by}})
+
+
+def stock_changed(changes):
+    """
+    Called after commit with what the committed movements added to each ingredient, {ingredient_id: quantity},
+    keeps the cached ingredient rows in step and pushes the change to the stock listeners
+    """
+    def add(rows):
+        for ingredient_id, quantity in changes.items():
+            if ingredient_id in rows:
+                rows[ingredient_id] = {**rows[ingredient_id],
+                                       "totalQuantity": rows[ingredient_id]["totalQuantity"] + quantity}
+        return rows
+
+    if changes:
+        stock_cache.update("ingredients", add)
+        stock_events.publish({"type": "delta", "changes": changes})
+
+
+def ingredients_changed():
+    """
+    Called after commit when an ingredient is added or renamed, stock listeners read the rows again
+    """
+    stock_cache.invalidate("ingredients")
+    stock_events.publish({"type": "resync"})
+
+
+def forget_recipes(recipe_ids):
+    """
+    Called by write paths after commit with the recipes whose documents changed
+    """
+    for recipe_id in recipe_ids:
+        recipe_cache.invalidate(("recipe", recipe_id))
+    if recipe_ids:
+        recipe_cache.invalidate("all")
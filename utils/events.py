@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+# events a subscriber can fall behind by before it is told to resync
+EVENT_QUEUE_SIZE = 256
+# seconds between keep-alive comments on an idle event stream
+STREAM_KEEPALIVE = 15
+
+
+class EventBus:
+    """
+    In-process publish/subscribe, every subscriber gets its own bounded queue.
+    publish never waits and never touches the database, so one write fans out to any number of listeners.
+    """
+
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # a listener that can not keep up drops its backlog and starts again from a snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+# {"type": "delta", "changes": {counter: by}} for the dashboard counts
+dashboard_events = EventBus()
+# {"type": "delta", "changes": {ingredient_id: quantity}} for every committed stock movement
+stock_events = EventBus()
+
+
+def server_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def delta_stream(bus, read_snapshot):
+    """
+    Server-sent events for a subscriber of bus: a snapshot event from read_snapshot(), then a delta event
+    for every delta published, and a new snapshot whenever the subscriber fell behind. Deltas are {key: number}
+    and are summed when several are waiting.
+    The subscription is taken when the stream starts and dropped when it ends, a response that is never sent
+    never subscribes.
+    """
+    # subscribed before the snapshot is read, so no delta falls in between
+    queue = bus.subscribe()
+    try:
+        yield server_event("snapshot", await read_snapshot())
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event["type"] == "resync":
+                yield server_event("snapshot", await read_snapshot())
+                continue
+
+            # deltas that queued up while the client was being written to go out as one event
+            changes = dict(event["changes"])
+            while not queue.empty():
+                event = queue.get_nowait()
+                if event["type"] != "delta":
+                    break
+                for key, by in event["changes"].items():
+                    changes[key] = changes.get(key, 0) + by
+            yield server_event("delta", changes)
+            if event["type"] == "resync":
+                yield server_event("snapshot", await read_snapshot())
+    finally:
+        bus.unsubscribe(queue)
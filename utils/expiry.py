@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from datetime import date
+
+from decouple import config
+from sqlalchemy import select, update, func, insert
+
+from models import models
+from utils.batch_index import check_batch_index
+from utils.cache import count_on_dashboard
+from utils.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_BATCHES_COUNTER = 'expiredBatches'
+# seconds between two sweeps
+EXPIRY_SWEEP_INTERVAL = config('EXPIRY_SWEEP_INTERVAL', default=3600, cast=int)
+
+
+async def sweep_expired_batches(db) -> int:
+    """
+    Marks every batch past its expiry date as expired and writes off its available quantity.
+    Keeps the expiredBatches counter in step in the same transaction. Returns the number of batches swept.
+    """
+    result = await db.execute(
+        update(models.Batch)
+        .where(models.Batch.expired == False, models.Batch.dateOfExpiry < date.today())
+        # MySQL applies SET left to right, the write-off has to read availableQuantity before it is cleared
+        .ordered_values(
+            (models.Batch.writtenOffQuantity, models.Batch.availableQuantity),
+            (models.Batch.availableQuantity, 0),
+            (models.Batch.expired, True),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    swept = result.rowcount
+
+    counter = await db.execute(
+        update(models.Counter)
+        .where(models.Counter.name == EXPIRED_BATCHES_COUNTER)
+        .values(value=models.Counter.value + swept)
+    )
+    if counter.rowcount == 0:
+        # first sweep, start the counter from what is already flagged
+        total = (await db.execute(
+            select(func.count(models.Batch.id)).filter(models.Batch.expired == True)
+        )).scalar()
+        await db.execute(insert(models.Counter).values(name=EXPIRED_BATCHES_COUNTER, value=total))
+
+    await db.commit()
+    return swept
+
+
+def expired_batch_count():
+    """
+    Scalar expression for the expired batch count, the maintained counter or the index before the first sweep
+    """
+    return func.coalesce(
+        select(models.Counter.value)
+        .filter(models.Counter.name == EXPIRED_BATCHES_COUNTER)
+        .scalar_subquery(),
+        select(func.count(models.Batch.id))
+        .filter(models.Batch.expired == True)
+        .scalar_subquery()
+    )
+
+
+async def run_expiry_sweeper():
+    """
+    Background task started with the app, sweeps once at startup and then every EXPIRY_SWEEP_INTERVAL seconds.
+    The first run also loads the batch index and checks it against the database.
+    """
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                swept = await sweep_expired_batches(db)
+                # expired batches leave the index, and anything it got wrong since the last sweep is corrected
+                await check_batch_index(db)
+            count_on_dashboard("expiredBatches", swept)
+            if swept:
+                logger.info(f"Expiry sweeper marked {swept} batches as expired")
+        except Exception:
+            logger.exception("Expiry sweep failed")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
@@ -0,0 +1,80 @@
+"""
+Schema changes to tables that already existed before a column or index was added to the model.
+create_all only creates missing tables, so these are applied at startup after it, or by hand with
+
+    python -m utils.migrations
+
+Every step checks the live schema first and is skipped once applied.
+"""
+import logging
+
+from sqlalchemy import inspect, text, update
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from models import models
+
+logger = logging.getLogger(__name__)
+
+# (table, columns added to it, indexes added to it), in the order they shipped
+SCHEMA_CHANGES = [
+    (models.Batch.__table__,
+     ["expired", "writtenOffQuantity"],
+     ["ix_Batch_productionDate_id", "ix_Batch_expired_dateOfExpiry", "ix_Batch_product_productionDate",
+      "ix_Batch_product_dateOfExpiry_available"]),
+    (models.GRN.__table__, [], ["ix_GRN_issuedDate_id"]),
+    # orders placed before it keep a NULL createdAt, the analytics leave them out
+    (models.Order.__table__, ["createdAt"], ["ix_order_createdAt"]),
+    # FULLTEXT ngram on MySQL, a plain index elsewhere, as create_all makes them
+    (models.Recipe.__table__, [], ["ft_Recipe_name"]),
+    (models.Product.__table__, [], ["ft_Product_name"]),
+    (models.User.__table__, [], ["ft_User_name"]),
+    (models.Ingredient.__table__, [], ["ft_Ingredient_name"]),
+    (models.StockMovement.__table__,
+     ["effectiveAt"],
+     ["ix_Stock_Movement_effectiveAt", "ix_Stock_Movement_Ingredient_id_effectiveAt"]),
+]
+
+# fills a column for the rows that were there before it was added
+COLUMN_BACKFILLS = {
+    ("Stock_Movement", "effectiveAt"): update(models.StockMovement)
+    .where(models.StockMovement.effectiveAt.is_(None))
+    .values(effectiveAt=models.StockMovement.createdAt),
+}
+
+
+def migrate(engine):
+    """
+    Adds the columns and indexes of SCHEMA_CHANGES that the database does not have yet, returns how many
+    """
+    applied = 0
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        preparer = connection.dialect.identifier_preparer
+        for table, columns, indexes in SCHEMA_CHANGES:
+            if not inspector.has_table(table.name):
+                # create_all made it with everything
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for name in columns:
+                if name not in existing_columns:
+                    column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+                    connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column}"))
+                    if (table.name, name) in COLUMN_BACKFILLS:
+                        connection.execute(COLUMN_BACKFILLS[(table.name, name)])
+                    logger.info(f"Added column {table.name}.{name}")
+                    applied += 1
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for name in indexes:
+                if name not in existing_indexes:
+                    index = next(index for index in table.indexes if index.name == name)
+                    connection.execute(CreateIndex(index))
+                    logger.info(f"Created index {name} on {table.name}")
+                    applied += 1
+    return applied
+
+
+if __name__ == "__main__":
+    from utils.database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    print(f"{migrate(engine)} schema changes applied")
@@ -0,0 +1,66 @@
+import base64
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import or_, and_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    """
+    Builds an opaque cursor from the sort key of the last row in a page
+    """
+    raw = f"{sort_value.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        sort_value, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_after(sort_column, id_column, cursor: str, descending: bool = True):
+    """
+    Filter for the rows that come after the cursor when ordering by (sort_column, id_column)
+    """
+    sort_value, row_id = decode_cursor(cursor)
+    if descending:
+        return or_(sort_column < sort_value, and_(sort_column == sort_value, id_column < row_id))
+    return or_(sort_column > sort_value, and_(sort_column == sort_value, id_column > row_id))
+
+
+def encode_id_cursor(row_id: int) -> str:
+    """
+    Cursor for lists paginated on the primary key alone
+    """
+    return base64.urlsafe_b64encode(str(row_id).encode()).decode()
+
+
+def id_after(id_column, cursor: str, descending: bool = True):
+    try:
+        row_id = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return id_column < row_id if descending else id_column > row_id
+
+
+def encode_offset_cursor(offset: int) -> str:
+    """
+    Cursor for ranked lists, whose order has no column to keyset on
+    """
+    return base64.urlsafe_b64encode(f"@{offset}".encode()).decode()
+
+
+def decode_offset_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        if not raw.startswith("@") or int(raw[1:]) < 0:
+            raise ValueError(raw)
+        return int(raw[1:])
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def max_batches_per_recipe(recipe_ids, ingredient_ids, quantities, stock):
+    """
+    Computes how many batches of every recipe the current stock can make.
+
+    recipe_ids, ingredient_ids, quantities: one entry per Recipe_has_Ingredient line
+    stock: {ingredient_id: current_quantity}
+    returns {recipe_id: (max_batches, limiting_ingredient_id)}
+    """
+    recipe_ids = np.asarray(recipe_ids, dtype=np.int64)
+    ingredient_ids = np.asarray(ingredient_ids, dtype=np.int64)
+    quantities = np.asarray(quantities, dtype=np.int64)
+
+    # lines with no quantity do not limit anything
+    used = quantities > 0
+    recipe_ids, ingredient_ids, quantities = recipe_ids[used], ingredient_ids[used], quantities[used]
+    if not len(recipe_ids):
+        return {}
+
+    # stock vector over the ingredients that appear in recipes, missing stock rows count as 0
+    unique_ingredients, ingredient_index = np.unique(ingredient_ids, return_inverse=True)
+    stock_vector = np.array([stock.get(ingredient_id, 0) for ingredient_id in unique_ingredients.tolist()],
+                            dtype=np.int64)
+
+    # batches every single line allows, the recipe is limited by its smallest one
+    line_batches = np.maximum(stock_vector[ingredient_index], 0) // quantities
+
+    # sort by recipe then by batches so the first line of each recipe is its limiting ingredient
+    order = np.lexsort((line_batches, recipe_ids))
+    sorted_recipes = recipe_ids[order]
+    first_of_recipe = np.ones(len(order), dtype=bool)
+    first_of_recipe[1:] = sorted_recipes[1:] != sorted_recipes[:-1]
+    limiting = order[first_of_recipe]
+
+    return dict(zip(recipe_ids[limiting].tolist(),
+                    zip(line_batches[limiting].tolist(), ingredient_ids[limiting].tolist())))
+
+
+def explode_plan(line_recipes, line_batches, recipe_ids, ingredient_ids, quantities, stock):
+    """
+    Works out the ingredients a production plan needs.
+
+    line_recipes, line_batches: recipe and number of batches of every plan line
+    recipe_ids, ingredient_ids, quantities: one entry per Recipe_has_Ingredient line of those recipes
+    stock: {ingredient_id: current_quantity}
+    returns (ingredient ids, required, stock, shortfall, per line usage [line x ingredient],
+             first line at which the running total goes over stock or -1)
+    """
+    line_recipes = np.asarray(line_recipes, dtype=np.int64)
+    line_batches = np.asarray(line_batches, dtype=np.int64)
+    recipe_ids = np.asarray(recipe_ids, dtype=np.int64)
+    ingredient_ids = np.asarray(ingredient_ids, dtype=np.int64)
+    quantities = np.asarray(quantities, dtype=np.int64)
+
+    # recipe x ingredient matrix of quantities per batch
+    unique_recipes, recipe_index = np.unique(recipe_ids, return_inverse=True)
+    unique_ingredients, ingredient_index = np.unique(ingredient_ids, return_inverse=True)
+    per_batch = np.zeros((len(unique_recipes), len(unique_ingredients)), dtype=np.int64)
+    np.add.at(per_batch, (recipe_index, ingredient_index), quantities)
+
+    # plan lines whose recipe has no ingredient lines use nothing
+    known = np.isin(line_recipes, unique_recipes)
+    plan = np.zeros((len(line_recipes), len(unique_recipes)), dtype=np.int64)
+    plan[np.flatnonzero(known), np.searchsorted(unique_recipes, line_recipes[known])] = line_batches[known]
+
+    # line x ingredient usage, its column sums are the plan's requirement
+    usage = plan @ per_batch
+    required = usage.sum(axis=0)
+    stock_vector = np.array([stock.get(ingredient_id, 0) for ingredient_id in unique_ingredients.tolist()],
+                            dtype=np.int64)
+    shortfall = np.maximum(required - stock_vector, 0)
+
+    over = np.cumsum(usage, axis=0) > stock_vector
+    first_over = np.where(over.any(axis=0), over.argmax(axis=0), -1)
+    return unique_ingredients, required, stock_vector, shortfall, usage, first_over
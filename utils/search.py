@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import logging
+import time
+from array import array
+
+from decouple import config
+from sqlalchemy import select, func
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import DBAPIError
+
+from models import models
+from utils.database import AsyncSessionLocal
+from utils.pagination import DEFAULT_PAGE_SIZE, encode_offset_cursor, decode_offset_cursor
+
+logger = logging.getLogger(__name__)
+
+# seconds an in-process index is served before it is rebuilt, bounds how long names written by other workers are missed
+SEARCH_INDEX_REFRESH = config('SEARCH_INDEX_REFRESH', default=300, cast=int)
+# the server's ngram_token_size, shorter queries have no token to look up and are matched with LIKE
+MYSQL_NGRAM_TOKEN_SIZE = config('MYSQL_NGRAM_TOKEN_SIZE', default=2, cast=int)
+# MySQL error for MATCH on a column that has no FULLTEXT index
+NO_FULLTEXT_INDEX = 1191
+# the in-process index is keyed on trigrams, shorter queries check every name
+GRAM_SIZE = 3
+
+
+def fold(name):
+    return (name or "").casefold()
+
+
+def grams(folded):
+    return {folded[start:start + GRAM_SIZE] for start in range(len(folded) - GRAM_SIZE + 1)}
+
+
+def fulltext_match(name, query):
+    """
+    MySQL filter for the names containing query, the same matches as NgramIndex.search: a phrase of ngrams
+    answered by the FULLTEXT index, or a LIKE scan for a query shorter than an ngram
+    """
+    if len(query) < MYSQL_NGRAM_TOKEN_SIZE:
+        return name.contains(query, autoescape=True)
+    return mysql.match(name, against='"' + query.replace('"', ' ') + '"').in_boolean_mode()
+
+
+def fulltext_rank(name, row_id, query):
+    """
+    ORDER BY of rank_key in SQL, the ci collation compares without case
+    """
+    return name != query, func.locate(query, name), func.char_length(name), name, row_id
+
+
+def rank_key(folded, query, position, row_id):
+    """
+    Exact matches first, then prefix matches, then by how early the query appears, shorter names first
+    """
+    return folded != query, position, len(folded), folded, row_id
+
+
+class NgramIndex:
+    """
+    Substring search over the names of one table. Every trigram of a name points at the ids having it,
+    a query reads the ids under its least common trigram and checks just those names, so it costs what
+    matches rather than the size of the table. Postings are append-only, ids whose name changed or went
+    away fail that check and are cleaned out by the next rebuild.
+    """
+
+    def __init__(self):
+        self._names = {}  # id -> folded name
+        self._postings = {}  # trigram -> array of ids
+
+    @classmethod
+    def build(cls, rows):
+        index = cls()
+        for row_id, name in rows:
+            index.add(row_id, name)
+        return index
+
+    def add(self, row_id, name):
+        folded = fold(name)
+        old = self._names.get(row_id)
+        self._names[row_id] = folded
+        for gram in grams(folded) - (grams(old) if old else set()):
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = array('i')
+            posting.append(row_id)
+
+    def remove(self, row_id):
+        self._names.pop(row_id, None)
+
+    def search(self, query, offset=0, limit=DEFAULT_PAGE_SIZE, exclude=()):
+        """
+        Returns (number of names containing query, [ids of the page in rank order])
+        """
+        query = fold(query)
+        names = self._names
+        if len(query) < GRAM_SIZE:
+            matches = [rank_key(name, query, name.find(query), row_id)
+                       for row_id, name in names.items() if query in name and row_id not in exclude]
+        else:
+            postings = [self._postings.get(gram) for gram in grams(query)]
+            if not all(postings):
+                return 0, []
+            matches = []
+            for row_id in set(min(postings, key=len)):
+                name = names.get(row_id)
+                position = name.find(query) if name is not None else -1
+                if position >= 0 and row_id not in exclude:
+                    matches.append(rank_key(name, query, position, row_id))
+        page = heapq.nsmallest(offset + limit, matches)[offset:]
+        return len(matches), [key[-1] for key in page]
+
+    def stats(self):
+        return {
+            "names": len(self._names),
+            "trigrams": len(self._postings),
+            "postings": sum(len(posting) for posting in self._postings.values()),
+        }
+
+
+class NameSearch:
+    """
+    Ranked, paginated search on the name of one table. MySQL answers from its FULLTEXT ngram index,
+    other databases, or a MySQL table still missing the index, from an NgramIndex in process: loaded
+    on the first search, kept current by the routes that write names and rebuilt every
+    SEARCH_INDEX_REFRESH seconds for what other workers wrote.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fulltext = True  # until MySQL says the index is missing
+        self._index = None
+        self._built_at = 0.0
+        self._building = None  # task rebuilding the index
+        self._changes = None  # writes made while a rebuild reads, replayed on the new index
+
+    def add(self, row_id, name):
+        """
+        Called after a name is committed
+        """
+        if self._index is not None:
+            self._index.add(row_id, name)
+        if self._changes is not None:
+            self._changes.append((row_id, name))
+
+    async def search(self, db, query, cursor=None, limit=DEFAULT_PAGE_SIZE, exclude=(), options=()):
+        """
+        One page of the rows whose name contains query, as {items, total, next_cursor}.
+        exclude is a set of ids left out, options are loader options for the rows.
+        """
+        offset = decode_offset_cursor(cursor) if cursor else 0
+        query = query.strip()
+        if self.fulltext and db.bind.dialect.name == "mysql":
+            try:
+                total, rows = await self._search_fulltext(db, query, offset, limit, exclude, options)
+                return search_page(rows, total, offset, limit)
+            except DBAPIError as error:
+                if getattr(error.orig, "args", ())[:1] != (NO_FULLTEXT_INDEX,):
+                    raise
+                await db.rollback()
+                self.fulltext = False
+                logger.warning(f"{self.model.__tablename__}.name has no FULLTEXT index, searching it in process")
+
+        total, ids = (await self._ready()).search(query, offset, limit, exclude)
+        rows = []
+        if ids:
+            found = {row.id: row for row in (await db.execute(
+                select(self.model).options(*options).filter(self.model.id.in_(ids))
+            )).scalars()}
+            # rows deleted by another worker since the index was built are left out
+            rows = [found[row_id] for row_id in ids if row_id in found]
+        return search_page(rows, total, offset, limit)
+
+    async def _search_fulltext(self, db, query, offset, limit, exclude, options):
+        model = self.model
+        filters = [fulltext_match(model.name, query)]
+        if exclude:
+            filters.append(model.id.notin_(exclude))
+        total = (await db.execute(select(func.count()).select_from(model).filter(*filters))).scalar()
+        rows = (await db.execute(
+            select(model)
+            .options(*options)
+            .filter(*filters)
+            .order_by(*fulltext_rank(model.name, model.id, query))
+            .offset(offset)
+            .limit(limit)
+        )).scalars().all()
+        return total, rows
+
+    async def _ready(self):
+        stale = time.monotonic() - self._built_at > SEARCH_INDEX_REFRESH
+        if (self._index is None or stale) and self._building is None:
+            self._building = asyncio.create_task(self._rebuild())
+        if self._index is None:
+            # searches that arrive during the first load wait for the same one
+            await asyncio.shield(self._building)
+        return self._index
+
+    async def _rebuild(self):
+        self._changes = []
+        try:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(select(self.model.id, self.model.name))).all()
+            # off the event loop, a large table takes seconds to index
+            index = await asyncio.to_thread(NgramIndex.build, rows)
+            for row_id, name in self._changes:
+                index.add(row_id, name)
+            self._index = index
+            self._built_at = time.monotonic()
+        finally:
+            self._changes = None
+            self._building = None
+
+
+def search_page(rows, total, offset, limit):
+    return {
+        "items": rows,
+        "total": total,
+        "next_cursor": encode_offset_cursor(offset + limit) if offset + limit < total else None,
+    }
+
+
+recipe_search = NameSearch(models.Recipe)
+product_search = NameSearch(models.Product)
+ingredient_search = NameSearch(models.Ingredient)
+user_search = NameSearch(models.User)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from decouple import config
+from sqlalchemy import select, insert, func, literal, union_all
+from sqlalchemy.exc import IntegrityError
+
+from models import models
+from utils.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# length of a snapshot period, a point in time query never replays more than one period of movements
+STOCK_SNAPSHOT_PERIOD = timedelta(hours=config('STOCK_SNAPSHOT_PERIOD_HOURS', default=24, cast=int))
+# a period is only snapshotted once it has been closed this long, so in flight transactions have committed
+STOCK_SNAPSHOT_SETTLE = timedelta(minutes=5)
+# seconds between two checks for a period to snapshot
+STOCK_SNAPSHOT_CHECK_INTERVAL = 600
+
+# Counter row the snapshot job and every backdated movement lock, so they take turns
+SNAPSHOTS_COUNTER = "stockSnapshots"
+
+_PERIOD_EPOCH = datetime(2000, 1, 1)
+
+
+def period_start(moment: datetime) -> datetime:
+    """
+    Start of the snapshot period the moment falls in, periods are aligned to midnight
+    """
+    periods = (moment - _PERIOD_EPOCH) // STOCK_SNAPSHOT_PERIOD
+    return _PERIOD_EPOCH + periods * STOCK_SNAPSHOT_PERIOD
+
+
+async def lock_snapshots(db):
+    """
+    Locks the snapshots counter row until the transaction ends, the first caller creates it
+    """
+    locked = select(models.Counter.value).filter(models.Counter.name == SNAPSHOTS_COUNTER).with_for_update()
+    if (await db.execute(locked)).scalar() is not None:
+        return
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(models.Counter).values(name=SNAPSHOTS_COUNTER, value=0))
+    except IntegrityError:
+        # another transaction created it first, wait for its lock
+        await db.execute(locked)
+
+
+async def latest_snapshot_before(db, moment: datetime):
+    return (await db.execute(
+        select(func.max(models.StockSnapshot.takenAt)).filter(models.StockSnapshot.takenAt <= moment)
+    )).scalar()
+
+
+def stock_rows_between(snapshot_at, until: datetime, ingredient_id=None):
+    """
+    (Ingredient_id, quantity) rows that add up to the stock at until: the snapshot taken at snapshot_at
+    plus the movements after it
+    """
+    movements = (select(models.StockMovement.Ingredient_id, models.StockMovement.quantity)
+                 .filter(models.StockMovement.effectiveAt <= until))
+    if snapshot_at is not None:
+        movements = movements.filter(models.StockMovement.effectiveAt > snapshot_at)
+    if ingredient_id is not None:
+        movements = movements.filter(models.StockMovement.Ingredient_id == ingredient_id)
+    if snapshot_at is None:
+        return movements
+
+    snapshot = (select(models.StockSnapshot.Ingredient_id, models.StockSnapshot.quantity)
+                .filter(models.StockSnapshot.takenAt == snapshot_at))
+    if ingredient_id is not None:
+        snapshot = snapshot.filter(models.StockSnapshot.Ingredient_id == ingredient_id)
+    return union_all(snapshot, movements)
+
+
+async def take_snapshot(db, taken_at: datetime, previous_at):
+    """
+    Builds the snapshot at taken_at from the previous one and the movements in between, in one INSERT ... SELECT
+    """
+    rows = stock_rows_between(previous_at, taken_at).subquery()
+    await db.execute(
+        insert(models.StockSnapshot).from_select(
+            ["takenAt", "Ingredient_id", "quantity"],
+            select(literal(taken_at), rows.c.Ingredient_id, func.sum(rows.c.quantity))
+            .group_by(rows.c.Ingredient_id)
+        )
+    )
+
+
+async def take_due_snapshots(db) -> int:
+    """
+    Snapshots every closed period since the last snapshot, one period at a time. Returns the number taken.
+    Each snapshot is read and written holding lock_snapshots: a backdated movement takes the same lock before it
+    is inserted and deletes the snapshots it changes, so it either commits before a snapshot reads the ledger or
+    waits for the snapshot to commit and deletes it.
+    """
+    last_closed = period_start(datetime.now() - STOCK_SNAPSHOT_SETTLE)
+    taken = 0
+    while True:
+        await lock_snapshots(db)
+        previous_at = (await db.execute(select(func.max(models.StockSnapshot.takenAt)))).scalar()
+        if previous_at is None:
+            first_movement = (await db.execute(select(func.min(models.StockMovement.effectiveAt)))).scalar()
+            if first_movement is None:
+                break
+            # the first snapshot closes the period of the first movement
+            next_at = period_start(first_movement) + STOCK_SNAPSHOT_PERIOD
+        else:
+            next_at = previous_at + STOCK_SNAPSHOT_PERIOD
+        if next_at > last_closed:
+            break
+        await take_snapshot(db, next_at, previous_at)
+        await db.commit()
+        taken += 1
+    # releases the lock
+    await db.rollback()
+    return taken
+
+
+async def run_snapshot_job():
+    """
+    Background task started with the app, keeps the stock snapshots up to the last closed period
+    """
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                taken = await take_due_snapshots(db)
+            if taken:
+                logger.info(f"Took {taken} stock snapshots")
+        except Exception:
+            logger.exception("Stock snapshot failed")
+        await asyncio.sleep(STOCK_SNAPSHOT_CHECK_INTERVAL)
@@ -0,0 +1,240 @@
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import select, insert, update, delete, case, event, exists, func, literal, and_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import models
+from utils.cache import stock_changed
+from utils.snapshots import lock_snapshots
+
+# Stock_Movement types
+GRN_RECEIPT = "grn_receipt"
+BATCH_CONSUMPTION = "batch_consumption"
+ADJUSTMENT = "adjustment"
+WRITE_OFF = "write_off"
+MOVEMENT_TYPES = (GRN_RECEIPT, BATCH_CONSUMPTION, ADJUSTMENT, WRITE_OFF)
+# note of the adjustments that carry the stock from before the ledger
+OPENING_BALANCE = "opening balance"
+# note of the movements open_ledger backfills from GRN and batch history
+LEDGER_HISTORY = "from history"
+# Counter row taken by the one run of open_ledger
+LEDGER_OPENED_COUNTER = "ledgerOpened"
+# Session.info key of the stock changes recorded in the open transaction
+PENDING_STOCK_CHANGES = "stockChanges"
+
+_dialect_inserts = {
+    "mysql": mysql.insert,
+    "mariadb": mysql.insert,
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+async def increment_upsert(db, model, key_columns, value_column, rows):
+    """
+    Inserts rows into model in one statement, rows whose key already exists get value_column added to theirs
+    """
+    if not rows:
+        return
+    dialect = db.bind.dialect.name
+    column = getattr(model, value_column)
+    statement = _dialect_inserts[dialect](model).values(rows)
+    if dialect in ("mysql", "mariadb"):
+        statement = statement.on_duplicate_key_update(
+            {value_column: column + getattr(statement.inserted, value_column)})
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=[getattr(model, key) for key in key_columns],
+            set_={value_column: column + getattr(statement.excluded, value_column)})
+    await db.execute(statement)
+
+
+async def add_stock(db, quantities):
+    """
+    Adds {ingredient_id: quantity} to Current_Stock with one upsert, rows are created for new ingredients
+    """
+    await increment_upsert(db, models.CurrentStock, ["Ingredient_id"], "current_quantity", [
+        {"Ingredient_id": ingredient_id, "current_quantity": quantity}
+        for ingredient_id, quantity in quantities.items()
+    ])
+
+
+async def take_stock(db, quantities):
+    """
+    Takes {ingredient_id: quantity} off Current_Stock with one UPDATE that only touches rows holding enough,
+    so stock can not go negative even where the database has no row locks. Raises 409 when a row falls short.
+    """
+    if not quantities:
+        return
+    result = await db.execute(
+        update(models.CurrentStock)
+        .where(models.CurrentStock.Ingredient_id.in_(quantities.keys()),
+               models.CurrentStock.current_quantity >= case(quantities, value=models.CurrentStock.Ingredient_id))
+        .values(current_quantity=models.CurrentStock.current_quantity
+                - case(quantities, value=models.CurrentStock.Ingredient_id))
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(quantities):
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Stock changed while it was being used, retry")
+
+
+async def add_grn_lines(db, quantities):
+    """
+    Adds {(grn_id, ingredient_id): quantity} to GRN_has_Ingredient with one upsert
+    """
+    await increment_upsert(db, models.GRN_has_Ingredient, ["GRN_id", "Ingredient_id"], "currentQuantity", [
+        {"GRN_id": grn_id, "Ingredient_id": ingredient_id, "currentQuantity": quantity}
+        for (grn_id, ingredient_id), quantity in quantities.items()
+    ])
+
+
+def movement_rows(movement_type, quantities, GRN_id=None, Batch_id=None, note=None, effective_at=None):
+    """
+    Stock_Movement rows for {ingredient_id: signed quantity}, quantities of 0 are left out.
+    effective_at is the business date of the change when it is not now, e.g. the issuedDate of a GRN.
+    """
+    return [
+        {"Ingredient_id": ingredient_id, "type": movement_type, "quantity": quantity,
+         "GRN_id": GRN_id, "Batch_id": Batch_id, "note": note,
+         **({"effectiveAt": effective_at} if effective_at is not None else {})}
+        for ingredient_id, quantity in quantities.items() if quantity
+    ]
+
+
+async def record_movements(db, rows, require_stock=False):
+    """
+    The only way stock changes. Appends the movements to the ledger with one insert and folds them into the
+    Current_Stock snapshot with one atomic increment per ingredient, no value is read back and written in Python.
+    With require_stock, what is taken off goes through take_stock and the transaction is refused rather than
+    leave an ingredient below zero.
+    The changes are published to the stock listeners when the transaction commits.
+    """
+    if not rows:
+        return
+    created_at = datetime.now()
+    rows = [{"GRN_id": None, "Batch_id": None, "note": None, "effectiveAt": created_at, **row, "createdAt": created_at}
+            for row in rows]
+    # a backdated movement changes every snapshot taken since, they are taken again by the snapshot job. The lock
+    # is taken first so the job can not read the ledger without this movement and commit after the delete
+    earliest = min(row["effectiveAt"] for row in rows)
+    if earliest < created_at:
+        await lock_snapshots(db)
+        await db.execute(delete(models.StockSnapshot).where(models.StockSnapshot.takenAt >= earliest))
+    await db.execute(insert(models.StockMovement), rows)
+
+    quantities = {}
+    for row in rows:
+        quantities[row["Ingredient_id"]] = quantities.get(row["Ingredient_id"], 0) + row["quantity"]
+    if require_stock:
+        await take_stock(db, {ingredient_id: -quantity
+                              for ingredient_id, quantity in quantities.items() if quantity < 0})
+        await add_stock(db, {ingredient_id: quantity for ingredient_id, quantity in quantities.items() if quantity > 0})
+    else:
+        await add_stock(db, quantities)
+
+    pending = db.info.setdefault(PENDING_STOCK_CHANGES, {})
+    for ingredient_id, quantity in quantities.items():
+        pending[ingredient_id] = pending.get(ingredient_id, 0) + quantity
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_stock_changes(session):
+    stock_changed(session.info.pop(PENDING_STOCK_CHANGES, {}))
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_stock_changes(session):
+    session.info.pop(PENDING_STOCK_CHANGES, None)
+
+
+async def open_ledger(db) -> bool:
+    """
+    Carries the stock history from before the ledger into it, so it can be asked for any business date:
+    - a GRN receipt on its issuedDate for every GRN line quantity the ledger does not hold yet
+    - a batch consumption on its productionDate for every batch made before the ledger, from the product's recipe
+    - per ingredient, an opening adjustment for what that history does not explain: its current_quantity minus
+      all its movements, dated with the earliest movement
+    Runs once, the first run takes a Counter row so later runs and other workers skip it, from then on the ledger
+    is the truth and Current_Stock is never read back into it. Returns whether it ran, the caller commits.
+    """
+    if (await db.execute(
+        select(models.Counter.value).filter(models.Counter.name == LEDGER_OPENED_COUNTER)
+    )).scalar() is not None:
+        return False
+    try:
+        await db.execute(insert(models.Counter).values(name=LEDGER_OPENED_COUNTER, value=1))
+    except IntegrityError:
+        # another worker is opening it
+        await db.rollback()
+        return False
+
+    now = datetime.now()
+    movement = models.StockMovement
+    columns = ["Ingredient_id", "type", "quantity", "GRN_id", "Batch_id", "note", "createdAt", "effectiveAt"]
+    ledger_started = (await db.execute(select(func.min(movement.createdAt)))).scalar() or now
+
+    # GRN lines, less what the ledger already received for them, e.g. the change of a GRN updated since
+    received = (select(movement.GRN_id, movement.Ingredient_id, func.sum(movement.quantity).label("quantity"))
+                .filter(movement.type == GRN_RECEIPT, movement.GRN_id.isnot(None))
+                .group_by(movement.GRN_id, movement.Ingredient_id)
+                .subquery())
+    missing = (func.coalesce(models.GRN_has_Ingredient.currentQuantity, 0)
+               - func.coalesce(received.c.quantity, 0))
+    await db.execute(insert(movement).from_select(columns, (
+        select(models.GRN_has_Ingredient.Ingredient_id, literal(GRN_RECEIPT), missing,
+               models.GRN_has_Ingredient.GRN_id, literal(None), literal(LEDGER_HISTORY), literal(now),
+               models.GRN.issuedDate)
+        .join(models.GRN, models.GRN.id == models.GRN_has_Ingredient.GRN_id)
+        .outerjoin(received, and_(received.c.GRN_id == models.GRN_has_Ingredient.GRN_id,
+                                  received.c.Ingredient_id == models.GRN_has_Ingredient.Ingredient_id))
+        .filter(missing != 0)
+    )))
+
+    # batches made before the ledger, one batch of the recipe as it is now, the batch count was not kept
+    consumed = exists().where(movement.Batch_id == models.Batch.id)
+    await db.execute(insert(movement).from_select(columns, (
+        select(models.RecipeHasIngredient.Ingredient_id, literal(BATCH_CONSUMPTION),
+               -models.RecipeHasIngredient.quantity, literal(None), models.Batch.id, literal(LEDGER_HISTORY),
+               literal(now), models.Batch.productionDate)
+        .select_from(models.Batch)
+        .join(models.Product, models.Product.id == models.Batch.product_id)
+        .join(models.RecipeHasIngredient, models.RecipeHasIngredient.Recipe_id == models.Product.Recipe_id)
+        .filter(models.Batch.productionDate < ledger_started, ~consumed, models.RecipeHasIngredient.quantity != 0)
+    )))
+
+    # what the history does not explain was in stock before it
+    opened_at = (await db.execute(select(func.min(movement.effectiveAt)))).scalar() or now
+    recorded = (select(movement.Ingredient_id, func.sum(movement.quantity).label("quantity"))
+                .group_by(movement.Ingredient_id)
+                .subquery())
+    balance = models.CurrentStock.current_quantity - func.coalesce(recorded.c.quantity, 0)
+    await db.execute(insert(movement).from_select(columns, (
+        select(models.CurrentStock.Ingredient_id, literal(ADJUSTMENT), balance, literal(None), literal(None),
+               literal(OPENING_BALANCE), literal(now), literal(opened_at))
+        .outerjoin(recorded, recorded.c.Ingredient_id == models.CurrentStock.Ingredient_id)
+        .filter(balance != 0)
+    )))
+
+    # snapshots were taken without the history
+    await db.execute(delete(models.StockSnapshot))
+    return True
+
+
+async def rebuild_current_stock(db):
+    """
+    Replaces the Current_Stock snapshot with the ledger totals in two bulk statements.
+    Stock from before the ledger is in it as the opening balances, written once by open_ledger.
+    """
+    await open_ledger(db)
+    await db.execute(delete(models.CurrentStock))
+    await db.execute(
+        insert(models.CurrentStock).from_select(
+            ["Ingredient_id", "current_quantity"],
+            select(models.StockMovement.Ingredient_id, func.sum(models.StockMovement.quantity))
+            .group_by(models.StockMovement.Ingredient_id)
+        )
+    )